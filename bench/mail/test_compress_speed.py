@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# test_compress_speed.py
+# Copyright (C) 2016 LEAP Encryption Acess Project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarking for the COMPRESS=DEFLATE extension of the IMAP server
+(leap.bitmask.mail.imap.server._DeflateTransport).
+
+Every test writes the FETCH responses of a mailbox to a transport, flushing
+once per message as the server does, and records the bytes that would go on
+the wire in the extra info of the benchmark, next to the raw size.
+"""
+
+import os
+import pytest
+import random
+
+from email.parser import Parser
+
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+
+from leap.bitmask.mail.imap.server import _DeflateTransport
+
+
+GROUP_HEADERS = 'header sync'
+GROUP_BODIES = 'full bodies'
+GROUP_BIG = 'incompressible attachments'
+
+CORPUS_DIR = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'tests', 'integration', 'mail')
+
+CORPUS = (
+    'rfc822.message',
+    'rfc822.multi.message',
+    'rfc822.multi-signed.message',
+    'rfc822.bounce.message',
+)
+
+MAILBOX_SIZE = 500
+
+
+def _get_corpus():
+    messages = []
+    for name in CORPUS:
+        with open(os.path.join(CORPUS_DIR, name)) as f:
+            messages.append(f.read())
+    return messages
+
+
+def _get_mailbox(size=MAILBOX_SIZE, words=400):
+    """
+    A mailbox with the headers of the messages of the corpus, and a text body
+    made of words of the corpus picked at random, so that the messages are
+    not copies of each other that the compressor would find in its window.
+    """
+    corpus = _get_corpus()
+    vocabulary = ' '.join(corpus).split()
+    rand = random.Random(0)
+    mailbox = []
+    for i in range(size):
+        msg = Parser().parsestr(corpus[i % len(corpus)])
+        body = ' '.join(rand.choice(vocabulary) for _ in range(words))
+        for header in ('Subject', 'Message-ID', 'Content-Type',
+                       'Content-Transfer-Encoding'):
+            del msg[header]
+        msg['Subject'] = 'message %d of the benchmark mailbox' % i
+        msg['Message-ID'] = '<%x@example.org>' % rand.getrandbits(96)
+        msg['Content-Type'] = 'text/plain; charset="us-ascii"'
+        msg.set_payload(body)
+        mailbox.append(msg.as_string())
+    return mailbox
+
+
+def _get_big_mailbox(size=10, attachment=256 * 1024):
+    corpus = _get_corpus()
+    return [corpus[0] + os.urandom(attachment).encode('base64')
+            for i in range(size)]
+
+
+def _fetch_headers(mailbox):
+    response = []
+    for uid, raw in enumerate(mailbox, 1):
+        headers = raw.split('\n\n', 1)[0].replace('\n', '\r\n') + '\r\n\r\n'
+        response.append(
+            '* %d FETCH (UID %d FLAGS (\\Seen) RFC822.SIZE %d '
+            'BODY[HEADER] {%d}\r\n%s)\r\n' % (
+                uid, uid, len(raw), len(headers), headers))
+    return response
+
+
+def _fetch_bodies(mailbox):
+    response = []
+    for uid, raw in enumerate(mailbox, 1):
+        raw = raw.replace('\n', '\r\n')
+        response.append(
+            '* %d FETCH (UID %d BODY[] {%d}\r\n%s)\r\n' % (
+                uid, uid, len(raw), raw))
+    return response
+
+
+MAILBOX = _get_mailbox()
+
+RESPONSES = {
+    'headers': _fetch_headers(MAILBOX),
+    'bodies': _fetch_bodies(MAILBOX),
+    'big': _fetch_bodies(_get_big_mailbox()),
+}
+
+
+def write_plain(response):
+    transport = StringTransport()
+    for msg in response:
+        transport.write(msg)
+    return len(transport.value())
+
+
+def write_compressed(response):
+    transport = StringTransport()
+    deflater = _DeflateTransport(transport)
+    deflater.clock = task.Clock()
+    for msg in response:
+        deflater.write(msg)
+        deflater.clock.advance(0)
+    return len(transport.value())
+
+
+#
+# generic speed test creator
+#
+
+def create_test(fun, name, group=None):
+
+    @pytest.mark.benchmark(group=group)
+    def test(benchmark):
+        response = RESPONSES[name]
+        raw = sum(map(len, response))
+        wire = benchmark(fun, response)
+        benchmark.extra_info['raw_bytes'] = raw
+        benchmark.extra_info['wire_bytes'] = wire
+        benchmark.extra_info['ratio'] = float(wire) / raw
+
+    return test
+
+
+test_plain_headers = create_test(
+    write_plain, 'headers', group=GROUP_HEADERS)
+test_deflate_headers = create_test(
+    write_compressed, 'headers', group=GROUP_HEADERS)
+test_plain_bodies = create_test(
+    write_plain, 'bodies', group=GROUP_BODIES)
+test_deflate_bodies = create_test(
+    write_compressed, 'bodies', group=GROUP_BODIES)
+test_plain_big = create_test(
+    write_plain, 'big', group=GROUP_BIG)
+test_deflate_big = create_test(
+    write_compressed, 'big', group=GROUP_BIG)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# test_ingestion_speed.py
+# Copyright (C) 2016 LEAP Encryption Acess Project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarking for the ingestion of messages (leap.bitmask.mail.walk and the
+splitting of a message into documents in the soledad adaptor).
+"""
+
+import os
+import pytest
+
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import Parser
+
+from leap.bitmask.mail import walk
+from leap.bitmask.mail.adaptors.soledad import _split_into_parts
+
+
+GROUP_WALK = 'walk only'
+GROUP_INGEST = 'parse, walk and build docs'
+
+CORPUS_DIR = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'tests', 'integration', 'mail')
+
+CORPUS = {
+    'simple': 'rfc822.message',
+    'multi': 'rfc822.multi.message',
+    'multisigned': 'rfc822.multi-signed.message',
+    'bounced': 'rfc822.bounce.message',
+}
+
+
+def _get_corpus_message(name):
+    with open(os.path.join(CORPUS_DIR, CORPUS[name])) as f:
+        return f.read()
+
+
+def _get_big_message(attachments=4, size=1024 * 1024):
+    msg = MIMEMultipart()
+    msg['Subject'] = 'big message'
+    msg['From'] = 'alice@example.org'
+    msg['To'] = 'bob@example.org'
+    msg.attach(MIMEText('a body\n' * 100))
+    for i in range(attachments):
+        msg.attach(MIMEApplication(os.urandom(size)))
+    return msg.as_string()
+
+
+MESSAGES = dict(
+    (name, _get_corpus_message(name)) for name in CORPUS)
+MESSAGES['big'] = _get_big_message()
+
+
+#
+# generic speed test creator
+#
+
+def create_test(fun, name, group=None):
+
+    @pytest.mark.benchmark(group=group)
+    def test(benchmark):
+        benchmark(fun, MESSAGES[name])
+
+    return test
+
+
+#
+# a single walk of an already parsed message, the parsing is left out
+#
+
+def walk_parsed(msg):
+    return walk.walk_msg(msg)
+
+
+def create_walk_test(name):
+
+    @pytest.mark.benchmark(group=GROUP_WALK)
+    def test(benchmark):
+        msg = Parser().parsestr(MESSAGES[name])
+        benchmark(walk_parsed, msg)
+
+    return test
+
+
+test_walk_simple = create_walk_test('simple')
+test_walk_multi = create_walk_test('multi')
+test_walk_multisigned = create_walk_test('multisigned')
+test_walk_bounced = create_walk_test('bounced')
+test_walk_big = create_walk_test('big')
+
+
+#
+# the whole ingestion: parse, walk and build the documents
+#
+
+test_ingest_simple = create_test(
+    _split_into_parts, 'simple', group=GROUP_INGEST)
+test_ingest_multi = create_test(
+    _split_into_parts, 'multi', group=GROUP_INGEST)
+test_ingest_multisigned = create_test(
+    _split_into_parts, 'multisigned', group=GROUP_INGEST)
+test_ingest_bounced = create_test(
+    _split_into_parts, 'bounced', group=GROUP_INGEST)
+test_ingest_big = create_test(
+    _split_into_parts, 'big', group=GROUP_INGEST)
@@ -44,6 +44,8 @@ try:
     from leap.bitmask.keymanager.errors import KeyNotFound
     from leap.bitmask.keymanager.validation import ValidationLevels
     from leap.bitmask.mail import errors
+    from leap.bitmask.mail.adaptors.soledad import ContentDocCache
+    from leap.bitmask.mail.adaptors.soledad import SoledadMailAdaptor
     from leap.bitmask.mail.constants import INBOX_NAME
     from leap.bitmask.mail.mail import Account
     from leap.bitmask.mail.imap import service as imap_service
@@ -463,6 +465,31 @@ class KeymanagerService(HookableService):
         return self._container.status(userid)
 
 
+def start_parsing_pool(size):
+    """
+    Start the pool of worker processes that parse the big messages that are
+    added to the mailboxes. It has to be started before the reactor runs, and
+    it is terminated when the reactor shuts down.
+
+    :param size: the number of worker processes.
+    :type size: int
+    """
+    if HAS_MAIL:
+        SoledadMailAdaptor.start_parsing_pool(size)
+
+
+def set_content_cache_size(size):
+    """
+    Set the memory ceiling of the caches of content documents of the mail
+    accounts.
+
+    :param size: the total size of the cached payloads, in bytes.
+    :type size: int
+    """
+    if HAS_MAIL:
+        ContentDocCache.set_max_size(size)
+
+
 class StandardMailService(service.MultiService, HookableService):
     """
     A collection of Services.
@@ -487,6 +514,7 @@ class StandardMailService(service.MultiService, HookableService):
         self._soledad_sessions = {}
         self._keymanager_sessions = {}
         self._outgoing_sessions = {}
+        self._bouncers = {}
         self._service_tokens = {}
         self._mixnet_enabled = mixnet_enabled
         super(StandardMailService, self).__init__()
@@ -507,6 +535,9 @@ class StandardMailService(service.MultiService, HookableService):
     def stopService(self):
         self.log.info('Stopping Mail service')
         super(StandardMailService, self).stopService()
+        for bouncer in self._bouncers.values():
+            bouncer.close()
+        self._bouncers = {}
 
     def startInstance(self, userid, soledad, keymanager):
 
@@ -531,6 +562,11 @@ class StandardMailService(service.MultiService, HookableService):
         return d
 
     def _create_outgoing_service(self, bouncer, userid, keymanager, soledad):
+        old_bouncer = self._bouncers.pop(userid, None)
+        if old_bouncer is not None:
+            old_bouncer.close()
+        self._bouncers[userid] = bouncer
+
         outgoing = OutgoingMail(userid, keymanager, bouncer)
 
         username, provider = userid.split('@')
@@ -820,7 +856,14 @@ class IncomingMailService(service.MultiService):
         super(IncomingMailService, self).startService()
 
     def stopService(self):
-        super(IncomingMailService, self).stopService()
+        d = super(IncomingMailService, self).stopService()
+        # the instances hold the shared accounts, so they are dropped; they
+        # are created again by startInstance.
+        for incoming in list(self):
+            self.removeService(incoming)
+            incoming.account.release()
+        self._status = {}
+        return d
 
     # Individual accounts
 
@@ -868,17 +911,17 @@ class IncomingMailService(service.MultiService):
             self._set_status(userid, "on")
             return res
 
-        # XXX ----------------------------------------------------------------
-        # TODO we probably want to enforce a SINGLE ACCOUNT INSTANCE
-        # earlier in the bootstrap process (ie, upper in the hierarchy of
-        # services) so that the single instance can be shared by the imap and
-        # the pixelated mua.
-        # XXX ----------------------------------------------------------------
+        def releaseAccount(failure):
+            acc.release()
+            return failure
 
-        acc = Account(soledad, userid)
+        # the account is shared with the imap sessions and the bouncer, and
+        # it is released when this service stops.
+        acc = Account.acquire(soledad, userid)
         d = acc.callWhenReady(
             lambda _: acc.get_collection_by_mailbox(INBOX_NAME))
         d.addCallback(setUpIncomingMail, acc)
+        d.addErrback(releaseAccount)
         d.addCallback(setStatusOn)
         d.addErrback(self._errback, userid)
         return d
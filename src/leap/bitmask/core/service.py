@@ -98,6 +98,12 @@ class BitmaskBackend(configurable.ConfigurableService):
 
         on_start = reactor.callWhenRunning
 
+        if HAS_MAIL and self._enabled('mail'):
+            # the worker processes are forked now, before the reactor
+            # starts any thread.
+            self._init_parsing_pool()
+            self._init_content_cache()
+
         on_start(self.init_events)
         on_start(self.init_bonafide)
         on_start(self.init_sessions)
@@ -205,6 +211,16 @@ class BitmaskBackend(configurable.ConfigurableService):
         if km:
             km.register_hook('on_new_keymanager_instance', listener='mail')
 
+    def _init_parsing_pool(self):
+        size = int(self.get_config('mail', 'parsing_pool_size', 0))
+        if size > 0:
+            mail_services.start_parsing_pool(size)
+
+    def _init_content_cache(self):
+        size = self.get_config('mail', 'content_cache_size', None)
+        if size is not None:
+            mail_services.set_content_cache_size(int(size) * 1024 * 1024)
+
     def _init_mail(self):
         service = mail_services.StandardMailService
         self._maybe_init_service('mail', service, self.basedir,
@@ -16,12 +16,16 @@
 """
 Soledadad MailAdaptor module.
 """
+import multiprocessing
 import re
+import signal
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from email import message_from_string
 
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
 from twisted.logger import Logger
 from zope.interface import implements
 
@@ -33,6 +37,8 @@ from leap.bitmask.mail.adaptors import soledad_indexes as indexes
 from leap.bitmask.mail.constants import INBOX_NAME
 from leap.bitmask.mail.adaptors import models
 from leap.bitmask.mail.imap.mailbox import normalize_mailbox
+from leap.bitmask.mail.imap.structure import get_envelope
+from leap.bitmask.mail.imap.structure import get_body_structure
 from leap.bitmask.mail.utils import lowerdict, first
 from leap.bitmask.mail.utils import stringify_parts_map
 from leap.bitmask.mail.interfaces import IMailAdaptor, IMessageWrapper
@@ -56,12 +62,111 @@ class DuplicatedDocumentError(Exception):
     pass
 
 
+class KeyedDeferredLock(object):
+    """
+    A set of DeferredLocks, one for each key, so that only the calls made
+    with the same key are serialized.
+
+    The lock for a key is discarded as soon as nobody holds it or waits for
+    it.
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    def run(self, key, f, *args, **kwargs):
+        """
+        Run f while holding the lock for key.
+
+        :param key: the key of the lock, any hashable object.
+        :return: a deferred that will fire with the result of f.
+        :rtype: Deferred
+        """
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = defer.DeferredLock()
+
+        def discard_lock(result):
+            if not lock.locked and not lock.waiting:
+                if self._locks.get(key) is lock:
+                    del self._locks[key]
+            return result
+
+        d = lock.run(f, *args, **kwargs)
+        d.addBoth(discard_lock)
+        return d
+
+
+class ParsingPool(object):
+    """
+    A pool of worker processes, to parse messages out of the reactor thread.
+
+    The pool has to be started before the reactor starts any thread: a
+    process forked while another thread holds a lock gets that lock held
+    forever, and its worker could deadlock on it. The processes are
+    terminated when the reactor shuts down, or when the pool is closed.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._pool = None
+        self._trigger = None
+        # every call blocks a thread of the reactor threadpool while it
+        # waits for its worker, so no more calls than workers are made.
+        self._semaphore = defer.DeferredSemaphore(size)
+
+    def start(self):
+        """
+        Fork the worker processes.
+        """
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(
+                self.size, _init_parsing_worker)
+            self._trigger = reactor.addSystemEventTrigger(
+                'before', 'shutdown', self._shutdown)
+
+    def run(self, f, *args):
+        """
+        Run f in a worker process.
+
+        :param f: a module level function, so that it can be pickled. Its
+                  arguments and its result have to be picklable too.
+        :return: a deferred that will fire with the result of f.
+        :rtype: Deferred
+        """
+        assert self._pool is not None, "The parsing pool is not started"
+        return self._semaphore.run(deferToThread, self._pool.apply, f, args)
+
+    def close(self):
+        if self._trigger is not None:
+            reactor.removeSystemEventTrigger(self._trigger)
+            self._trigger = None
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _shutdown(self):
+        self._trigger = None
+        self.close()
+
+
+def _init_parsing_worker():
+    # The workers are forked from the reactor process, and they inherit the
+    # signal handlers of the reactor, that would make them ignore the SIGTERM
+    # with which the pool terminates them.
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
 def cleanup_deferred_locks():
     """
     Need to use this from within trial to cleanup the reactor before
     each run.
     """
-    SoledadDocumentWrapper._k_locks = defaultdict(defer.DeferredLock)
+    SoledadDocumentWrapper._k_locks = KeyedDeferredLock()
+    SoledadMailAdaptor._mbox_locks = KeyedDeferredLock()
 
 
 class SoledadDocumentWrapper(models.DocumentWrapper):
@@ -79,18 +184,21 @@ class SoledadDocumentWrapper(models.DocumentWrapper):
     # TODO we could also use a _dirty flag (in models)
     # TODO add a get_count() method ??? -- that is extended over l2db.
 
-    # We keep a dictionary with DeferredLocks, that will be
-    # unique to every subclass of SoledadDocumentWrapper.
-    _k_locks = defaultdict(defer.DeferredLock)
+    # We keep DeferredLocks keyed by the subclass name and the store, so that
+    # the queries of every subclass of SoledadDocumentWrapper are only
+    # serialized for the same store.
+    _k_locks = KeyedDeferredLock()
 
     @classmethod
-    def _get_klass_lock(cls):
+    def _run_with_klass_lock(cls, store, key, f, *args):
         """
-        Get a DeferredLock that is unique for this subclass name.
+        Run f(store, *args) holding the lock for this subclass name, the
+        store and the rest of the key.
         Used to lock the access to indexes in the `get_or_create` call
         for a particular DocumentWrapper.
         """
-        return cls._k_locks[cls.__name__]
+        key = (cls.__name__, id(store)) + key
+        return cls._k_locks.run(key, f, store, *args)
 
     def __init__(self, doc_id=None, future_doc_id=None, **kwargs):
         self._doc_id = doc_id
@@ -220,8 +328,8 @@ class SoledadDocumentWrapper(models.DocumentWrapper):
                  matching the index query, either existing or just created.
         :rtype: Deferred
         """
-        return cls._get_klass_lock().run(
-            cls._get_or_create, store, index, value)
+        return cls._run_with_klass_lock(
+            store, (index, value), cls._get_or_create, index, value)
 
     @classmethod
     def _get_or_create(cls, store, index, value):
@@ -328,7 +436,15 @@ class SoledadDocumentWrapper(models.DocumentWrapper):
         # [ ] benchmark the cost of querying and returning indexes in a big
         #     database. This might badly need pagination before being put to
         #     serious use.
-        return cls._get_klass_lock().run(cls._get_all, store)
+
+        # The listing does not wait for the get_or_create calls in course,
+        # that hold the lock of their (index, value) only. That is safe
+        # because the listing is a single index query, and every document
+        # is created with a single write: the listing sees a document that
+        # is being created or not, but never half of it. Whoever caches a
+        # listing (like the MailboxCatalogue) has to drop it if a document
+        # was created meanwhile.
+        return cls._run_with_klass_lock(store, (), cls._get_all)
 
     @classmethod
     def _get_all(cls, store):
@@ -408,6 +524,10 @@ class HeaderDocWrapper(SoledadDocumentWrapper):
         msgid = ""
         multi = False
 
+        # precomputed IMAP fetch items
+        envelope = []
+        bodystructure = []
+
         class __meta__(object):
             index = "chash"
 
@@ -457,6 +577,9 @@ class MessageWrapper(object):
     implements(IMessageWrapper)
     log = Logger()
 
+    # the ContentDocCache to get the body from, if any. See `get_body`.
+    cdoc_cache = None
+
     def __init__(self, mdoc, fdoc, hdoc, cdocs=None, is_copy=False):
         """
         Need at least a metamsg-document, a flag-document and a header-document
@@ -465,7 +588,7 @@ class MessageWrapper(object):
 
         cdocs, if any, should be a dictionary in which the keys are ascending
         integers, beginning at one, and the values are dictionaries with the
-        content of the content-docs.
+        content of the content-docs (or the documents, or ContentDocWrappers).
 
         is_copy, if set to True, will only attempt to create mdoc and fdoc
         (because hdoc and cdocs are supposed to exist already)
@@ -473,6 +596,9 @@ class MessageWrapper(object):
         self._is_copy = is_copy
 
         def get_doc_wrapper(doc, cls):
+            if isinstance(doc, cls):
+                # already wrapped, like the cached content documents.
+                return doc
             if isinstance(doc, SoledadDocument):
                 doc_id = doc.doc_id
                 doc = doc.content
@@ -528,11 +654,10 @@ class MessageWrapper(object):
             if self.hdoc.doc_id is None:
                 hdoc = yield self.hdoc.create(store)
                 self.hdoc = hdoc
-            for cdoc in self.cdocs.values():
-                if cdoc.doc_id is not None:
-                    # we could be just linking to an existing
-                    # content-doc.
-                    continue
+            # we could be just linking to existing content-docs.
+            cdocs = yield _skip_existing_cdocs(
+                store, self.cdocs.values(), self.log)
+            for cdoc in cdocs:
                 yield cdoc.create(store)
         defer.returnValue(self)
 
@@ -551,6 +676,9 @@ class MessageWrapper(object):
         if self.mdoc.doc_id:
             d.append(self.mdoc.delete(store))
         d.append(self.fdoc.delete(store))
+        if self.cdoc_cache is not None:
+            for cdoc_id in self.mdoc.cdocs:
+                self.cdoc_cache.discard(_get_phash(cdoc_id))
         return defer.gatherResults(d)
 
     def copy(self, store, new_mbox_uuid):
@@ -628,8 +756,9 @@ class MessageWrapper(object):
         """
         body_phash = self.hdoc.body
         if body_phash:
-            d = store.get_doc('C-' + body_phash)
-            d.addCallback(lambda doc: ContentDocWrapper(**doc.content))
+            doc_id = constants.CDOCID.format(phash=body_phash)
+            d = _get_cdoc_wrappers(store, [doc_id], self.cdoc_cache)
+            d.addCallback(lambda wrappers: wrappers[doc_id])
             return d
         elif self.cdocs:
             return self.cdocs[1]
@@ -785,7 +914,24 @@ class SoledadMailAdaptor(SoledadIndexMixin):
     wait_for_indexes = ['get_or_create_mbox', 'update_mbox', 'get_all_mboxes']
 
     mboxwrapper_klass = MailboxWrapper
-    atomic = defer.DeferredLock()
+
+    # locks for the operations on a mailbox, keyed by store and mailbox name
+    _mbox_locks = KeyedDeferredLock()
+
+    # how many messages to retrieve with a single get_docs call
+    max_msgs_per_query = 200
+
+    # the ContentDocCache where the content documents are kept once
+    # retrieved, if any. The Account shares one for each user.
+    cdoc_cache = None
+
+    # the pool of worker processes where get_msg_from_string_async parses
+    # the messages, shared by all the adaptors. Without it, they are always
+    # parsed in the reactor thread.
+    _parsing_pool = None
+    # the messages smaller than this (in bytes) are parsed in the reactor
+    # thread anyway, since it takes less than sending them to a worker.
+    parsing_pool_threshold = 256 * 1024
 
     log = Logger()
 
@@ -812,6 +958,64 @@ class SoledadMailAdaptor(SoledadIndexMixin):
         return self.get_msg_from_docs(
             MessageClass, mdoc, fdoc, hdoc, cdocs)
 
+    def get_msg_from_string_async(self, MessageClass, raw_msg):
+        """
+        Like `get_msg_from_string`, but the message is parsed and split into
+        documents in a pool of worker processes if the pool was started (see
+        `start_parsing_pool`) and the message is at least
+        `parsing_pool_threshold` bytes long.
+
+        :param MessageClass: any Message class that can be initialized passing
+                             an instance of an IMessageWrapper implementor.
+        :type MessageClass: type
+        :param raw_msg: a string containing the raw email message.
+        :type raw_msg: str
+        :return: a deferred that will fire with a MessageClass instance.
+        :rtype: Deferred
+        """
+        assert(MessageClass is not None)
+        pool = SoledadMailAdaptor._parsing_pool
+        if pool is None or len(raw_msg) < self.parsing_pool_threshold:
+            return defer.maybeDeferred(
+                self.get_msg_from_string, MessageClass, raw_msg)
+
+        def get_msg_from_parts((mdoc, fdoc, hdoc, cdocs)):
+            return self.get_msg_from_docs(
+                MessageClass, mdoc, fdoc, hdoc, cdocs)
+
+        d = pool.run(_split_into_parts, raw_msg)
+        d.addCallback(get_msg_from_parts)
+        return d
+
+    @classmethod
+    def start_parsing_pool(cls, size):
+        """
+        Start the pool of worker processes where get_msg_from_string_async
+        parses the big messages.
+
+        This has to be called when the service starts, before the reactor
+        runs. See ParsingPool.
+
+        :param size: the number of worker processes.
+        :type size: int
+        :return: the pool
+        :rtype: ParsingPool
+        """
+        if cls._parsing_pool is None:
+            pool = ParsingPool(size)
+            pool.start()
+            cls._parsing_pool = pool
+        return cls._parsing_pool
+
+    @classmethod
+    def stop_parsing_pool(cls):
+        """
+        Terminate the pool of worker processes, if it was started.
+        """
+        if cls._parsing_pool is not None:
+            cls._parsing_pool.close()
+            cls._parsing_pool = None
+
     def get_msg_from_docs(self, MessageClass, mdoc, fdoc, hdoc, cdocs=None,
                           uid=None):
         """
@@ -839,7 +1043,9 @@ class SoledadMailAdaptor(SoledadIndexMixin):
         :rtype: MessageClass instance.
         """
         assert(MessageClass is not None)
-        return MessageClass(MessageWrapper(mdoc, fdoc, hdoc, cdocs), uid=uid)
+        wrapper = MessageWrapper(mdoc, fdoc, hdoc, cdocs)
+        wrapper.cdoc_cache = self.cdoc_cache
+        return MessageClass(wrapper, uid=uid)
 
     def get_msg_from_mdoc_id(self, MessageClass, store, mdoc_id,
                              uid=None, get_cdocs=False):
@@ -852,11 +1058,14 @@ class SoledadMailAdaptor(SoledadIndexMixin):
             d_docs = []
             d_docs.append(store.get_doc(wrapper.fdoc))
             d_docs.append(store.get_doc(wrapper.hdoc))
-            for cdoc in wrapper.cdocs:
-                d_docs.append(store.get_doc(cdoc))
+            d_docs.append(
+                _get_cdoc_wrappers(store, wrapper.cdocs, self.cdoc_cache))
 
-            def add_mdoc(doc_list):
-                return [wrapper.serialize()] + doc_list
+            def add_mdoc((fdoc, hdoc, cdocs)):
+                # the wrapper itself is passed on, so that the message keeps
+                # the doc_id of its meta document.
+                return [wrapper, fdoc, hdoc] + [
+                    cdocs.get(doc_id) for doc_id in wrapper.cdocs]
 
             d = defer.gatherResults(d_docs)
             d.addCallback(add_mdoc)
@@ -923,6 +1132,107 @@ class SoledadMailAdaptor(SoledadIndexMixin):
         return self.get_msg_from_docs(
             msg_class, mdoc, fdoc, hdoc, cdocs, uid=uid)
 
+    @defer.inlineCallbacks
+    def get_msgs_from_mdoc_ids(self, MessageClass, store, mdoc_ids,
+                               uids=None, get_hdoc=True, get_cdocs=False):
+        """
+        Get a MessageClass instance for each one of the passed meta-doc ids.
+
+        Instead of issuing one get_doc per part document, the mdocs, fdocs
+        and hdocs for a batch of messages are retrieved with a single
+        get_docs call (the fdoc and hdoc ids can be derived from the mdoc
+        id), and the content-docs, if requested, with a second one. The
+        messages are then assembled in memory.
+
+        :param MessageClass: any Message class that can be initialized passing
+                             an instance of an IMessageWrapper implementor.
+        :type MessageClass: type
+        :param store: an instance of Soledad, or anything that behaves alike
+        :param mdoc_ids: the doc_ids of the meta-documents to retrieve.
+        :type mdoc_ids: list
+        :param uids: the uids to pass to each message, in the same order than
+                     mdoc_ids.
+        :type uids: list or None
+        :param get_hdoc: whether to retrieve the header-documents. If not,
+                         the messages will have an empty header-document.
+        :type get_hdoc: bool
+        :param get_cdocs: whether to retrieve also the content-documents.
+        :type get_cdocs: bool
+
+        :return: a Deferred that will fire with a list of MessageClass
+                 instances, in the same order than mdoc_ids. Messages that
+                 cannot be found are returned as None.
+        :rtype: Deferred
+        """
+        mdoc_ids = list(mdoc_ids)
+        if uids is None:
+            uids = [None] * len(mdoc_ids)
+        msgs = []
+        size = self.max_msgs_per_query
+        for i in range(0, len(mdoc_ids), size):
+            batch = zip(mdoc_ids[i:i + size], uids[i:i + size])
+            try:
+                batch_msgs = yield self._get_msgs_batch(
+                    MessageClass, store, batch, get_hdoc, get_cdocs)
+            except Exception as exc:
+                # get_docs does not cope with ids that are not in the store,
+                # which can happen if a message is being deleted while we
+                # fetch it. Fall back to retrieving them one by one.
+                self.log.warn(
+                    'Error while getting messages in batch, '
+                    'falling back to one by one: %r' % (exc,))
+                batch_msgs = yield defer.gatherResults([
+                    self.get_msg_from_mdoc_id(
+                        MessageClass, store, mdoc_id,
+                        uid=uid, get_cdocs=get_cdocs)
+                    for (mdoc_id, uid) in batch])
+            msgs.extend(batch_msgs)
+        defer.returnValue(msgs)
+
+    @defer.inlineCallbacks
+    def _get_msgs_batch(self, MessageClass, store, batch,
+                        get_hdoc, get_cdocs):
+        doc_ids = []
+        for mdoc_id, _ in batch:
+            mbox = re.findall(constants.METAMSGID_MBOX_RE, mdoc_id)[0]
+            chash = re.findall(constants.METAMSGID_CHASH_RE, mdoc_id)[0]
+            doc_ids.append(mdoc_id)
+            doc_ids.append(
+                constants.FDOCID.format(mbox_uuid=mbox, chash=chash))
+            if get_hdoc:
+                doc_ids.append(
+                    constants.HDOCID.format(mbox_uuid=mbox, chash=chash))
+
+        docs = yield store.get_docs(doc_ids)
+        docs = dict((doc.doc_id, doc) for doc in docs)
+
+        cdocs = {}
+        if get_cdocs:
+            cdoc_ids = set()
+            for mdoc_id, _ in batch:
+                if mdoc_id in docs:
+                    cdoc_ids.update(docs[mdoc_id].content.get('cdocs', []))
+            cdocs = yield _get_cdoc_wrappers(
+                store, cdoc_ids, self.cdoc_cache)
+
+        msgs = []
+        for mdoc_id, uid in batch:
+            mdoc = docs.get(mdoc_id)
+            if mdoc is None:
+                self.log.error('BUG: Error while getting msg (uid=%s)' % uid)
+                msgs.append(None)
+                continue
+            wrapper = MetaMsgDocWrapper(doc_id=mdoc.doc_id, **mdoc.content)
+            msg_cdocs = None
+            if get_cdocs:
+                msg_cdocs = dict(enumerate(
+                    [cdocs.get(cdoc_id) for cdoc_id in wrapper.cdocs], 1))
+            msgs.append(self.get_msg_from_docs(
+                MessageClass, mdoc,
+                docs.get(wrapper.fdoc), docs.get(wrapper.hdoc),
+                msg_cdocs, uid=uid))
+        defer.returnValue(msgs)
+
     def get_flags_from_mdoc_id(self, store, mdoc_id):
         """
         # XXX stuff here...
@@ -951,6 +1261,30 @@ class SoledadMailAdaptor(SoledadIndexMixin):
         d.addCallback(get_flags)
         return d
 
+    def get_all_flags_by_chash(self, store, mbox_uuid):
+        """
+        Get the flags for all the messages in a given mailbox, with a single
+        index query.
+
+        :param store: instance of Soledad.
+        :param mbox_uuid: the uuid for this mailbox.
+        :return: a Deferred that will fire with a dict mapping the content
+                 hash of each message to its list of flags.
+        :rtype: Deferred
+        """
+        type_ = FlagsDocWrapper.model.type_
+        uuid = mbox_uuid.replace('-', '_')
+
+        def get_flags_by_chash(fdocs):
+            return dict(
+                (doc.content.get('chash'),
+                 map(str, doc.content.get('flags', [])))
+                for doc in fdocs)
+
+        d = store.get_from_index(indexes.TYPE_MBOX_UUID_IDX, type_, uuid)
+        d.addCallback(get_flags_by_chash)
+        return d
+
     def create_msg(self, store, msg):
         """
         :param store: an instance of soledad, or anything that behaves alike
@@ -975,41 +1309,202 @@ class SoledadMailAdaptor(SoledadIndexMixin):
         wrapper = msg.get_wrapper()
         return wrapper.update(store)
 
-    # batch deletion
+    # batch operations
 
-    def del_all_flagged_messages(self, store, mbox_uuid):
+    def create_msgs(self, store, msgs):
         """
-        Delete all messages flagged as deleted.
+        Create the documents for several new messages.
+
+        The documents of every `max_msgs_per_query` messages are written all
+        at once, instead of one after the other. The header and content
+        documents that are shared by several messages of a batch are written
+        only once, and the content documents already in the store are looked
+        up with a single query and not written again.
+
+        :param store: an instance of Soledad, or anything that behaves alike
+        :param msgs: a list of Message objects.
+        :type msgs: list
+        :return: a deferred that will fire with the doc_ids of the
+                 meta-documents of the messages, in the same order than msgs,
+                 or None for the messages whose meta-document is not in the
+                 store after trying to create it.
+        :rtype: Deferred
+        """
+        def create_chunk(msgs):
+            wrappers = [msg.get_wrapper() for msg in msgs]
+            creating = []
+            cdocs = []
+            future_doc_ids = set()
+            for wrapper in wrappers:
+                copy = wrapper._is_copy
+                creating.append(wrapper.mdoc.create(store, is_copy=copy))
+                creating.append(wrapper.fdoc.create(store, is_copy=copy))
+                if copy:
+                    continue
+                for doc in [wrapper.hdoc] + wrapper.cdocs.values():
+                    # we could be just linking to an existing document, or
+                    # to one that another message of the batch creates.
+                    if (doc.doc_id is not None or
+                            doc.future_doc_id in future_doc_ids):
+                        continue
+                    future_doc_ids.add(doc.future_doc_id)
+                    if doc is wrapper.hdoc:
+                        creating.append(doc.create(store))
+                    else:
+                        cdocs.append(doc)
+
+            d = _skip_existing_cdocs(store, cdocs, self.log)
+            d.addCallback(lambda new_cdocs: defer.gatherResults(
+                [cdoc.create(store) for cdoc in new_cdocs]))
+            creating.append(d)
+
+            d = defer.gatherResults(creating)
+            d.addCallback(lambda _: get_mdoc_ids(wrappers))
+            return d
+
+        def get_mdoc_ids(wrappers):
+            # a meta-doc without doc_id could not be created, but it can
+            # also be that it was already there (the message was already in
+            # the mailbox).
+            not_created = [
+                wrapper.mdoc.future_doc_id for wrapper in wrappers
+                if wrapper.mdoc.doc_id is None]
+            d = _get_existing_docs(store, not_created)
+            d.addCallback(lambda docs: set(doc.doc_id for doc in docs))
+            d.addCallback(lambda existing: [
+                wrapper.mdoc.doc_id or (
+                    wrapper.mdoc.future_doc_id
+                    if wrapper.mdoc.future_doc_id in existing else None)
+                for wrapper in wrappers])
+            return d
+
+        return self._run_in_chunks(msgs, create_chunk)
+
+    def copy_msgs(self, store, mdoc_ids, new_mbox_uuid):
+        """
+        Copy several messages to another mailbox.
+
+        Only the meta and flags documents are written for the copies, since
+        the header and content documents are addressed by content and are
+        shared already. The documents are read with a single get_docs call
+        for every `max_msgs_per_query` messages.
+
+        :param store: an instance of Soledad, or anything that behaves alike
+        :param mdoc_ids: the doc_ids of the meta-documents of the messages.
+        :type mdoc_ids: list
+        :param new_mbox_uuid: the uuid of the mailbox where the messages are
+                              copied to.
+        :type new_mbox_uuid: str
+        :return: a deferred that will fire with the doc_ids of the new
+                 meta-documents, in the same order than mdoc_ids. The
+                 messages that could not be found are skipped.
+        :rtype: Deferred
         """
+        def copy_doc(doc, klass):
+            wrapper = klass(**doc.content)
+            wrapper.set_mbox_uuid(new_mbox_uuid)
+            return wrapper
 
-        def delete_fdoc_and_mdoc_flagged(fdocs):
-            # low level here, not using the wrappers...
-            # get meta doc ids from the flag doc ids
-            fdoc_ids = [doc.doc_id for doc in fdocs]
-            mdoc_ids = map(lambda s: "M" + s[1:], fdoc_ids)
-
-            def delete_all_docs(mdocs, fdocs):
-                mdocs = list(mdocs)
-                doc_ids = [m.doc_id for m in mdocs]
-                _d = []
-                docs = mdocs + fdocs
-                for doc in docs:
-                    _d.append(store.delete_doc(doc))
-                d = defer.gatherResults(_d)
-                # return the mdocs ids only
-                d.addCallback(lambda _: doc_ids)
-                return d
+        def copy_chunk(mdoc_ids):
+            d = store.get_docs(mdoc_ids + _get_fdoc_ids(mdoc_ids))
+            d.addCallback(create_copies, mdoc_ids)
+            return d
+
+        def create_copies(docs, mdoc_ids):
+            docs = dict((doc.doc_id, doc) for doc in docs)
+            copies = []
+            for mdoc_id, fdoc_id in zip(mdoc_ids, _get_fdoc_ids(mdoc_ids)):
+                if mdoc_id not in docs or fdoc_id not in docs:
+                    self.log.warn('Cannot copy missing message %s' % mdoc_id)
+                    continue
+                copies.append((
+                    copy_doc(docs[mdoc_id], MetaMsgDocWrapper),
+                    copy_doc(docs[fdoc_id], FlagsDocWrapper)))
+
+            d = defer.gatherResults([
+                doc.create(store, is_copy=True)
+                for copy in copies for doc in copy])
+            # a copy that could not be created has no doc_id
+            d.addCallback(lambda _: [
+                mdoc.doc_id for (mdoc, fdoc) in copies if mdoc.doc_id])
+            return d
+
+        return self._run_in_chunks(mdoc_ids, copy_chunk)
+
+    def del_msgs(self, store, mdoc_ids):
+        """
+        Delete the meta and flags documents of several messages.
+
+        The messages are deleted in chunks of `max_msgs_per_query`, so that
+        deleting thousands of them does not queue all the deletions in the
+        store at once.
+
+        :param store: an instance of Soledad, or anything that behaves alike
+        Documents that are already missing from the store are skipped, so
+        that a single message deleted elsewhere does not make the whole
+        batch fail.
+
+        :param store: an instance of Soledad, or anything that behaves alike
+        :param mdoc_ids: the doc_ids of the meta-documents of the messages.
+        :type mdoc_ids: list
+        :return: a deferred that will fire with the doc_ids of the meta docs
+                 that are not in the store anymore, whether they were deleted
+                 now or were already missing.
+        :rtype: Deferred
+        """
+        # low level here, not using the wrappers...
 
-            d = store.get_docs(mdoc_ids)
-            d.addCallback(delete_all_docs, fdocs)
+        def delete_chunk(mdoc_ids):
+            d = _get_existing_docs(store, mdoc_ids + _get_fdoc_ids(mdoc_ids))
+            d.addCallback(delete_docs, mdoc_ids)
             return d
 
+        def delete_docs(docs, mdoc_ids):
+            if self.cdoc_cache is not None:
+                # the content may be shared with other messages, but it is
+                # likely that nobody is going to fetch it soon.
+                for doc in docs:
+                    for cdoc_id in doc.content.get('cdocs', []):
+                        self.cdoc_cache.discard(_get_phash(cdoc_id))
+            d = defer.gatherResults(
+                [store.delete_doc(doc) for doc in docs])
+            # return the mdocs ids only
+            d.addCallback(lambda _: mdoc_ids)
+            return d
+
+        return self._run_in_chunks(mdoc_ids, delete_chunk)
+
+    @defer.inlineCallbacks
+    def _run_in_chunks(self, doc_ids, f):
+        # the chunks go one after the other, and the results of f (lists) are
+        # concatenated.
+        results = []
+        doc_ids = list(doc_ids)
+        step = self.max_msgs_per_query
+        for i in range(0, len(doc_ids), step):
+            result = yield f(doc_ids[i:i + step])
+            results.extend(result)
+        defer.returnValue(results)
+
+    def del_all_flagged_messages(self, store, mbox_uuid):
+        """
+        Delete all messages flagged as deleted.
+
+        :return: a deferred that will fire with the doc_ids of the deleted
+                 meta docs.
+        :rtype: Deferred
+        """
+        def delete_flagged(fdocs):
+            # get meta doc ids from the flag doc ids
+            mdoc_ids = ["M" + doc.doc_id[1:] for doc in fdocs]
+            return self.del_msgs(store, mdoc_ids)
+
         type_ = FlagsDocWrapper.model.type_
         uuid = mbox_uuid.replace('-', '_')
         deleted_index = indexes.TYPE_MBOX_DEL_IDX
 
         d = store.get_from_index(deleted_index, type_, uuid, "1")
-        d.addCallback(delete_fdoc_and_mdoc_flagged)
+        d.addCallback(delete_flagged)
         return d
 
     # count messages
@@ -1075,6 +1570,32 @@ class SoledadMailAdaptor(SoledadIndexMixin):
 
     # Mailbox handling
 
+    def run_with_mbox_lock(self, store, names, f, *args, **kwargs):
+        """
+        Run f holding the locks for the passed mailboxes of a store.
+
+        The operations on other mailboxes, or on the mailboxes of other
+        stores, are not serialized with this one.
+
+        :param store: instance of Soledad
+        :param names: the names of the mailboxes to lock.
+        :type names: tuple of str
+        :param f: the function to run.
+        :type f: callable
+        :return: a deferred that will fire with the result of f.
+        :rtype: Deferred
+        """
+        # always acquired in the same order, to avoid deadlocks.
+        keys = sorted(set(
+            [(id(store), normalize_mailbox(name)) for name in names]))
+
+        def run_with_locks(keys):
+            if not keys:
+                return defer.maybeDeferred(f, *args, **kwargs)
+            return self._mbox_locks.run(keys[0], run_with_locks, keys[1:])
+
+        return run_with_locks(keys)
+
     def get_or_create_mbox(self, store, name):
         """
         Get the mailbox with the given name, or create one if it does not
@@ -1115,6 +1636,214 @@ class SoledadMailAdaptor(SoledadIndexMixin):
         return MailboxWrapper.get_all(store)
 
 
+def _get_fdoc_ids(mdoc_ids):
+    # the flags docs have the same id than the meta docs, but for the prefix
+    return ["F" + mdoc_id[1:] for mdoc_id in mdoc_ids]
+
+
+def _get_existing_docs(store, doc_ids):
+    """
+    Get the documents for the doc_ids that are in the store, skipping the
+    missing and deleted ones.
+
+    :param store: an instance of Soledad, or anything that behaves alike
+    :param doc_ids: the ids of the documents.
+    :type doc_ids: list
+    :return: a deferred that will fire with the list of documents found.
+    :rtype: Deferred
+    """
+    def get_one_by_one(failure):
+        # get_docs does not cope with ids that are not in the store, so in
+        # that case the documents are retrieved one by one.
+        d = defer.gatherResults([store.get_doc(doc_id) for doc_id in doc_ids])
+        d.addCallback(lambda docs: [doc for doc in docs if doc is not None])
+        return d
+
+    if not doc_ids:
+        return defer.succeed([])
+    d = store.get_docs(doc_ids)
+    d.addCallback(list)
+    d.addErrback(get_one_by_one)
+    return d
+
+
+class ContentDedupStats(object):
+    """
+    Counters for the content documents that were not written again, because
+    a document with the same payload was already in the store.
+    """
+
+    def __init__(self):
+        self.skipped_docs = 0
+        self.saved_bytes = 0
+
+    def add(self, skipped_docs, saved_bytes):
+        self.skipped_docs += skipped_docs
+        self.saved_bytes += saved_bytes
+
+
+content_dedup_stats = ContentDedupStats()
+
+
+class ContentDocCache(object):
+    """
+    A cache of ContentDocWrappers, keyed by the payload hash of the content,
+    that keeps the ones used most recently while the total size of their
+    payloads fits in `max_size` bytes.
+
+    The doc_id of a content document is derived from its payload, so a
+    cached content document never gets stale. It is discarded when the
+    document is deleted or synced, to free the memory.
+    """
+
+    # the default ceiling, in bytes. See `set_max_size`.
+    max_size = 32 * 1024 * 1024
+
+    def __init__(self, max_size=None):
+        if max_size is not None:
+            self.max_size = max_size
+        self._wrappers = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def set_max_size(cls, max_size):
+        """
+        Set the ceiling of the caches that do not have their own.
+
+        :param max_size: the total size of the cached payloads, in bytes.
+        :type max_size: int
+        """
+        cls.max_size = max_size
+
+    def __len__(self):
+        return len(self._wrappers)
+
+    def get(self, phash):
+        """
+        :return: the ContentDocWrapper for this payload hash, or None if it
+                 is not in the cache.
+        """
+        wrapper = self._wrappers.pop(phash, None)
+        if wrapper is None:
+            self.misses += 1
+            return None
+        self._wrappers[phash] = wrapper
+        self.hits += 1
+        return wrapper
+
+    def add(self, phash, wrapper):
+        """
+        Add a ContentDocWrapper, dropping the least recently used ones if
+        the cache is full. A payload bigger than the whole cache is not
+        cached.
+        """
+        self.discard(phash)
+        size = len(wrapper.raw)
+        if size > self.max_size:
+            return
+        self._wrappers[phash] = wrapper
+        self.size += size
+        while self.size > self.max_size:
+            _, old = self._wrappers.popitem(last=False)
+            self.size -= len(old.raw)
+
+    def discard(self, phash):
+        wrapper = self._wrappers.pop(phash, None)
+        if wrapper is not None:
+            self.size -= len(wrapper.raw)
+
+    def clear(self):
+        self._wrappers.clear()
+        self.size = 0
+
+
+def _get_phash(cdoc_id):
+    return cdoc_id[len(constants.CDOCID.format(phash='')):]
+
+
+@defer.inlineCallbacks
+def _get_cdoc_wrappers(store, cdoc_ids, cache=None):
+    """
+    Get the ContentDocWrappers for several content documents, taking the
+    ones that are in the cache from there, and adding the others to it.
+
+    :param store: an instance of Soledad, or anything that behaves alike
+    :param cdoc_ids: the ids of the content documents.
+    :type cdoc_ids: iterable
+    :param cache: optional, the ContentDocCache to use.
+    :type cache: ContentDocCache
+    :return: a deferred that will fire with a dict mapping the doc_ids to
+             the ContentDocWrappers. The documents that are not in the store
+             are left out.
+    :rtype: Deferred
+    """
+    wrappers = {}
+    missing = []
+    for doc_id in sorted(set(cdoc_ids)):
+        wrapper = None
+        if cache is not None:
+            wrapper = cache.get(_get_phash(doc_id))
+        if wrapper is None:
+            missing.append(doc_id)
+        else:
+            wrappers[doc_id] = wrapper
+    docs = yield _get_existing_docs(store, missing)
+    for doc in docs:
+        wrapper = ContentDocWrapper(doc_id=doc.doc_id, **doc.content)
+        wrappers[doc.doc_id] = wrapper
+        if cache is not None:
+            cache.add(_get_phash(doc.doc_id), wrapper)
+    defer.returnValue(wrappers)
+
+
+def _skip_existing_cdocs(store, cdocs, log):
+    """
+    Find out which of the content docs are already in the store, with a
+    single lookup, so that they are not written (and encrypted and synced)
+    again.
+
+    The content docs are addressed by the hash of their payload, so the
+    existing ones are just linked to. The skipped documents and the bytes
+    saved are added to `content_dedup_stats`.
+
+    :param store: an instance of Soledad, or anything that behaves alike
+    :param cdocs: the ContentDocWrappers that are about to be created.
+    :type cdocs: list
+    :param log: the logger where the saved bytes are reported.
+    :return: a deferred that will fire with the content docs that still have
+             to be created.
+    :rtype: Deferred
+    """
+    cdocs = [cdoc for cdoc in cdocs if cdoc.doc_id is None]
+    if not cdocs:
+        return defer.succeed([])
+
+    def skip_existing(docs):
+        existing = set(doc.doc_id for doc in docs)
+        new_cdocs = []
+        saved = 0
+        for cdoc in cdocs:
+            if cdoc.future_doc_id not in existing:
+                new_cdocs.append(cdoc)
+                continue
+            cdoc._doc_id = cdoc.future_doc_id
+            cdoc.set_future_doc_id(None)
+            saved += len(cdoc.raw)
+        skipped = len(cdocs) - len(new_cdocs)
+        if skipped:
+            content_dedup_stats.add(skipped, saved)
+            log.debug('Skipped %d existing content docs, %d bytes saved' % (
+                skipped, saved))
+        return new_cdocs
+
+    d = _get_existing_docs(
+        store, sorted(set(cdoc.future_doc_id for cdoc in cdocs)))
+    d.addCallback(skip_existing)
+    return d
+
+
 def _split_into_parts(raw):
     # TODO signal that we can delete the original message!-----
     # when all the processing is done.
@@ -1124,12 +1853,13 @@ def _split_into_parts(raw):
     # TODO seed propely the content_docs with defaults??
 
     msg, chash, multi = _parse_msg(raw)
-    size = len(msg.as_string())
+    # the size is that of the raw message, serializing the parsed one again
+    # would cost as much as parsing it.
+    size = len(raw)
 
-    parts_map = walk.get_tree(msg)
-    cdocs_list = list(walk.get_raw_docs(msg))
+    # a single walk, since this runs for every message that is stored.
+    parts_map, cdocs_list, body_phash = walk.walk_msg(msg)
     cdocs_phashes = [c['phash'] for c in cdocs_list]
-    body_phash = walk.get_body_phash(msg)
 
     mdoc = _build_meta_doc(chash, cdocs_phashes)
     fdoc = _build_flags_doc(chash, size, multi)
@@ -1170,7 +1900,9 @@ def _build_headers_doc(msg, chash, body_phash, parts_map):
     Assemble a headers document from the original parsed message, the
     content-hash, and the parts map.
 
-    It takes into account possibly repeated headers.
+    It takes into account possibly repeated headers. The IMAP ENVELOPE and
+    BODYSTRUCTURE of the message are also computed here, so that they can be
+    served without walking the content documents.
     """
     headers = defaultdict(list)
     for k, v in msg.items():
@@ -1186,7 +1918,8 @@ def _build_headers_doc(msg, chash, body_phash, parts_map):
 
     _hdoc = HeaderDocWrapper(
         chash=chash, headers=headers, body=body_phash,
-        msgid=msgid)
+        msgid=msgid, envelope=get_envelope(msg),
+        bodystructure=get_body_structure(msg))
 
     def copy_attr(headers, key, doc):
         if key in headers:
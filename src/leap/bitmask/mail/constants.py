@@ -30,6 +30,7 @@ METAMSGID_MBOX_RE = "M\-(\w+)\-[0-9a-fA-F]+"
 FDOCID = "F-{mbox_uuid}-{chash}"
 FDOCID_RE = "F\-{mbox_uuid}\-[0-9a-fA-F]+"
 FDOCID_CHASH_RE = "F\-\w+\-([0-9a-fA-F]+)"
+FDOCID_MBOX_RE = "F\-(\w+)\-[0-9a-fA-F]+"
 
 HDOCID = "H-{chash}"
 HDOCID_RE = "H\-[0-9a-fA-F]+"
@@ -37,6 +38,11 @@ HDOCID_RE = "H\-[0-9a-fA-F]+"
 CDOCID = "C-{phash}"
 CDOCID_RE = "C\-[0-9a-fA-F]+"
 
+# The maximum number of host parameters in a single sqlite statement (the
+# default SQLITE_MAX_VARIABLE_NUMBER). The raw queries on the local database
+# have to be split to stay below it.
+SQLITE_MAX_VARIABLES = 999
+
 
 class MessageFlags(object):
     """
@@ -25,3 +25,7 @@ class AuthenticationError(Exception):
 
 class ConfigurationError(Exception):
     pass
+
+
+class MessageStorageError(Exception):
+    pass
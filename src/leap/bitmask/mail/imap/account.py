@@ -50,7 +50,7 @@ class IMAPAccount(object):
     selected = None
     log = Logger()
 
-    def __init__(self, store, user_id, d=defer.Deferred()):
+    def __init__(self, store, user_id, d=None):
         """
         Keeps track of the mailboxes and subscriptions handled by this account.
 
@@ -79,8 +79,20 @@ class IMAPAccount(object):
         # about user_id, only the client backend.
 
         self.user_id = user_id
-        self.account = Account(
-            store, user_id, ready_cb=lambda: d.callback(self))
+        # the Account is shared by all the sessions of this user, and it can
+        # be already initialized.
+        self.account = Account.acquire(store, user_id)
+        self._released = False
+        if d is not None:
+            self.account.callWhenReady(lambda _: d.callback(self))
+
+    def logout(self):
+        """
+        Release the shared Account when the imap session is closed.
+        """
+        if not self._released:
+            self._released = True
+            self.account.release()
 
     def end_session(self):
         """
@@ -19,12 +19,16 @@ IMAP Mailbox.
 """
 import re
 import os
+import sys
 import io
 import cStringIO
 import StringIO
 import time
+import weakref
 
-from collections import defaultdict
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 from email.utils import formatdate
 
 from twisted.internet import defer
@@ -38,42 +42,286 @@ from leap.common.check import leap_assert
 from leap.common.check import leap_assert_type
 from leap.bitmask.mail.constants import INBOX_NAME, MessageFlags
 from leap.bitmask.mail.imap.messages import IMAPMessage
+from leap.bitmask.mail.search_indexer import SearchQueryError
 
-# TODO LIST
-# [ ] finish the implementation of IMailboxListener
-# [ ] implement the rest of ISearchableMailbox
+INIT_FLAGS = (MessageFlags.RECENT_FLAG, MessageFlags.LIST_FLAG)
 
 
-INIT_FLAGS = (MessageFlags.RECENT_FLAG, MessageFlags.LIST_FLAG)
+# The changes of a selected mailbox that have not been sent to the client:
+# the sequence numbers of the expunged messages (from the highest to the
+# lowest) and their uids, the number of messages and of recent messages if
+# there are new ones, and a (msn, uid, flags, modseq) tuple for every message
+# whose flags changed.
+MailboxUpdates = namedtuple(
+    'MailboxUpdates', ['expunged', 'vanished', 'exists', 'recent', 'flags'])
+
+
+class MailboxEvents(object):
+    """
+    The source of the changes of a mailbox for the IMAP sessions that
+    selected it.
+
+    There is one for every collection, no matter how many sessions selected
+    its mailbox: it listens to the collection, and it gathers the new,
+    expunged and flagged messages for `delay` seconds, so that a burst of
+    changes (like a batch of incoming messages, or a sync) reaches the
+    sessions as a single update. The count of recent messages comes from the
+    counters of the collection, and the modseqs of the flagged messages are
+    retrieved once for all the sessions.
+    """
+
+    delay = 0.1
+    clock = reactor
+
+    log = Logger()
+
+    _sources = weakref.WeakValueDictionary()
+
+    def __init__(self, collection):
+        # the collection keeps its listeners, so it is not referenced back.
+        self._collection = weakref.ref(collection)
+        self._mailboxes = weakref.WeakSet()
+        self._reset()
+
+    @classmethod
+    def for_collection(cls, collection):
+        """
+        Get the events of a collection, listening to it if they did not
+        exist yet.
+
+        :rtype: MailboxEvents
+        """
+        events = cls._sources.get(id(collection))
+        if events is None or events._collection() is not collection:
+            events = cls(collection)
+            collection.addListener(events)
+            cls._sources[id(collection)] = events
+        return events
+
+    def add(self, mbox):
+        self._mailboxes.add(mbox)
+
+    def discard(self, mbox):
+        self._mailboxes.discard(mbox)
+        if not self._mailboxes:
+            if self._call is not None and self._call.active():
+                self._call.cancel()
+            self._reset()
+
+    def _reset(self):
+        self._call = None
+        self._resync = False
+        self._added = set()
+        self._expunged = set()
+        self._flags = {}
+
+    # collection listener
+
+    def notify_new(self):
+        # the uids of the new messages are not known, so all of them are
+        # listed when the changes are sent.
+        self._resync = True
+        self._schedule()
+
+    def notify_added(self, uids):
+        self._added.update(uids)
+        self._schedule()
+
+    def notify_expunged(self, uids):
+        for uid in uids:
+            self._added.discard(uid)
+            self._flags.pop(uid, None)
+        self._expunged.update(uids)
+        self._schedule()
+
+    def notify_flags(self, flags):
+        self._flags.update(flags)
+        self._schedule()
+
+    def _schedule(self):
+        if not self._mailboxes:
+            self._reset()
+        elif self._call is None:
+            self._call = self.clock.callLater(self.delay, self.flush)
+
+    def flush(self):
+        """
+        Pass the gathered changes to the mailboxes now.
+
+        :return: a deferred that will fire when the mailboxes have them.
+        :rtype: Deferred
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        resync, added = self._resync, self._added
+        expunged, flags = self._expunged, self._flags
+        self._reset()
+
+        collection = self._collection()
+        if collection is None or not self._mailboxes:
+            return defer.succeed(None)
+        if not (resync or added or expunged or flags):
+            return defer.succeed(None)
+
+        def get_added():
+            if resync:
+                return collection.all_uid_iter()
+            return defer.succeed(added)
+
+        def get_modseqs():
+            if not flags:
+                return defer.succeed([])
+            return collection.get_modseqs(sorted(flags))
+
+        def queue_updates(result):
+            added, recent, modseqs = result
+            modseqs = dict(modseqs)
+            changed = dict(
+                (uid, (flags[uid], modseqs[uid]))
+                for uid in flags if uid in modseqs)
+            for mbox in list(self._mailboxes):
+                mbox.queue_updates(added, expunged, changed, recent)
+
+        d = defer.gatherResults([
+            get_added(), collection.count_recent(), get_modseqs()],
+            consumeErrors=True)
+        d.addCallback(queue_updates)
+        d.addErrback(lambda f: self.log.failure(
+            'Error while sending the changes of a mailbox', f))
+        return d
 
 
-def make_collection_listener(mailbox):
+class MessageSequence(object):
     """
-    Wrap a mailbox in a class that can be hashed according to the mailbox name.
+    The messages that a client knows about in the mailbox that it selected,
+    that give their message sequence numbers.
 
-    This means that dicts or sets will use this new equality rule, so we won't
-    collect multiple instances of the same mailbox in collections like the
-    MessageCollection set where we keep track of listeners.
+    The uids are kept sorted in an array, so the numbers are resolved with a
+    binary search, and a big mailbox takes a few bytes per message. It is
+    indexed like the sorted list of the uids.
     """
 
-    class HashableMailbox(object):
+    def __init__(self, uids=()):
+        self._uids = array('L', sorted(uids))
+
+    def __len__(self):
+        return len(self._uids)
+
+    def __iter__(self):
+        return iter(self._uids)
+
+    def __getitem__(self, index):
+        return self._uids[index]
+
+    def __contains__(self, uid):
+        return self.get_msn(uid) is not None
+
+    def get_uid(self, msn):
+        """
+        :return: the uid of a message sequence number, or None.
+        """
+        if 0 < msn <= len(self._uids):
+            return self._uids[msn - 1]
+        return None
+
+    def get_msn(self, uid):
+        """
+        :return: the message sequence number of a uid, or None.
+        """
+        i = bisect_left(self._uids, uid)
+        if i < len(self._uids) and self._uids[i] == uid:
+            return i + 1
+        return None
+
+    def add(self, uid):
+        """
+        Add a message. New messages get higher uids than the rest, so they
+        are just appended.
 
-        def __init__(self, mbox):
-            self.mbox = mbox
+        :return: whether the message was not known before.
+        :rtype: bool
+        """
+        uids = self._uids
+        if not uids or uid > uids[-1]:
+            uids.append(uid)
+            return True
+        i = bisect_left(uids, uid)
+        if uids[i] == uid:
+            return False
+        uids.insert(i, uid)
+        return True
 
-            # See #8083, pixelated adaptor introduces conflicts in the usage
-            self.mailbox_name = self.mbox.mbox_name + 'IMAP'
+    def remove(self, uid):
+        """
+        Remove a message.
 
-        def __hash__(self):
-            return hash(self.mailbox_name)
+        :return: the message sequence number that it had, or None if it was
+                 not known.
+        """
+        msn = self.get_msn(uid)
+        if msn is not None:
+            del self._uids[msn - 1]
+        return msn
 
-        def __eq__(self, other):
-            return self.mailbox_name == other.mbox.mbox_name + 'IMAP'
+    def get_ranges(self, messages, uid):
+        """
+        Resolve a sequence set to the messages in it that the client knows
+        about.
 
-        def notify_new(self):
-            self.mbox.notify_new()
+        An open range (n:*) ends at the last message, and if n is greater
+        than it, the last message is still in the range (rfc 3501). The set
+        itself is not modified.
 
-    return HashableMailbox(mailbox)
+        :param messages: the set, or an iterable of ids.
+        :type messages: MessageSet
+        :param uid: if true, the ids are UIDs. They are message sequence
+                    numbers otherwise.
+        :type uid: bool
+        :return: the sorted (first, last) ranges of message sequence numbers
+                 of the messages, without any overlap.
+        :rtype: list
+        """
+        uids = self._uids
+        if not uids:
+            return []
+        last = uids[-1] if uid else len(uids)
+        ranges = getattr(messages, 'ranges', None)
+        if ranges is None:
+            ranges = [(i, i) for i in messages]
+
+        msn_ranges = []
+        for lo, hi in ranges:
+            lo = last if lo is None else lo
+            hi = last if hi is None else hi
+            if lo > hi:
+                lo, hi = hi, lo
+            if uid:
+                first, end = bisect_left(uids, lo) + 1, bisect_right(uids, hi)
+            else:
+                first, end = max(lo, 1), min(hi, len(uids))
+            if first <= end:
+                msn_ranges.append((first, end))
+
+        merged = []
+        for first, end in sorted(msn_ranges):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((first, end))
+        return merged
+
+    def get_uid_set(self, ranges):
+        """
+        :param ranges: the ranges of message sequence numbers, as returned
+                       by `get_ranges`.
+        :return: the uids of the messages in the ranges, to be resolved
+                 with bounded queries.
+        :rtype: MessageSet
+        """
+        uid_set = imap4.MessageSet()
+        for first, end in ranges:
+            uid_set.add(self._uids[first - 1], self._uids[end - 1])
+        return uid_set
 
 
 class IMAPMailbox(object):
@@ -104,11 +352,12 @@ class IMAPMailbox(object):
     CMD_UIDNEXT = "UIDNEXT"
     CMD_UIDVALIDITY = "UIDVALIDITY"
     CMD_UNSEEN = "UNSEEN"
+    CMD_HIGHESTMODSEQ = "HIGHESTMODSEQ"
 
-    log = Logger()
+    # max number of messages to keep in memory while streaming a FETCH
+    fetch_window_size = 200
 
-    # TODO we should turn this into a datastructure with limited capacity
-    _listeners = defaultdict(set)
+    log = Logger()
 
     def __init__(self, collection, rw=1):
         """
@@ -121,7 +370,12 @@ class IMAPMailbox(object):
         self.rw = rw
         self._uidvalidity = None
         self.collection = collection
-        self.collection.addListener(make_collection_listener(self))
+        self._listeners = set()
+
+        # the messages that the client knows about, once the mailbox is
+        # selected, and the changes not sent to it yet.
+        self._sequence = None
+        self._pending = None
 
     @property
     def mbox_name(self):
@@ -132,23 +386,23 @@ class IMAPMailbox(object):
         """
         Returns listeners for this mbox.
 
-        The server itself is a listener to the mailbox.
-        so we can notify it (and should!) after changes in flags
-        and number of messages.
+        The server itself is a listener to the mailbox, so that it is told
+        about the changes in the flags and the number of messages, see
+        `queue_updates`.
 
         :rtype: set
         """
-        return self._listeners[self.mbox_name]
+        return self._listeners
 
-    def get_imap_message(self, message):
+    def get_imap_message(self, message, prefetch_body=True):
+        store = self.collection.store
+        if not prefetch_body:
+            return defer.succeed(
+                IMAPMessage(message, prefetch_body=False, store=store))
         d = defer.Deferred()
-        IMAPMessage(message, store=self.collection.store, d=d)
+        IMAPMessage(message, store=store, d=d)
         return d
 
-    # FIXME this grows too crazily when many instances are fired, like
-    # during imaptest stress testing. Should have a queue of limited size
-    # instead.
-
     def addListener(self, listener):
         """
         Add a listener to the listeners queue.
@@ -163,6 +417,7 @@ class IMAPMailbox(object):
         self.log.debug('Adding mailbox listener: %s. Total: %s' % (
                        listener, len(listeners)))
         listeners.add(listener)
+        MailboxEvents.for_collection(self.collection).add(self)
 
     def removeListener(self, listener):
         """
@@ -171,7 +426,131 @@ class IMAPMailbox(object):
         :param listener: listener to remove
         :type listener: an object that implements IMailboxListener
         """
-        self.listeners.remove(listener)
+        self.listeners.discard(listener)
+        if not self.listeners:
+            MailboxEvents.for_collection(self.collection).discard(self)
+            self._sequence = self._pending = None
+
+    def load_uids(self):
+        """
+        Get the uids of the messages of this mailbox when it is selected.
+
+        From then on, they are the messages that the client knows about, and
+        the ones that its message sequence numbers refer to in all its
+        commands: the changes in the mailbox are applied to them when they
+        are sent to the client, see `get_updates`.
+
+        :return: a deferred that will fire with the MessageSequence.
+        :rtype: Deferred
+        """
+        def set_sequence(uids):
+            self._sequence = MessageSequence(uids)
+            return self._sequence
+
+        # the changes made while the uids are retrieved are kept too, they
+        # are ignored if the uids already have them.
+        self._sequence = None
+        self._pending = _new_pending()
+        MailboxEvents.for_collection(self.collection).add(self)
+        d = self.collection.all_uid_iter()
+        d.addCallback(set_sequence)
+        return d
+
+    def _get_sequence(self):
+        """
+        Get the messages that the client knows about, to resolve its ids.
+
+        They are kept once the mailbox is selected. Otherwise, they are the
+        messages in the mailbox right now.
+
+        :return: a deferred that will fire with a MessageSequence.
+        :rtype: Deferred
+        """
+        if self._sequence is not None:
+            return defer.succeed(self._sequence)
+        d = self.collection.all_uid_iter()
+        d.addCallback(MessageSequence)
+        return d
+
+    def queue_updates(self, added, expunged, flags, recent):
+        """
+        Keep the changes of the mailbox until they can be sent to the client,
+        and tell the listeners about them.
+
+        Called by the MailboxEvents of the collection.
+
+        :param added: the uids of the new messages.
+        :param expunged: the uids of the expunged messages.
+        :param flags: a dict mapping the uids of the flagged messages to a
+                      (flags, modseq) tuple.
+        :param recent: the number of recent messages.
+        """
+        if self._pending is None:
+            return
+        pending_added, pending_expunged, pending_flags, pending_recent = \
+            self._pending
+        pending_added.update(added)
+        pending_added.difference_update(expunged)
+        pending_expunged.update(expunged)
+        pending_flags.update(flags)
+        pending_recent[0] = recent
+        if self._sequence is None:
+            return
+        for listener in list(self.listeners):
+            notify = getattr(listener, 'updatesPending', None)
+            if notify is not None:
+                notify()
+
+    def get_updates(self):
+        """
+        Get the changes of the mailbox not sent to the client yet, applying
+        them to the messages that it knows about.
+
+        :return: the changes, or None if there are none.
+        :rtype: MailboxUpdates
+        """
+        if self._sequence is None or self._pending is None:
+            return None
+        added, expunged, flags, (recent,) = self._pending
+        self._pending = _new_pending()
+        sequence = self._sequence
+
+        # each expunged msn is valid once the higher ones are expunged.
+        expunged_msns, vanished = [], []
+        for uid in sorted(expunged, reverse=True):
+            msn = sequence.remove(uid)
+            if msn is not None:
+                expunged_msns.append(msn)
+                vanished.append(uid)
+
+        exists = None
+        for uid in sorted(added):
+            if sequence.add(uid):
+                exists = len(sequence)
+
+        changed = []
+        for uid in sorted(flags):
+            msn = sequence.get_msn(uid)
+            if msn is not None:
+                msg_flags, modseq = flags[uid]
+                changed.append((msn, uid, msg_flags, modseq))
+
+        if not (expunged_msns or exists is not None or changed):
+            return None
+        return MailboxUpdates(
+            expunged_msns, sorted(vanished), exists,
+            recent if exists is not None else None, changed)
+
+    def flush_updates(self):
+        """
+        Get now the changes that the collection gathered for the mailboxes,
+        instead of waiting for them.
+
+        :rtype: Deferred
+        """
+        if self._sequence is None:
+            return defer.succeed(None)
+        return MailboxEvents.for_collection(self.collection).flush()
 
     def getFlags(self):
         """
@@ -210,23 +589,20 @@ class IMAPMailbox(object):
 
     def getUID(self, message_number):
         """
-        Return the UID of a message in the mailbox
-
-        .. note:: this implementation does not make much sense RIGHT NOW,
-        but in the future will be useful to get absolute UIDs from
-        message sequence numbers.
+        Return the UID of a message in the mailbox.
 
+        The sequence numbers are the ones of the messages that the client
+        knows about, so the mailbox has to be selected.
 
-        :param message: the message sequence number.
-        :type message: int
+        :param message_number: the message sequence number.
+        :type message_number: int
 
         :rtype: int
-        :return: the UID of the message.
-
+        :return: the UID of the message, or None if there is no such message.
         """
-        # TODO support relative sequences. The (imap) message should
-        # receive a sequence number attribute: a deferred is not expected
-        return message_number
+        if self._sequence is None:
+            return None
+        return self._sequence.get_uid(message_number)
 
     def getUIDNext(self):
         """
@@ -240,6 +616,15 @@ class IMAPMailbox(object):
         d = self.collection.get_uid_next()
         return d
 
+    def getHighestModSeq(self):
+        """
+        Return the highest modification sequence (rfc 7162) of this mailbox.
+
+        :return: deferred with int
+        :rtype: Deferred
+        """
+        return self.collection.get_highest_modseq()
+
     def getMessageCount(self):
         """
         Returns the total count of messages in this mailbox.
@@ -306,6 +691,8 @@ class IMAPMailbox(object):
             r[self.CMD_UIDVALIDITY] = maybe(self.getUIDValidity)
         if self.CMD_UNSEEN in names:
             r[self.CMD_UNSEEN] = maybe(self.getUnseenCount)
+        if self.CMD_HIGHESTMODSEQ in names:
+            r[self.CMD_HIGHESTMODSEQ] = maybe(self.getHighestModSeq)
 
         def as_a_dict(values):
             return dict(zip(r.keys(), values))
@@ -352,58 +739,12 @@ class IMAPMailbox(object):
         if date is None:
             date = formatdate(time.time())
 
-        d = self.collection.add_msg(message, flags, date=date)
-        d.addCallback(lambda message: message.get_uid())
-        d.addErrback(
-            lambda failure: self.log.failure('Error while adding msg'))
-        return d
-
-    def notify_new(self, *args):
-        """
-        Notify of new messages to all the listeners.
-
-        This will be called indirectly by the underlying collection, that will
-        notify this IMAPMailbox whenever there are changes in the number of
-        messages in the collection, since we have added ourselves to the
-        collection listeners.
-
-        :param args: ignored.
-        """
-
-        def cbNotifyNew(result):
-            exists, recent = result
-            for listener in self.listeners:
-                listener.newMessages(exists, recent)
-
-        d = self._get_notify_count()
-        d.addCallback(cbNotifyNew)
-        d.addCallback(self.collection.cb_signal_unread_to_ui)
-        d.addErrback(lambda failure: self.log.failure('Error while notify'))
+        def ebAdd(failure):
+            self.log.failure('Error while adding msg', failure)
+            return failure
 
-    def _get_notify_count(self):
-        """
-        Get message count and recent count for this mailbox.
-
-        :return: a deferred that will fire with a tuple, with number of
-                 messages and number of recent messages.
-        :rtype: Deferred
-        """
-        # XXX this is way too expensive in cases like multiple APPENDS.
-        # We should have a way of keep a cache or do a self-increment for that
-        # kind of calls.
-        d_exists = defer.maybeDeferred(self.getMessageCount)
-        d_recent = defer.maybeDeferred(self.getRecentCount)
-        d_list = [d_exists, d_recent]
-
-        def log_num_msg(result):
-            exists, recent = tuple(result)
-            self.log.debug(
-                'NOTIFY (%r): there are %s messages, %s recent' % (
-                    self.mbox_name, exists, recent))
-            return result
-
-        d = defer.gatherResults(d_list)
-        d.addCallback(log_num_msg)
+        d = self.collection.add_msg(message, flags, date=date)
+        d.addCallbacks(lambda message: message.get_uid(), ebAdd)
         return d
 
     # commands, do not rename methods
@@ -431,93 +772,193 @@ class IMAPMailbox(object):
         d.addCallback(remove_mbox)
         return d
 
-    def expunge(self):
+    def expunge(self, uids=False):
         """
         Remove all messages flagged \\Deleted
+
+        :param uids: if true, return the UIDs of the expunged messages
+                     instead, as the VANISHED responses need (rfc 7162).
+        :type uids: bool
+        :return: a deferred that will fire with the sequence numbers of the
+                 expunged messages, from the highest to the lowest.
+        :rtype: Deferred
         """
         if not self.isWriteable():
             raise imap4.ReadOnlyMailbox
-        return self.collection.delete_all_flagged()
 
-    def _get_message_fun(self, uid):
+        def delete_all_flagged(sequence):
+            d = self.collection.delete_all_flagged()
+            d.addCallback(_forget_expunged, sequence, uids)
+            return d
+
+        d = self._get_sequence()
+        d.addCallback(delete_all_flagged)
+        return d
+
+    def copy_messages(self, messages_asked, uid, target):
         """
-        Return the proper method to get a message for this mailbox, depending
-        on the passed uid flag.
+        Copy several messages of this mailbox to another one, in bulk.
 
-        :param uid: If true, the IDs specified in the query are UIDs;
-                    otherwise they are message sequence IDs.
+        :param messages_asked: IDs of the messages to copy.
+        :type messages_asked: MessageSet
+        :param uid: If true, the IDs are UIDs. They are message sequence IDs
+                    otherwise.
         :type uid: bool
-        :rtype: callable
+        :param target: the mailbox where the messages are copied to.
+        :type target: IMAPMailbox
+        :return: a deferred that will fire with the uids of the copies in
+                 the target mailbox.
+        :rtype: Deferred
         """
-        get_message_fun = [
-            self.collection.get_message_by_sequence_number,
-            self.collection.get_message_by_uid][uid]
-        return get_message_fun
+        def copy_msgs(msg_range):
+            doc_ids = [doc_id for (_, _, doc_id) in msg_range]
+            return target.collection.copy_msgs(
+                doc_ids, target.collection.mbox_uuid)
 
-    def _get_messages_range(self, messages_asked, uid=True):
+        d = self._get_messages_range(messages_asked, uid)
+        d.addCallback(copy_msgs)
+        return d
+
+    def move_messages(self, messages_asked, uid, target, uids=False):
+        """
+        Move several messages of this mailbox to another one (rfc 6851): the
+        messages are copied in bulk, and then expunged from this mailbox.
 
-        def get_range(messages_asked):
-            return self._filter_msg_seq(messages_asked)
+        The arguments are the same than for `copy_messages`.
 
-        d = self._bound_seq(messages_asked, uid)
-        if uid:
-            d.addCallback(get_range)
-        d.addErrback(
-            lambda f: self.log.failure('Error getting msg range'))
+        :param uids: if true, return the UIDs of the expunged messages
+                     instead, as for `expunge`.
+        :type uids: bool
+        :return: a deferred that will fire with the sequence numbers of the
+                 expunged messages, from the highest to the lowest.
+        :rtype: Deferred
+        """
+        if not self.isWriteable():
+            raise imap4.ReadOnlyMailbox
+        # the copies would get the same documents than the messages, that
+        # are then deleted.
+        if target.collection.mbox_uuid == self.collection.mbox_uuid:
+            raise imap4.MailboxException(
+                'Cannot move messages to the same mailbox')
+
+        def move_msgs(msg_range, sequence):
+            doc_ids = [doc_id for (_, _, doc_id) in msg_range]
+            d = target.collection.copy_msgs(
+                doc_ids, target.collection.mbox_uuid)
+            d.addCallback(lambda _: self.collection.delete_msgs(doc_ids))
+            d.addCallback(_forget_expunged, sequence, uids)
+            return d
+
+        def get_doc_ids(sequence):
+            d = self._get_messages_range(messages_asked, uid, sequence)
+            d.addCallback(move_msgs, sequence)
+            return d
+
+        d = self._get_sequence()
+        d.addCallback(get_doc_ids)
         return d
 
-    def _bound_seq(self, messages_asked, uid):
+    def get_modseqs(self, messages_asked, uid, changedsince=None):
         """
-        Put an upper bound to a messages sequence if this is open.
+        Get the modification sequences (rfc 7162) of the messages in a
+        sequence set.
 
         :param messages_asked: IDs of the messages.
         :type messages_asked: MessageSet
-        :return: a Deferred that will fire with a MessageSet
+        :param uid: If true, the IDs are UIDs. They are message sequence IDs
+                    otherwise.
+        :type uid: bool
+        :param changedsince: optional, only get the messages that changed
+                             after this modseq. They are looked up in the
+                             modseq index, without going through the whole
+                             set.
+        :type changedsince: int
+        :return: a deferred that will fire with a list of (msn, uid, modseq)
+                 tuples, sorted.
+        :rtype: Deferred
         """
+        def get_modseqs(sequence):
+            ranges = sequence.get_ranges(messages_asked, uid)
+            if changedsince is None:
+                d = self.collection.get_modseqs(sequence.get_uid_set(ranges))
+            else:
+                d = self.collection.get_modseqs(changedsince=changedsince)
+            d.addCallback(add_msns, sequence, ranges)
+            return d
 
-        def set_last_uid(last_uid):
-            messages_asked.last = last_uid
-            return messages_asked
+        def add_msns(rows, sequence, ranges):
+            modseqs = []
+            for u, modseq in rows:
+                msn = sequence.get_msn(u)
+                if msn is not None and _in_ranges(msn, ranges):
+                    modseqs.append((msn, u, modseq))
+            return modseqs
 
-        def set_last_seq(all_uid):
-            messages_asked.last = len(all_uid)
-            return messages_asked
+        d = self._get_sequence()
+        d.addCallback(get_modseqs)
+        return d
 
-        if not messages_asked.last:
-            try:
-                iter(messages_asked)
-            except TypeError:
-                # looks like we cannot iterate
-                if uid:
-                    d = self.collection.get_last_uid()
-                    d.addCallback(set_last_uid)
-                else:
-                    d = self.collection.all_uid_iter()
-                    d.addCallback(set_last_seq)
-                return d
-        return defer.succeed(messages_asked)
+    def get_expunged(self, changedsince, messages_asked=None):
+        """
+        Get the UIDs of the messages that were expunged from this mailbox
+        after a given modification sequence, for the VANISHED responses
+        (rfc 7162).
 
-    def _filter_msg_seq(self, messages_asked):
+        :param changedsince: the modseq.
+        :type changedsince: int
+        :param messages_asked: optional, the UIDs to look for.
+        :type messages_asked: MessageSet
+        :return: a deferred that will fire with the sorted list of UIDs.
+        :rtype: Deferred
         """
-        Filter a message sequence returning only the ones that do exist in the
-        collection.
+        return self.collection.get_expunged(changedsince, messages_asked)
+
+    def _get_messages_range(self, messages_asked, uid, sequence=None):
+        """
+        Get the identifiers for the messages in a sequence set, of UIDs or of
+        message sequence numbers.
+
+        The set is resolved against the messages that the client knows
+        about, and their mdoc_ids are retrieved with bounded queries to the
+        UID table, that return only the messages that still exist.
 
         :param messages_asked: IDs of the messages.
         :type messages_asked: MessageSet
-        :rtype: set
+        :param uid: If true, the IDs are UIDs. They are message sequence IDs
+                    otherwise.
+        :type uid: bool
+        :param sequence: the messages that the client knows about, retrieved
+                         if not passed (see `_get_sequence`).
+        :type sequence: MessageSequence
+        :return: a Deferred that will fire with a sorted list of (msn, uid,
+                 mdoc_id) tuples.
+        :rtype: Deferred
         """
-        # TODO we could pass the asked sequence to the indexer
-        # all_uid_iter, and bound the sql query instead.
-        def filter_by_asked(all_msg_uid):
-            set_asked = set(messages_asked)
-            set_exist = set(all_msg_uid)
-            return set_asked.intersection(set_exist)
+        def get_doc_ids(sequence):
+            ranges = sequence.get_ranges(messages_asked, uid)
+            d = self.collection.get_doc_ids_from_uids(
+                sequence.get_uid_set(ranges))
+            d.addCallback(add_msns, sequence)
+            return d
 
-        d = self.collection.all_uid_iter()
-        d.addCallback(filter_by_asked)
+        def add_msns(pairs, sequence):
+            msg_range = []
+            for u, doc_id in pairs:
+                msn = sequence.get_msn(u)
+                if msn is not None:
+                    msg_range.append((msn, u, doc_id))
+            return msg_range
+
+        if sequence is not None:
+            d = get_doc_ids(sequence)
+        else:
+            d = self._get_sequence()
+            d.addCallback(get_doc_ids)
+        d.addErrback(
+            lambda f: self.log.failure('Error getting msg range'))
         return d
 
-    def fetch(self, messages_asked, uid):
+    def fetch(self, messages_asked, uid, get_hdoc=True, get_cdocs=True):
         """
         Retrieve one or more messages in this mailbox.
 
@@ -532,52 +973,99 @@ class IMAPMailbox(object):
                     otherwise.
         :type uid: bool
 
+        :param get_hdoc: whether the fetched items need the header documents.
+        :type get_hdoc: bool
+
+        :param get_cdocs: whether the fetched items need the content
+                          documents (ie, the body of the messages).
+        :type get_cdocs: bool
+
         :rtype: deferred with a generator that yields...
         """
-        get_msg_fun = self._get_message_fun(uid)
-        getimapmsg = self.get_imap_message
-
-        def get_imap_messages_for_range(msg_range):
-
-            def _get_imap_msg(messages):
-                d_imapmsg = []
-                # just in case we got bad data in here
-                for msg in filter(None, messages):
-                    d_imapmsg.append(getimapmsg(msg))
-                return defer.gatherResults(d_imapmsg, consumeErrors=True)
-
-            def _zip_msgid(imap_messages):
-                zipped = zip(
-                    list(msg_range), imap_messages)
-                return (item for item in zipped)
-
-            # XXX not called??
-            def _unset_recent(sequence):
-                reactor.callLater(0, self.unset_recent_flags, sequence)
-                return sequence
-
-            d_msg = []
-            for msgid in msg_range:
-                # XXX We want cdocs because we "probably" are asked for the
-                # body. We should be smarter at do_FETCH and pass a parameter
-                # to this method in order not to prefetch cdocs if they're not
-                # going to be used.
-                d_msg.append(get_msg_fun(msgid, get_cdocs=True))
-
-            d = defer.gatherResults(d_msg, consumeErrors=True)
-            d.addCallback(_get_imap_msg)
-            d.addCallback(_zip_msgid)
-            d.addErrback(
-                lambda failure: self.log.error(
-                    'Error getting msg for range'))
-            return d
+        def zip_msgid(result):
+            return (item for item in result)
 
         d = self._get_messages_range(messages_asked, uid)
-        d.addCallback(get_imap_messages_for_range)
+        d.addCallback(
+            self._get_imap_messages_for_range, get_hdoc, get_cdocs)
+        d.addCallback(zip_msgid)
         d.addErrback(
             lambda failure: self.log.failure('Error on fetch'))
         return d
 
+    def fetch_windows(self, messages_asked, uid, get_hdoc=True,
+                      get_cdocs=True):
+        """
+        Retrieve one or more messages in this mailbox, lazily, in windows of
+        at most `fetch_window_size` messages.
+
+        This is used by the server to stream the answer to big FETCH queries
+        without holding all the messages (and their bodies) in memory at
+        once. The arguments are the same than for `fetch`.
+
+        :return: a deferred that will fire with an iterator of deferreds.
+                 Each one of them will fire with a list of (msgid,
+                 IMAPMessage) tuples for the next window. The documents for
+                 a window are not retrieved until the iterator is advanced.
+        :rtype: Deferred
+        """
+        size = self.fetch_window_size
+
+        def get_windows(msg_range):
+            return (
+                self._get_imap_messages_for_range(
+                    msg_range[i:i + size], get_hdoc, get_cdocs)
+                for i in range(0, len(msg_range), size))
+
+        def log_error(failure):
+            self.log.failure('Error on fetch', failure)
+            return failure
+
+        d = self._get_messages_range(messages_asked, uid)
+        d.addCallback(get_windows)
+        d.addErrback(log_error)
+        return d
+
+    def _get_imap_messages_for_range(self, msg_range, get_hdoc, get_cdocs):
+        """
+        Get the IMAPMessages for a list of (msn, uid, doc_id) tuples.
+
+        All the documents for the range are retrieved in a few batched
+        queries.
+
+        :return: a deferred that will fire with a list of (msn, IMAPMessage)
+                 tuples.
+        :rtype: Deferred
+        """
+        getimapmsg = self.get_imap_message
+        msns = dict((u, msn) for (msn, u, _) in msg_range)
+        msgids = []
+
+        def _get_imap_msg(messages):
+            d_imapmsg = []
+            for u, msg in messages:
+                msgids.append(msns[u])
+                d_imapmsg.append(
+                    getimapmsg(msg, prefetch_body=get_cdocs))
+            return defer.gatherResults(d_imapmsg, consumeErrors=True)
+
+        def _zip_msgid(imap_messages):
+            return zip(msgids, imap_messages)
+
+        def _log_error(failure):
+            # the failure is passed on, so that the FETCH command fails
+            # instead of silently skipping the messages of this range.
+            self.log.failure('Error getting msg for range', failure)
+            return failure
+
+        d = self.collection.get_messages_by_doc_ids(
+            [(u, doc_id) for (_, u, doc_id) in msg_range],
+            get_hdoc=get_hdoc, get_cdocs=get_cdocs)
+        d.addCallback(_get_imap_msg)
+        d.addCallback(_zip_msgid)
+        d.addErrback(_log_error)
+        return d
+
     def fetch_flags(self, messages_asked, uid):
         """
         A fast method to fetch all flags, tricking just the
@@ -602,17 +1090,6 @@ class IMAPMailbox(object):
                 MessagePart.
         :rtype: tuple
         """
-        # is_sequence = True if uid == 0 else False
-        # XXX FIXME -----------------------------------------------------
-        # imap/tests, or muas like mutt, it will choke until we implement
-        # sequence numbers. This is an easy hack meanwhile.
-        is_sequence = False
-        # ---------------------------------------------------------------
-
-        if is_sequence:
-            raise NotImplementedError(
-                "FETCH FLAGS NOT IMPLEMENTED FOR MESSAGE SEQUENCE NUMBERS YET")
-
         d = defer.Deferred()
         reactor.callLater(0, self._do_fetch_flags, messages_asked, uid, d)
         return d
@@ -643,18 +1120,13 @@ class IMAPMailbox(object):
             def getFlags(self):
                 return map(str, self.flags)
 
-        def pack_flags(result):
-            _uid, _flags = result
-            return _uid, flagsPart(_uid, _flags)
-
-        def get_flags_for_seq(sequence):
-            d_all_flags = []
-            for msgid in sequence:
-                # TODO implement sequence numbers here too
-                d_flags_per_uid = self.collection.get_flags_by_uid(msgid)
-                d_flags_per_uid.addCallback(pack_flags)
-                d_all_flags.append(d_flags_per_uid)
-            gotflags = defer.gatherResults(d_all_flags)
+        def get_flags_for_seq(msg_range):
+            msns = dict((_uid, msn) for (msn, _uid, _) in msg_range)
+            gotflags = self.collection.get_flags_by_doc_ids(
+                [(_uid, doc_id) for (_, _uid, doc_id) in msg_range])
+            gotflags.addCallback(lambda result: [
+                (msns[_uid], flagsPart(_uid, _flags))
+                for (_uid, _flags) in result])
             gotflags.addCallback(get_uid_flag_generator)
             return gotflags
 
@@ -691,12 +1163,6 @@ class IMAPMailbox(object):
                 MessagePart.
         :rtype: tuple
         """
-        # TODO implement sequences
-        is_sequence = True if uid == 0 else False
-        if is_sequence:
-            raise NotImplementedError(
-                "FETCH HEADERS NOT IMPLEMENTED FOR SEQUENCE NUMBER YET")
-
         class headersPart(object):
             def __init__(self, uid, headers):
                 self.uid = uid
@@ -711,14 +1177,16 @@ class IMAPMailbox(object):
                     for key, value in
                     self.headers.items())
 
-        messages_asked = yield self._bound_seq(messages_asked, uid)
-        seq_messg = yield self._filter_msg_seq(messages_asked)
+        seq_messg = yield self._get_messages_range(messages_asked, uid)
+        msns = dict((_uid, msn) for (msn, _uid, _) in seq_messg)
+
+        msgs = yield self.collection.get_messages_by_doc_ids(
+            [(_uid, doc_id) for (_, _uid, doc_id) in seq_messg])
 
         result = []
-        for msgid in seq_messg:
-            msg = yield self.collection.get_message_by_uid(msgid)
-            headers = headersPart(msgid, msg.get_headers())
-            result.append((msgid, headers))
+        for _uid, msg in msgs:
+            headers = headersPart(_uid, msg.get_headers())
+            result.append((msns[_uid], headers))
         defer.returnValue(iter(result))
 
     def store(self, messages_asked, flags, mode, uid):
@@ -758,7 +1226,12 @@ class IMAPMailbox(object):
         reactor.callLater(0, self._do_store, messages_asked, flags,
                           mode, uid, d)
 
-        d.addCallback(self.collection.cb_signal_unread_to_ui)
+        def signal_unread(result):
+            # the flags are the result of the store
+            self.collection.cb_signal_unread_to_ui()
+            return result
+
+        d.addCallback(signal_unread)
         d.addErrback(lambda f: self.log.error('Error on store'))
         return d
 
@@ -769,25 +1242,25 @@ class IMAPMailbox(object):
         See the documentation for the `store` method for the parameters.
 
         :param observer: a deferred that will be called with the dictionary
-                         mapping UIDs to flags after the operation has been
-                         done.
+                         mapping message sequence numbers to flags after the
+                         operation has been done.
         :type observer: deferred
         """
         # TODO we should prevent client from setting Recent flag
-        get_msg_fun = self._get_message_fun(uid)
         leap_assert(not isinstance(flags, basestring),
                     "flags cannot be a string")
         flags = tuple(flags)
 
         def set_flags_for_seq(sequence):
             def return_result_dict(list_of_flags):
-                result = dict(zip(list(sequence), list_of_flags))
+                msgids = [msgid for msgid, _, _ in sequence]
+                result = dict(zip(msgids, list_of_flags))
                 observer.callback(result)
                 return result
 
             d_all_set = []
-            for msgid in sequence:
-                d = get_msg_fun(msgid)
+            for _, msg_uid, doc_id in sequence:
+                d = self.collection.get_message_by_doc_id(doc_id, uid=msg_uid)
                 d.addCallback(lambda msg: self.collection.update_flags(
                     msg, flags, mode))
                 d_all_set.append(d)
@@ -805,9 +1278,11 @@ class IMAPMailbox(object):
         """
         Search for messages that meet the given query criteria.
 
-        Warning: this is half-baked, and it might give problems since
-        it offers the SearchableInterface.
-        We'll be implementing it asap.
+        The search is done against the local search index of the messages,
+        so the flags, dates and sizes are matched without loading any
+        document. The text keys (BODY, TEXT, HEADER, FROM...) match the
+        messages that contain the words of the search string, in the same
+        order.
 
         :param query: The search criteria
         :type query: list
@@ -820,30 +1295,83 @@ class IMAPMailbox(object):
                  match the search criteria or a C{Deferred} whose callback
                  will be invoked with such a list.
         :rtype: C{list} or C{Deferred}
+        :raise IllegalQueryError: Raised when query is not valid.
         """
-        # TODO see if we can raise w/o interrupting flow
-        # :raise IllegalQueryError: Raised when query is not valid.
-        # example query:
-        #  ['UNDELETED', 'HEADER', 'Message-ID',
-        # XXX fixme, does not exist
-        #   '52D44F11.9060107@dev.bitmask.net']
+        # the server maps the results with getUID if uid is set, so the
+        # sequence numbers are returned in any case.
+        return self._query_index(
+            lambda sequence: self.collection.search(query, sequence),
+            False, _map_ids)
 
-        # TODO hardcoding for now! -- we'll support generic queries later on
-        # but doing a quickfix for avoiding duplicate saves in the draft
-        # folder.  # See issue #4209
+    def sort(self, criteria, query, uid):
+        """
+        Search for messages that meet the given query criteria, and sort
+        them (rfc 5256).
 
-        if len(query) > 2:
-            if query[1] == 'HEADER' and query[2].lower() == "message-id":
-                msgid = str(query[3]).strip()
-                self.log.debug('Searching for %s' % (msgid,))
+        :param criteria: the sort criteria, like ARRIVAL or SUBJECT, each one
+                         optionally preceded by REVERSE.
+        :type criteria: list
+        :param query: The search criteria
+        :type query: list
+        :param uid: If true, the IDs specified in the query and returned are
+                    UIDs; otherwise they are message sequence IDs.
+        :type uid: bool
+        :return: a deferred that will fire with the sorted list of the ids of
+                 the matching messages.
+        :rtype: Deferred
+        :raise IllegalQueryError: Raised when the criteria or the query are
+                                  not valid.
+        """
+        return self._query_index(
+            lambda sequence: self.collection.sort(criteria, query, sequence),
+            uid, _map_ids)
 
-                d = self.collection.get_uid_from_msgid(str(msgid))
-                d.addCallback(lambda result: [result])
-                return d
+    def thread(self, algorithm, query, uid):
+        """
+        Search for messages that meet the given query criteria, and thread
+        them (rfc 5256).
+
+        :param algorithm: the threading algorithm, ORDEREDSUBJECT or
+                          REFERENCES.
+        :type algorithm: str
+        :param query: The search criteria
+        :type query: list
+        :param uid: If true, the IDs specified in the query and returned are
+                    UIDs; otherwise they are message sequence IDs.
+        :type uid: bool
+        :return: a deferred that will fire with the threads, as lists of
+                 (id, children) nodes, the id being None for the messages
+                 that are not in the mailbox.
+        :rtype: Deferred
+        :raise IllegalQueryError: Raised when the algorithm or the query are
+                                  not valid.
+        """
+        return self._query_index(
+            lambda sequence: self.collection.thread(
+                algorithm, query, sequence),
+            uid, _map_threads)
+
+    def _query_index(self, query_index, uid, map_ids):
+        # the sequence resolves the sets in the query, and the messages that
+        # the client does not know about yet are left out of the results.
+        def run_query(sequence):
+            def get_id(u):
+                if uid:
+                    return u if u in sequence else None
+                return sequence.get_msn(u)
+
+            d = defer.maybeDeferred(query_index, sequence)
+            d.addCallback(map_ids, get_id)
+            return d
 
-        # nothing implemented for any other query
-        self.log.warn('Cannot process query: %s' % (query,))
-        return []
+        def illegal_query(failure):
+            failure.trap(SearchQueryError)
+            raise imap4.IllegalQueryError(str(failure.value))
+
+        d = self._get_sequence()
+        d.addCallback(run_query)
+        d.addErrback(illegal_query)
+        return d
 
     # IMessageCopier
 
@@ -885,6 +1413,52 @@ class IMAPMailbox(object):
             self.mbox_name, self.collection.count())
 
 
+def _map_ids(ids, get_id):
+    ids = [get_id(i) for i in ids]
+    return [i for i in ids if i is not None]
+
+
+def _map_threads(threads, get_id):
+    return [(get_id(i) if i is not None else None,
+             _map_threads(children, get_id))
+            for (i, children) in threads]
+
+
+def _new_pending():
+    # the uids of the new and the expunged messages, the (flags, modseq) of
+    # the flagged ones, and the last count of recent messages.
+    return (set(), set(), {}, [None])
+
+
+def _forget_expunged(expunged, sequence, uids=False):
+    """
+    Remove the messages expunged by a command of the client from the ones
+    that it knows about, since it is told about them in the response.
+
+    :param expunged: the uids of the expunged messages.
+    :param sequence: the messages that the client knows about.
+    :type sequence: MessageSequence
+    :param uids: if true, return the uids, for the VANISHED responses.
+    :return: the sequence numbers of the messages, from the highest one, so
+             that each of them is still valid once the previous ones have
+             been expunged.
+    :rtype: list
+    """
+    msns = []
+    for uid in sorted(expunged, reverse=True):
+        msn = sequence.remove(uid)
+        if msn is not None:
+            msns.append(msn)
+    if uids:
+        return expunged
+    return msns
+
+
+def _in_ranges(msn, ranges):
+    i = bisect_right(ranges, (msn, sys.maxint))
+    return i > 0 and ranges[i - 1][1] >= msn
+
+
 _INBOX_RE = re.compile(INBOX_NAME, re.IGNORECASE)
 
 
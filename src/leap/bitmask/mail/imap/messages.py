@@ -17,6 +17,7 @@
 """
 IMAPMessage implementation.
 """
+
 from twisted.mail import imap4
 from twisted.internet import defer
 from twisted.logger import Logger
@@ -92,6 +93,25 @@ class IMAPMessage(object):
         """
         return self.message.get_flags()
 
+    def getEnvelope(self):
+        """
+        Retrieve the ENVELOPE that was computed when the message was stored.
+
+        :return: the envelope structure, or None if it was not computed.
+        :rtype: list or None
+        """
+        return _encode_structure(self.message.get_envelope())
+
+    def getBodyStructure(self):
+        """
+        Retrieve the extended BODYSTRUCTURE that was computed when the
+        message was stored.
+
+        :return: the body structure, or None if it was not computed.
+        :rtype: list or None
+        """
+        return _encode_structure(self.message.get_body_structure())
+
     def getInternalDate(self):
         """
         Retrieve the date internally associated with this message
@@ -208,6 +228,18 @@ class IMAPMessagePart(object):
         return IMAPMessagePart(subpart)
 
 
+def _encode_structure(structure):
+    # the stored structures come back from the store with unicode strings
+    if not structure:
+        return None
+    if isinstance(structure, list):
+        return [_encode_structure(item) if item else item
+                for item in structure]
+    if isinstance(structure, unicode):
+        return structure.encode('utf-8')
+    return structure
+
+
 def _format_headers(headers, negate, *names):
     # current server impl. expects content-type to be present, so if for
     # some reason we do not have headers, we have to return at least that
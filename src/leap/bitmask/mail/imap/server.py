@@ -17,12 +17,15 @@
 """
 LEAP IMAP4 Server Implementation.
 """
-import StringIO
+import zlib
+
 from copy import copy
 
+from twisted.internet import reactor, task
 from twisted.internet.defer import maybeDeferred
 from twisted.mail import imap4
 from twisted.logger import Logger
+from zope.interface import implements, directlyProvides, providedBy
 
 # imports for LITERAL+ patch
 from twisted.internet import defer, interfaces
@@ -32,34 +35,7 @@ from twisted.mail.imap4 import LiteralString, LiteralFile
 
 from leap.common.events import emit_async, catalog
 
-
-def _getContentType(msg):
-
-    """
-    Return a two-tuple of the main and subtype of the given message.
-    """
-    attrs = None
-    mm = msg.getHeaders(False, 'content-type').get('content-type', None)
-    if mm:
-        mm = ''.join(mm.splitlines())
-        mimetype = mm.split(';')
-        if mimetype:
-            type = mimetype[0].split('/', 1)
-            if len(type) == 1:
-                major = type[0]
-                minor = None
-            elif len(type) == 2:
-                major, minor = type
-            else:
-                major = minor = None
-            # XXX patched ---------------------------------------------
-            attrs = dict(x.strip().split('=', 1) for x in mimetype[1:])
-            # XXX patched ---------------------------------------------
-        else:
-            major = minor = None
-    else:
-        major = minor = None
-    return major, minor, attrs
+from leap.bitmask.mail.imap.structure import _getContentType
 
 
 def _parseMbox(name):
@@ -78,6 +54,327 @@ def _parseMbox(name):
 imap4._getContentType = _getContentType
 
 
+# Fetch attributes that can be answered with the flags document alone (the
+# modseq is kept in the local index).
+_FDOC_FETCH_ATTRS = ('flags', 'uid', 'rfc822size', 'modseq')
+
+# Fetch attributes that need the headers document too (the internal date, the
+# envelope and the body structure are kept in the headers document).
+_HDOC_FETCH_ATTRS = (
+    'internaldate', 'envelope', 'bodystructure', 'rfc822header')
+
+
+def _get_fetch_plan(query):
+    """
+    Inspect the parsed fetch attributes and decide which documents need to be
+    retrieved to answer them.
+
+    Anything that is not known to be answerable from the flags or headers
+    documents (BODY[], BODY[TEXT], RFC822...) needs the content documents.
+
+    :param query: the list of fetch attributes, as parsed by imap4.
+    :type query: list
+    :return: a tuple of booleans, (get_hdoc, get_cdocs)
+    :rtype: tuple
+    """
+    get_hdoc = get_cdocs = False
+    for item in query:
+        type_ = getattr(item, 'type', None)
+        if type_ in _FDOC_FETCH_ATTRS:
+            continue
+        elif type_ in _HDOC_FETCH_ATTRS:
+            get_hdoc = True
+        elif type_ == 'body' and (item.header or item.mime):
+            get_hdoc = True
+        else:
+            get_hdoc = get_cdocs = True
+    return get_hdoc, get_cdocs
+
+
+def _formatSection(part):
+    """
+    Format a BODY fetch attribute without its partial range, as in
+    BODY[1.TEXT].
+    """
+    section = str(part)
+    if part.partialBegin is not None:
+        section = section[:section.rindex('<')]
+    return section
+
+
+def _formatBodyItem(part):
+    """
+    Format a BODY fetch attribute for the FETCH response.
+
+    For partial fetches only the origin octet is sent back (RFC 3501, 7.4.2),
+    as in BODY[]<1024>.
+    """
+    if part.partialBegin is None:
+        return str(part)
+    return '%s<%d>' % (_formatSection(part), part.partialBegin)
+
+
+def _partialString(part, data):
+    """
+    Return the range of data requested by a partial fetch.
+    """
+    if part.partialBegin is None:
+        return data
+    begin = part.partialBegin
+    return data[begin:begin + part.partialLength]
+
+
+class _FetchModSeq(object):
+    """
+    The MODSEQ fetch attribute (rfc 7162), that the twisted fetch parser does
+    not know about.
+    """
+    type = 'modseq'
+
+    def __str__(self):
+        return 'modseq'
+
+
+def _splitFetchAtts(line):
+    """
+    Split the fetch attributes of a FETCH command from the fetch modifiers
+    that can follow them (rfc 4466), and take the MODSEQ attribute out of
+    them.
+
+    :param line: the rest of the FETCH command, after the sequence set.
+    :type line: str
+    :return: a tuple with the attributes for the twisted fetch parser, a
+             boolean telling if MODSEQ was among them, and the rest of the
+             line.
+    :rtype: tuple
+    """
+    line = line.strip()
+    parens = line.startswith('(')
+    if parens:
+        line = line[1:]
+    tokens, depth, start = [], 0, 0
+    for i, c in enumerate(line):
+        if c in '([':
+            depth += 1
+        elif c in ')]' and depth:
+            depth -= 1
+        elif c == ')' and parens:
+            tokens.append(line[start:i])
+            rest = line[i + 1:]
+            break
+        elif c == ' ' and not depth:
+            tokens.append(line[start:i])
+            start = i + 1
+            if not parens:
+                rest = line[start:]
+                break
+    else:
+        if parens:
+            raise IllegalClientResponse("Mismatched parenthesis")
+        tokens.append(line[start:])
+        rest = ''
+
+    tokens = [token for token in tokens if token]
+    modseq = 'MODSEQ' in [token.upper() for token in tokens]
+    tokens = [token for token in tokens if token.upper() != 'MODSEQ']
+    if not tokens:
+        atts = ''
+    elif parens:
+        atts = '(%s)' % ' '.join(tokens)
+    else:
+        atts = tokens[0]
+    return atts, modseq, rest.strip()
+
+
+def _formatSequenceSet(ids):
+    """
+    Format a list of message identifiers as a compact sequence set, as in
+    1:3,7.
+    """
+    ranges = []
+    for msgid in sorted(ids):
+        if ranges and ranges[-1][1] == msgid - 1:
+            ranges[-1][1] = msgid
+        else:
+            ranges.append([msgid, msgid])
+    return ','.join(
+        str(lo) if lo == hi else '%d:%d' % (lo, hi) for lo, hi in ranges)
+
+
+def _formatThread(thread):
+    """
+    Format a thread for the THREAD response (rfc 5256): the chains of
+    single children go in a row, the siblings go each in its own
+    parenthesis.
+
+    :param thread: the (id, children) node at the root of the thread.
+    :type thread: tuple
+    :rtype: str
+    """
+    ids = []
+    msgid, children = thread
+    while True:
+        if msgid is not None:
+            ids.append(str(msgid))
+        if len(children) != 1:
+            break
+        msgid, children = children[0]
+    formatted = ' '.join(ids)
+    if children:
+        nested = ''.join('(%s)' % _formatThread(child) for child in children)
+        formatted = (formatted + ' ' + nested) if formatted else nested
+    return formatted
+
+
+def _makeMessageSet(ids):
+    return imap4.MessageSet([(msgid, msgid) for msgid in ids])
+
+
+class _FetchThrottle(object):
+    """
+    A streaming producer that is registered with the transport while a FETCH
+    response is being written.
+
+    The transport pauses it when its write buffer is full, and the server
+    waits for it to be resumed before writing the next message, or the next
+    chunk of a message body.
+    """
+    implements(interfaces.IPushProducer)
+
+    def __init__(self):
+        self.paused = False
+        self.stopped = False
+        self._waiting = []
+
+    def wait(self):
+        """
+        :return: a deferred that will fire as soon as the transport is ready
+                 to accept more data.
+        :rtype: Deferred
+        """
+        if not self.paused:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
+
+
+class _FileWindow(object):
+    """
+    A read-only view over a range of bytes of a seekable file.
+
+    It is used to serve partial fetches (BODY[]<start.len>) by reading only
+    the requested range from the original file, instead of copying it into a
+    new buffer.
+    """
+
+    def __init__(self, fd, begin, length):
+        """
+        :param fd: the file to read from.
+        :type fd: file-like object
+        :param begin: the offset of the first byte of the window.
+        :type begin: int
+        :param length: the maximum number of bytes in the window.
+        :type length: int
+        """
+        fd.seek(0, 2)
+        end = fd.tell()
+        self._fd = fd
+        self._begin = min(begin, end)
+        self._end = min(begin + length, end)
+        self._pos = self._begin
+
+    def tell(self):
+        return self._pos - self._begin
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence == 2:
+            offset += self._end - self._begin
+        self._pos = max(self._begin, min(self._begin + offset, self._end))
+
+    def read(self, size=-1):
+        left = self._end - self._pos
+        if size < 0 or size > left:
+            size = left
+        self._fd.seek(self._pos)
+        data = self._fd.read(size)
+        self._pos += len(data)
+        return data
+
+
+class _DeflateTransport(object):
+    """
+    A transport wrapper that compresses everything written to it into a raw
+    DEFLATE stream, as the COMPRESS extension (rfc 4978) requires.
+
+    The data written in the same reactor iteration is flushed at once, so the
+    many short lines of a response share a single sync flush.
+    """
+
+    clock = reactor
+
+    def __init__(self, transport, level=zlib.Z_DEFAULT_COMPRESSION):
+        """
+        :param transport: the transport to write the compressed data to.
+        :type transport: ITransport
+        :param level: the zlib compression level.
+        :type level: int
+        """
+        directlyProvides(self, providedBy(transport))
+        self.transport = transport
+        self._compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._flushCall = None
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def write(self, data):
+        data = self._compressor.compress(data)
+        if data:
+            self.transport.write(data)
+        if self._flushCall is None:
+            self._flushCall = self.clock.callLater(0, self.flush)
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def flush(self):
+        """
+        Write all the data compressed so far to the transport.
+        """
+        self.cancel()
+        self.transport.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def cancel(self):
+        """
+        Cancel the pending flush.
+        """
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+
+    def loseConnection(self):
+        if self._flushCall is not None:
+            self.flush()
+        self.transport.loseConnection()
+
+
 class LEAPIMAPServer(imap4.IMAP4Server):
 
     """
@@ -86,6 +383,25 @@ class LEAPIMAPServer(imap4.IMAP4Server):
 
     log = Logger()
 
+    # registered with the transport while writing a FETCH response
+    _fetchThrottle = None
+
+    # (key, file) for the last body section that was partially fetched
+    _partialCache = None
+
+    # CONDSTORE (rfc 7162) is enabled by the first command that uses it, and
+    # QRESYNC with the ENABLE command.
+    _condstore = False
+    _qresync = False
+
+    # uid -> modseq, for the messages of the FETCH response being written
+    _fetchModSeqs = None
+
+    # the compressed transport and the decompressor of the incoming data,
+    # once the COMPRESS command (rfc 4978) succeeded
+    _deflater = None
+    _inflater = None
+
     #############################################################
     #
     # Twisted imap4 patch to workaround bad mime rendering  in TB.
@@ -99,6 +415,9 @@ class LEAPIMAPServer(imap4.IMAP4Server):
     def spew_body(self, part, id, msg, _w=None, _f=None):
         if _w is None:
             _w = self.transport.write
+        # PATCHED ##########################################
+        uid = msg.getUID()
+        # END PATCHED ######################################
         for p in part.part:
             if msg.isMultipart():
                 msg = msg.getSubPart(p)
@@ -111,51 +430,32 @@ class LEAPIMAPServer(imap4.IMAP4Server):
             hdrs = msg.getHeaders(part.header.negate, *part.header.fields)
             hdrs = imap4._formatHeaders(hdrs)
             # PATCHED ##########################################
-            _w(str(part) + ' ' + imap4._literal(hdrs + "\r\n"))
+            _w(_formatBodyItem(part) + ' ' +
+               imap4._literal(_partialString(part, hdrs + "\r\n")))
             # PATCHED ##########################################
         elif part.text:
-            _w(str(part) + ' ')
+            _w(_formatBodyItem(part) + ' ')
             _f()
-            return imap4.FileProducer(
-                msg.getBodyFile()
-            ).beginProducing(self.transport)
+            return self._producePart(part, uid, msg.getBodyFile)
         elif part.mime:
             hdrs = imap4._formatHeaders(msg.getHeaders(True))
 
             # PATCHED ##########################################
-            _w(str(part) + ' ' + imap4._literal(hdrs + "\r\n"))
+            _w(_formatBodyItem(part) + ' ' +
+               imap4._literal(_partialString(part, hdrs + "\r\n")))
             # END PATCHED ######################################
 
         elif part.empty:
-            _w(str(part) + ' ')
+            _w(_formatBodyItem(part) + ' ')
             _f()
+            # PATCHED #############################################
+            # implement partial FETCH
             if part.part:
-                # PATCHED #############################################
-                # implement partial FETCH
-                # TODO implement boundary checks
-                # TODO see if there's a more efficient way, without
-                # copying the original content into a new buffer.
-                fd = msg.getBodyFile()
-                begin = getattr(part, "partialBegin", None)
-                _len = getattr(part, "partialLength", None)
-                if begin is not None and _len is not None:
-                    _fd = StringIO.StringIO()
-                    fd.seek(part.partialBegin)
-                    _fd.write(fd.read(part.partialLength))
-                    _fd.seek(0)
-                else:
-                    _fd = fd
-                return imap4.FileProducer(
-                    _fd
-                    # END PATCHED #########################3
-                ).beginProducing(self.transport)
+                return self._producePart(part, uid, msg.getBodyFile)
             else:
-                mf = imap4.IMessageFile(msg, None)
-                if mf is not None:
-                    return imap4.FileProducer(
-                        mf.open()).beginProducing(self.transport)
-                return imap4.MessageProducer(
-                    msg, None, self._scheduler).beginProducing(self.transport)
+                return self._producePart(
+                    part, uid, lambda: self._renderMessage(msg))
+            # END PATCHED #########################3
 
         else:
             _w('BODY ' +
@@ -168,6 +468,160 @@ class LEAPIMAPServer(imap4.IMAP4Server):
     #
     ##################################################################
 
+    def spew_rfc822text(self, id, msg, _w=None, _f=None):
+        if _w is None:
+            _w = self.transport.write
+        _w('RFC822.TEXT ')
+        _f()
+        return self._produceFile(msg.getBodyFile())
+
+    def spew_rfc822(self, id, msg, _w=None, _f=None):
+        if _w is None:
+            _w = self.transport.write
+        _w('RFC822 ')
+        _f()
+        return self._produceMessage(msg)
+
+    def spew_envelope(self, id, msg, _w=None, _f=None):
+        if _w is None:
+            _w = self.transport.write
+        envelope = msg.getEnvelope()
+        if envelope is None:
+            envelope = imap4.getEnvelope(msg)
+        _w('ENVELOPE ' + imap4.collapseNestedLists([envelope]))
+
+    def spew_bodystructure(self, id, msg, _w=None, _f=None):
+        if _w is None:
+            _w = self.transport.write
+
+        def write_structure(structure):
+            _w('BODYSTRUCTURE ' + imap4.collapseNestedLists([structure]))
+
+        structure = msg.getBodyStructure()
+        if structure is not None:
+            return write_structure(structure)
+
+        # the headers document of messages stored before the body structure
+        # was precomputed does not have it, and computing it needs the
+        # content documents.
+        d = self.mbox.collection.get_message_by_uid(
+            msg.getUID(), get_cdocs=True)
+        d.addCallback(self.mbox.get_imap_message)
+        d.addCallback(lambda msg: imap4.getBodyStructure(msg, True))
+        d.addCallback(write_structure)
+        return d
+
+    def spew_modseq(self, id, msg, _w=None, _f=None):
+        if _w is None:
+            _w = self.transport.write
+        modseq = self._fetchModSeqs.get(msg.getUID(), 0)
+        _w('MODSEQ (%d)' % modseq)
+
+    def _produceMessage(self, msg):
+        """
+        Write a whole message as an IMAP literal.
+        """
+        d = self._renderMessage(msg)
+        d.addCallback(self._produceFile)
+        return d
+
+    def _renderMessage(self, msg):
+        """
+        Get a file with the whole message, headers included.
+
+        :return: a deferred that will fire with a file-like object.
+        :rtype: Deferred
+        """
+        mf = imap4.IMessageFile(msg, None)
+        if mf is not None:
+            return defer.succeed(mf.open())
+        # with no consumer, MessageProducer only renders the message into
+        # its buffer.
+        producer = imap4.MessageProducer(msg, None, self._scheduler)
+        d = producer.beginProducing(None)
+
+        def rewind_buffer(_):
+            producer.buffer.seek(0, 0)
+            return producer.buffer
+
+        d.addCallback(rewind_buffer)
+        return d
+
+    def _producePart(self, part, uid, get_file):
+        """
+        Write the contents of a body section as an IMAP literal, or just the
+        requested range of it for a partial fetch.
+
+        Clients fetch big attachments with successive partial fetches, so the
+        file for the last section that was partially fetched is kept, and
+        reused if the next partial fetch asks for the same section.
+
+        :param part: the parsed body section.
+        :type part: imap4._FetchParser.Body
+        :param uid: the uid of the message the section belongs to.
+        :type uid: int
+        :param get_file: a callable that returns the file for the section,
+                         or a deferred that will fire with it.
+        :type get_file: callable
+        :return: a deferred that will fire when all the data has been
+                 written.
+        :rtype: Deferred
+        """
+        begin = part.partialBegin
+        if begin is None:
+            d = maybeDeferred(get_file)
+            d.addCallback(self._produceFile)
+            return d
+
+        key = (self.mbox.collection.mbox_uuid, uid, _formatSection(part))
+        if self._partialCache is not None and self._partialCache[0] == key:
+            d = defer.succeed(self._partialCache[1])
+        else:
+            d = maybeDeferred(get_file)
+
+            def cache_file(fd):
+                self._partialCache = (key, fd)
+                return fd
+            d.addCallback(cache_file)
+
+        d.addCallback(lambda fd: self._produceFile(
+            _FileWindow(fd, begin, part.partialLength)))
+        return d
+
+    def _produceFile(self, fd):
+        """
+        Write the contents of a file as an IMAP literal.
+
+        While a FETCH response is being written, the data is written in
+        chunks, waiting for the fetch throttle between them. Otherwise, a
+        regular imap4.FileProducer is used.
+
+        :return: a deferred that will fire when all the data has been
+                 written.
+        :rtype: Deferred
+        """
+        throttle = self._fetchThrottle
+        if throttle is None:
+            return imap4.FileProducer(fd).beginProducing(self.transport)
+
+        write = self.transport.write
+        chunk_size = imap4.FileProducer.CHUNK_SIZE
+
+        def produce():
+            begin = fd.tell()
+            fd.seek(0, 2)
+            size = fd.tell() - begin
+            fd.seek(begin, 0)
+            write('{%d}\r\n' % size)
+            while not throttle.stopped:
+                data = fd.read(chunk_size)
+                if not data:
+                    break
+                write(data)
+                yield throttle.wait()
+
+        return task.cooperate(produce()).whenDone()
+
     def lineReceived(self, line):
         """
         Attempt to parse a single line from the server.
@@ -198,55 +652,284 @@ class LEAPIMAPServer(imap4.IMAP4Server):
             self.mbox = None
         self.state = 'unauth'
 
-    def do_FETCH(self, tag, messages, query, uid=0):
+    def do_FETCH(self, tag, messages, query, modifiers=None, uid=0):
         """
         Overwritten fetch dispatcher to use the fast fetch_flags
-        method
+        method, and to retrieve only the documents that the requested
+        attributes need.
+
+        The messages are streamed to the client in windows, see
+        `_cbFetchWindows`.
+
+        Once CONDSTORE is enabled, the modseqs of the messages are sent too,
+        and the CHANGEDSINCE modifier restricts the messages to the ones
+        that changed after a given modseq. With QRESYNC, the VANISHED
+        modifier sends first the UIDs of the messages expunged after it
+        (rfc 7162).
         """
         if not query:
             self.sendPositiveResponse(tag, 'FETCH complete')
             return
 
-        cbFetch = self._IMAP4Server__cbFetch
+        modifiers = modifiers or {}
+        changedsince = modifiers.get('CHANGEDSINCE')
+        vanished = modifiers.get('VANISHED', False)
+        if vanished and not (uid and self._qresync and changedsince):
+            self.sendBadResponse(
+                tag, 'VANISHED needs UID FETCH with CHANGEDSINCE, '
+                'and QRESYNC enabled')
+            return
+
+        modseq = any(isinstance(item, _FetchModSeq) for item in query)
+        if modseq or changedsince is not None:
+            self._condstore = True
+        if self._condstore and not modseq:
+            query = query + [_FetchModSeq()]
+
         ebFetch = self._IMAP4Server__ebFetch
 
-        if len(query) == 1 and str(query[0]) == "flags":
-            self._oldTimeout = self.setTimeout(None)
-            # no need to call iter, we get a generator
-            maybeDeferred(
-                self.mbox.fetch_flags, messages, uid=uid
-            ).addCallback(
-                cbFetch, tag, query, uid
-            ).addErrback(ebFetch, tag)
-
-        elif len(query) == 1 and str(query[0]) == "rfc822.header":
-            self._oldTimeout = self.setTimeout(None)
-            # no need to call iter, we get a generator
-            maybeDeferred(
-                self.mbox.fetch_headers, messages, uid=uid
-            ).addCallback(
-                cbFetch, tag, query, uid
-            ).addErrback(ebFetch, tag)
+        self._oldTimeout = self.setTimeout(None)
+
+        if self._condstore:
+            d = defer.succeed(None)
+            if vanished:
+                # before the set gets bounded to the UIDs still in use
+                d.addCallback(
+                    lambda _: self.mbox.get_expunged(changedsince, messages))
+                d.addCallback(self._sendVanished, earlier=True)
+            d.addCallback(
+                lambda _: self.mbox.get_modseqs(messages, uid, changedsince))
+            d.addCallback(
+                self._cbFetchModSeqs, messages, query, uid, changedsince)
         else:
-            self._oldTimeout = self.setTimeout(None)
-            # no need to call iter, we get a generator
-            maybeDeferred(
-                self.mbox.fetch, messages, uid=uid
-            ).addCallback(
-                cbFetch, tag, query, uid
-            ).addErrback(
-                ebFetch, tag)
+            d = self._fetchWindows(messages, query, uid)
+
+        d.addCallback(self._cbFetchWindows, tag, query, uid)
+        d.addErrback(ebFetch, tag)
+
+    def _fetchWindows(self, messages, query, uid):
+        atts = [str(item) for item in query
+                if not isinstance(item, _FetchModSeq)]
+
+        if atts == ["flags"]:
+            d = maybeDeferred(self.mbox.fetch_flags, messages, uid=uid)
+            # a single window with all the results
+            d.addCallback(lambda results: iter([results]))
+
+        elif atts == ["rfc822.header"]:
+            d = maybeDeferred(self.mbox.fetch_headers, messages, uid=uid)
+            d.addCallback(lambda results: iter([results]))
+
+        else:
+            get_hdoc, get_cdocs = _get_fetch_plan(query)
+            d = maybeDeferred(
+                self.mbox.fetch_windows, messages, uid=uid,
+                get_hdoc=get_hdoc, get_cdocs=get_cdocs)
+        return d
+
+    def _cbFetchModSeqs(self, modseqs, messages, query, uid, changedsince):
+        """
+        Remember the modseqs of the messages to fetch, and leave out the
+        ones that did not change if CHANGEDSINCE was given.
+        """
+        self._fetchModSeqs = dict(
+            (msg_uid, modseq) for (_, msg_uid, modseq) in modseqs)
+        if changedsince is None:
+            return self._fetchWindows(messages, query, uid)
+        elif modseqs:
+            changed = _makeMessageSet(
+                msg_uid if uid else msn for (msn, msg_uid, _) in modseqs)
+            return self._fetchWindows(changed, query, uid)
+        return iter([])
+
+    def _cbFetchWindows(self, windows, tag, query, uid):
+        """
+        Write the FETCH responses for the messages in each window.
+
+        A window is either a list of (msgid, IMessage) tuples, or a deferred
+        that will fire with one. The next window is requested while the
+        current one is being written, so that at most two windows are kept
+        in memory.
+
+        While the messages are written, a _FetchThrottle is registered as a
+        producer with the transport, so that we stop writing whenever the
+        client is not consuming fast enough.
+        """
+        if self.blocked is None:
+            self.blocked = []
+
+        throttle = self._fetchThrottle = _FetchThrottle()
+        self.transport.registerProducer(throttle, True)
+
+        d = self._spewWindows(windows, query, uid, throttle)
+        d.addCallback(self._cbFetchWindowsDone, tag)
+        d.addErrback(self._ebFetchWindows, tag)
+
+    @defer.inlineCallbacks
+    def _spewWindows(self, windows, query, uid, throttle):
+        window = next(windows, None)
+        while window is not None:
+            messages = yield window
+            window = next(windows, None)
+            for msgid, msg in messages:
+                yield throttle.wait()
+                if throttle.stopped:
+                    return
+                yield self.spewMessage(msgid, msg, query, uid)
+
+    def _unregisterFetchThrottle(self):
+        if self._fetchThrottle is not None:
+            self._fetchThrottle = None
+            self.transport.unregisterProducer()
+
+    def _cbFetchWindowsDone(self, _, tag):
+        self._unregisterFetchThrottle()
+        self._fetchModSeqs = None
+        # The idle timeout was suspended while we delivered results,
+        # restore it now.
+        self.setTimeout(self._oldTimeout)
+        del self._oldTimeout
+        self.sendPositiveResponse(tag, 'FETCH completed')
+        self._unblock()
+
+    def _ebFetchWindows(self, failure, tag):
+        # Some of the messages may have been written already, but the client
+        # has to know that it did not get all of them.
+        self._unregisterFetchThrottle()
+        self._fetchModSeqs = None
+        self.setTimeout(self._oldTimeout)
+        del self._oldTimeout
+        self.log.failure('Error while writing FETCH response', failure)
+        self.sendNegativeResponse(
+            tag, 'FETCH failed: ' + str(failure.value))
+        self._unblock()
+
+    def arg_fetchatt(self, line):
+        """
+        fetch-att, that can include the MODSEQ attribute. The fetch
+        modifiers are left in the rest of the line.
+        """
+        atts, modseq, rest = _splitFetchAtts(line)
+        query = []
+        if atts:
+            parser = imap4._FetchParser()
+            parser.parseString(atts)
+            query = parser.result
+        if modseq:
+            query.append(_FetchModSeq())
+        return query, rest
+
+    def opt_fetch_modifiers(self, line):
+        """
+        Optional fetch modifiers: CHANGEDSINCE and VANISHED (rfc 7162).
+        """
+        if not line.startswith('('):
+            return None, line
+        items, rest = self.arg_plist(line)
+        modifiers = {}
+        items = iter(items)
+        for item in items:
+            name = item.upper()
+            if name == 'CHANGEDSINCE':
+                try:
+                    modifiers[name] = int(next(items))
+                except (StopIteration, TypeError, ValueError):
+                    raise IllegalClientResponse("Bad CHANGEDSINCE modifier")
+            elif name == 'VANISHED':
+                modifiers[name] = True
+            else:
+                raise IllegalClientResponse(
+                    "Unknown FETCH modifier: %s" % (item,))
+        return modifiers, rest
 
     select_FETCH = (do_FETCH, imap4.IMAP4Server.arg_seqset,
-                    imap4.IMAP4Server.arg_fetchatt)
+                    arg_fetchatt, opt_fetch_modifiers)
+
+    def _sendVanished(self, uids, earlier=False):
+        if uids:
+            self.sendUntaggedResponse('VANISHED %s%s' % (
+                '(EARLIER) ' if earlier else '', _formatSequenceSet(uids)))
+
+    def _selectWork(self, tag, name, params, rw, cmdName):
+        """
+        Patched to accept the CONDSTORE and QRESYNC select parameters (rfc
+        7162).
+        """
+        try:
+            qresync = self._parseSelectParams(params)
+        except IllegalClientResponse as e:
+            self.sendBadResponse(tag, 'Illegal syntax: %s' % (e,))
+            return
+
+        if self.mbox:
+            self.mbox.removeListener(self)
+            cmbx = imap4.ICloseableMailbox(self.mbox, None)
+            if cmbx is not None:
+                maybeDeferred(cmbx.close).addErrback(
+                    lambda f: self.log.failure('Error closing mailbox', f))
+            self.mbox = None
+            self.state = 'auth'
+            if self._qresync:
+                self.sendPositiveResponse(None, '[CLOSED] Mailbox closed')
+
+        name = _parseMbox(name)
+        d = maybeDeferred(self.account.select, name, rw)
+        d.addCallback(self._cbSelectWork, cmdName, tag, qresync)
+        d.addErrback(self._ebSelectWork, cmdName, tag)
 
-    def _cbSelectWork(self, mbox, cmdName, tag):
+    def _parseSelectParams(self, params):
+        """
+        Parse the parameters of a SELECT or EXAMINE command.
+
+        :return: None, or a tuple (uidvalidity, modseq, known_uids) with the
+                 QRESYNC parameters. known_uids is a MessageSet, or None if
+                 it was not given.
+        """
+        qresync = None
+        params = iter(params or [])
+        for param in params:
+            name = str(param).upper()
+            if name == 'CONDSTORE':
+                self._condstore = True
+            elif name == 'QRESYNC':
+                if not self._qresync:
+                    raise IllegalClientResponse("QRESYNC is not enabled")
+                try:
+                    args = next(params)
+                    uidvalidity, modseq = int(args[0]), int(args[1])
+                    known_uids = None
+                    if len(args) > 2:
+                        known_uids = imap4.parseIdList(args[2])
+                except (StopIteration, IndexError, TypeError, ValueError,
+                        imap4.IllegalIdentifierError):
+                    raise IllegalClientResponse("Bad QRESYNC parameter")
+                qresync = (uidvalidity, modseq, known_uids)
+            else:
+                raise IllegalClientResponse(
+                    "Unknown select parameter: %s" % (param,))
+        return qresync
+
+    def opt_select_params(self, line):
+        """
+        Optional select parameters, that can be nested.
+        """
+        if not line.startswith('('):
+            return None, line
+        try:
+            params = imap4.parseNestedParens(line)
+        except (imap4.MismatchedNesting, imap4.MismatchedQuoting):
+            raise IllegalClientResponse("Malformed select parameters")
+        return params[0], ''
+
+    def _cbSelectWork(self, mbox, cmdName, tag, qresync=None):
         """
         Callback for selectWork
 
         * patched to avoid conformance errors due to incomplete UIDVALIDITY
         line.
         * patched to accept deferreds for messagecount and recent count
+        * patched to send the HIGHESTMODSEQ, and the changes since the one
+          known by the client with QRESYNC.
         """
         if mbox is None:
             self.sendNegativeResponse(tag, 'No such mailbox')
@@ -255,14 +938,17 @@ class LEAPIMAPServer(imap4.IMAP4Server):
             self.sendNegativeResponse(tag, 'Mailbox cannot be selected')
             return
 
-        d1 = defer.maybeDeferred(mbox.getMessageCount)
+        # the messages that the client knows about, from now on.
+        d1 = defer.maybeDeferred(mbox.load_uids)
+        d1.addCallback(len)
         d2 = defer.maybeDeferred(mbox.getRecentCount)
         d3 = defer.maybeDeferred(mbox.getUIDNext)
-        return defer.gatherResults([d1, d2, d3]).addCallback(
-            self.__cbSelectWork, mbox, cmdName, tag)
+        d4 = defer.maybeDeferred(mbox.getHighestModSeq)
+        return defer.gatherResults([d1, d2, d3, d4]).addCallback(
+            self.__cbSelectWork, mbox, cmdName, tag, qresync)
 
-    def __cbSelectWork(self, ((msg_count, recent_count, uid_next)),
-                       mbox, cmdName, tag):
+    def __cbSelectWork(self, counts, mbox, cmdName, tag, qresync):
+        msg_count, recent_count, uid_next, highest_modseq = counts
         flags = mbox.getFlags()
         self.sendUntaggedResponse('FLAGS (%s)' % ' '.join(flags))
 
@@ -282,13 +968,55 @@ class LEAPIMAPServer(imap4.IMAP4Server):
         # send UIDNEXT too
         self.sendPositiveResponse(None, '[UIDNEXT %d]' % uid_next)
         # ----------------------------------------------------------------
+        self.sendPositiveResponse(
+            None, '[HIGHESTMODSEQ %d] Highest' % highest_modseq)
 
         s = mbox.isWriteable() and 'READ-WRITE' or 'READ-ONLY'
         mbox.addListener(self)
-        self.sendPositiveResponse(tag, '[%s] %s successful' % (s, cmdName))
         self.state = 'select'
         self.mbox = mbox
 
+        d = defer.succeed(None)
+        # with a different UIDVALIDITY, the client has to forget everything
+        # that it knew about the mailbox.
+        if qresync and qresync[0] == mbox.getUIDValidity():
+            _, modseq, known_uids = qresync
+            d.addCallback(lambda _: self._qresyncChanges(
+                mbox, modseq, known_uids))
+        d.addCallback(lambda _: self.sendPositiveResponse(
+            tag, '[%s] %s successful' % (s, cmdName)))
+        return d
+
+    def _qresyncChanges(self, mbox, modseq, known_uids):
+        """
+        Send the UIDs of the messages expunged after a modseq, and the flags
+        of the messages that changed after it.
+        """
+        def send_flags(modseqs):
+            if not modseqs:
+                return
+            msgids = dict((uid, msgid) for (msgid, uid, _) in modseqs)
+            changed = dict((uid, value) for (_, uid, value) in modseqs)
+            d = mbox.fetch_flags(_makeMessageSet(sorted(changed)), 1)
+            d.addCallback(send_responses, msgids, changed)
+            return d
+
+        def send_responses(results, msgids, changed):
+            for _, flags_part in results:
+                uid = flags_part.getUID()
+                self.sendUntaggedResponse(
+                    '%d FETCH (UID %d FLAGS (%s) MODSEQ (%d))' % (
+                        msgids[uid], uid, ' '.join(flags_part.getFlags()),
+                        changed[uid]))
+
+        if known_uids is None:
+            known_uids = imap4.MessageSet(1, None)
+        d = mbox.get_expunged(modseq, known_uids)
+        d.addCallback(self._sendVanished, earlier=True)
+        d.addCallback(lambda _: mbox.get_modseqs(known_uids, 1, modseq))
+        d.addCallback(send_flags)
+        return d
+
     def checkpoint(self):
         """
         Called when the client issues a CHECK command.
@@ -299,7 +1027,80 @@ class LEAPIMAPServer(imap4.IMAP4Server):
         when the deferred's callback (or errback) is invoked.
         """
         # TODO implement a collection of ongoing deferreds?
-        return None
+        return self._sendUpdates(flush=True)
+
+    # -----------------------------------------------------------------------
+    # Patched to push the changes of the selected mailbox: they are sent
+    # as soon as they happen while the client is in IDLE, and otherwise in
+    # the response to the next NOOP or CHECK, since an EXPUNGE cannot be
+    # sent when there is no command in progress.
+
+    def updatesPending(self):
+        """
+        Called by the selected mailbox when it has changes for the client.
+        """
+        if self.parseState == 'idle':
+            self._sendUpdates()
+
+    def _sendUpdates(self, flush=False):
+        if self.mbox is None:
+            return defer.succeed(None)
+        d = defer.succeed(None)
+        if flush:
+            d.addCallback(lambda _: self.mbox.flush_updates())
+        d.addCallback(lambda _: self._writeUpdates(self.mbox.get_updates()))
+        d.addErrback(lambda f: self.log.failure(
+            'Error while sending the mailbox updates', f))
+        return d
+
+    def _writeUpdates(self, updates):
+        if updates is None:
+            return
+        if self._qresync:
+            self._sendVanished(updates.vanished)
+        else:
+            for msn in updates.expunged:
+                self.sendUntaggedResponse('%d EXPUNGE' % msn)
+        if updates.exists is not None:
+            self.sendUntaggedResponse('%d EXISTS' % updates.exists)
+            if updates.recent is not None:
+                self.sendUntaggedResponse('%d RECENT' % updates.recent)
+        for msn, uid, flags, modseq in updates.flags:
+            items = ['FLAGS (%s)' % ' '.join(flags)]
+            # the client needs to know the uid and the modseq once it
+            # enabled the extensions (rfc 7162).
+            if self._qresync:
+                items.append('UID %d' % uid)
+            if self._condstore and modseq is not None:
+                items.append('MODSEQ (%d)' % modseq)
+            self.sendUntaggedResponse(
+                '%d FETCH (%s)' % (msn, ' '.join(items)))
+
+    def do_NOOP(self, tag):
+        d = self._sendUpdates(flush=True)
+        d.addCallback(lambda _: self.sendPositiveResponse(
+            tag, 'NOOP No operation performed'))
+
+    unauth_NOOP = (do_NOOP,)
+    auth_NOOP = unauth_NOOP
+    select_NOOP = unauth_NOOP
+    logout_NOOP = unauth_NOOP
+
+    def do_IDLE(self, tag):
+        imap4.IMAP4Server.do_IDLE(self, tag)
+        self._sendUpdates(flush=True)
+
+    select_IDLE = (do_IDLE,)
+    auth_IDLE = select_IDLE
+
+    def connectionLost(self, reason):
+        if self._deflater is not None:
+            self._deflater.cancel()
+        if self.mbox:
+            self.mbox.removeListener(self)
+            self.mbox = None
+        imap4.IMAP4Server.connectionLost(self, reason)
+    # -----------------------------------------------------------------------
 
     #############################################################
     #
@@ -321,6 +1122,13 @@ class LEAPIMAPServer(imap4.IMAP4Server):
         # patched ############
         cap['LITERAL+'] = None
         ######################
+        cap['MOVE'] = None
+        cap['ENABLE'] = None
+        cap['CONDSTORE'] = None
+        cap['QRESYNC'] = None
+        cap['COMPRESS'] = ['DEFLATE']
+        cap['SORT'] = None
+        cap['THREAD'] = ['ORDEREDSUBJECT', 'REFERENCES']
         return cap
 
     def _stringLiteral(self, size, literal_plus=False):
@@ -625,12 +1433,13 @@ class LEAPIMAPServer(imap4.IMAP4Server):
     def __cbAppend(self, result, tag, mbox):
 
         # XXX patched ---------------------------------
-        def send_response(count):
-            self.sendUntaggedResponse('%d EXISTS' % count)
-            self.sendPositiveResponse(tag, 'APPEND complete')
-
-        d = mbox.getMessageCount()
-        d.addCallback(send_response)
+        # the new message is counted in the EXISTS response only if it was
+        # appended to the selected mailbox.
+        d = defer.succeed(None)
+        if self.mbox is not None and mbox.collection is self.mbox.collection:
+            d = self._sendUpdates(flush=True)
+        d.addCallback(
+            lambda _: self.sendPositiveResponse(tag, 'APPEND complete'))
         return d
         # XXX patched ---------------------------------
     # -----------------------------------------------------------------------
@@ -639,6 +1448,298 @@ class LEAPIMAPServer(imap4.IMAP4Server):
                    imap4.IMAP4Server.opt_datetime, arg_literal)
     select_APPEND = auth_APPEND
 
+    # -----------------------------------------------------------------------
+    # Patched to copy all the messages in bulk, instead of one by one, and to
+    # support the MOVE extension (rfc 6851).
+
+    # the commands that can be prefixed with UID
+    _uidCommands = ('COPY', 'FETCH', 'STORE', 'SEARCH', 'MOVE', 'SORT',
+                    'THREAD')
+
+    def do_UID(self, tag, command, line):
+        command = command.upper()
+        if command not in self._uidCommands:
+            raise imap4.IllegalClientResponse(command)
+        self.dispatchCommand(tag, command, line, uid=1)
+
+    select_UID = (do_UID, imap4.IMAP4Server.arg_atom,
+                  imap4.IMAP4Server.arg_line)
+
+    def do_COPY(self, tag, messages, mailbox, uid=0):
+        self._copyWork(tag, messages, mailbox, uid, 'COPY')
+
+    def do_MOVE(self, tag, messages, mailbox, uid=0):
+        self._copyWork(tag, messages, mailbox, uid, 'MOVE')
+
+    def _copyWork(self, tag, messages, mailbox, uid, cmdName):
+        mailbox = _parseMbox(mailbox)
+        d = maybeDeferred(self.account.select, mailbox)
+        d.addCallback(
+            self._cbCopyGotMailbox, tag, messages, mailbox, uid, cmdName)
+        d.addErrback(self._ebCopy, tag, cmdName)
+
+    def _cbCopyGotMailbox(self, mbox, tag, messages, mailbox, uid, cmdName):
+        if not mbox:
+            self.sendNegativeResponse(
+                tag, '[TRYCREATE] No such mailbox: ' + mailbox)
+            return
+
+        if cmdName == 'MOVE':
+            d = maybeDeferred(
+                self.mbox.move_messages, messages, uid, mbox,
+                uids=self._qresync)
+            d.addCallback(self._cbMoved, tag)
+        else:
+            d = maybeDeferred(self.mbox.copy_messages, messages, uid, mbox)
+            d.addCallback(
+                lambda _: self.sendPositiveResponse(tag, 'COPY completed'))
+        d.addErrback(self._ebCopy, tag, cmdName)
+
+    def _cbMoved(self, expunged, tag):
+        if self._qresync:
+            self._sendVanished(expunged)
+        else:
+            for msn in expunged:
+                self.sendUntaggedResponse('%d EXPUNGE' % msn)
+        self.sendPositiveResponse(tag, 'MOVE completed')
+
+    def _ebCopy(self, failure, tag, cmdName):
+        if failure.check(imap4.ReadOnlyMailbox):
+            self.sendNegativeResponse(
+                tag, '%s ignored on read-only mailbox' % cmdName)
+            return
+        if failure.check(imap4.MailboxException):
+            self.sendNegativeResponse(tag, str(failure.value))
+            return
+        self.log.failure('Error on %s' % cmdName, failure)
+        self.sendBadResponse(tag, '%s failed: %s' % (cmdName, failure.value))
+    # -----------------------------------------------------------------------
+
+    # -----------------------------------------------------------------------
+    # Patched to support the COMPRESS extension (rfc 4978).
+
+    def do_COMPRESS(self, tag, mechanism):
+        if self._deflater is not None:
+            self.sendNegativeResponse(
+                tag, '[COMPRESSIONACTIVE] DEFLATE active')
+            return
+        if mechanism.upper() != 'DEFLATE':
+            self.sendNegativeResponse(
+                tag, 'Unknown compression mechanism %s' % mechanism)
+            return
+        # the response is the last thing sent uncompressed.
+        self.sendPositiveResponse(tag, 'DEFLATE active')
+        self._deflater = _DeflateTransport(self.transport)
+        self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.transport = self._deflater
+
+    auth_COMPRESS = (do_COMPRESS, imap4.IMAP4Server.arg_atom)
+    select_COMPRESS = auth_COMPRESS
+
+    def dataReceived(self, data):
+        if self._inflater is not None:
+            try:
+                data = self._inflater.decompress(data)
+            except zlib.error:
+                self.log.error('Bad compressed data, closing the connection')
+                self.transport.loseConnection()
+                return
+        imap4.IMAP4Server.dataReceived(self, data)
+    # -----------------------------------------------------------------------
+
+    # -----------------------------------------------------------------------
+    # Patched to support the SORT and THREAD extensions (rfc 5256).
+
+    _sortCharsets = ('US-ASCII', 'UTF-8')
+
+    def do_SORT(self, tag, criteria, charset, query, uid=0):
+        if self._checkSortCharset(tag, charset):
+            d = maybeDeferred(self.mbox.sort, criteria, query, uid=uid)
+            d.addCallback(self._cbSort, tag)
+            d.addErrback(self._ebSort, tag, 'SORT')
+
+    select_SORT = (do_SORT, imap4.IMAP4Server.arg_plist,
+                   imap4.IMAP4Server.arg_atom,
+                   imap4.IMAP4Server.arg_searchkeys)
+
+    def _cbSort(self, ids, tag):
+        self.sendUntaggedResponse(
+            ' '.join(['SORT'] + [str(i) for i in ids]))
+        self.sendPositiveResponse(tag, 'SORT completed')
+
+    def do_THREAD(self, tag, algorithm, charset, query, uid=0):
+        if self._checkSortCharset(tag, charset):
+            d = maybeDeferred(self.mbox.thread, algorithm, query, uid=uid)
+            d.addCallback(self._cbThread, tag)
+            d.addErrback(self._ebSort, tag, 'THREAD')
+
+    select_THREAD = (do_THREAD, imap4.IMAP4Server.arg_atom,
+                     imap4.IMAP4Server.arg_atom,
+                     imap4.IMAP4Server.arg_searchkeys)
+
+    def _cbThread(self, threads, tag):
+        self.sendUntaggedResponse(
+            'THREAD ' + ''.join('(%s)' % _formatThread(thread)
+                                for thread in threads))
+        self.sendPositiveResponse(tag, 'THREAD completed')
+
+    def _checkSortCharset(self, tag, charset):
+        if charset.upper() not in self._sortCharsets:
+            self.sendNegativeResponse(
+                tag, '[BADCHARSET (%s)] Unsupported charset' % (
+                    ' '.join(self._sortCharsets)))
+            return False
+        return True
+
+    def _ebSort(self, failure, tag, cmdName):
+        if not failure.check(imap4.IllegalQueryError):
+            self.log.failure('Error on %s' % cmdName, failure)
+        self.sendBadResponse(tag, '%s failed: %s' % (cmdName, failure.value))
+    # -----------------------------------------------------------------------
+
+    # -----------------------------------------------------------------------
+    # Patched to support the CONDSTORE and QRESYNC extensions (rfc 7162).
+
+    def do_ENABLE(self, tag, line):
+        enabled = []
+        for capability in line.upper().split():
+            if capability == 'CONDSTORE':
+                self._condstore = True
+            elif capability == 'QRESYNC':
+                self._condstore = self._qresync = True
+            else:
+                continue
+            enabled.append(capability)
+        self.sendUntaggedResponse(' '.join(['ENABLED'] + enabled))
+        self.sendPositiveResponse(tag, 'ENABLE completed')
+
+    auth_ENABLE = (do_ENABLE, imap4.IMAP4Server.arg_line)
+    select_ENABLE = auth_ENABLE
+
+    def do_STORE(self, tag, messages, unchangedsince, mode, flags, uid=0):
+        """
+        Patched to support the UNCHANGEDSINCE modifier, and to send the
+        modseqs of the messages once CONDSTORE is enabled.
+        """
+        mode = mode.upper()
+        silent = mode.endswith('SILENT')
+        if mode.startswith('+'):
+            mode = 1
+        elif mode.startswith('-'):
+            mode = -1
+        else:
+            mode = 0
+        flags = [str(flag) for flag in flags]
+
+        if unchangedsince is None:
+            d = maybeDeferred(self.mbox.store, messages, flags, mode, uid=uid)
+            d.addCallback(lambda result: (result, []))
+        else:
+            self._condstore = True
+            d = maybeDeferred(self.mbox.get_modseqs, messages, uid)
+            d.addCallback(
+                self._cbConditionalStore, unchangedsince, flags, mode, uid)
+        d.addCallback(self._cbStore, tag, uid, silent)
+        d.addErrback(self._ebStore, tag)
+
+    def _cbConditionalStore(self, modseqs, unchangedsince, flags, mode, uid):
+        # the messages that changed after the modseq known by the client are
+        # left untouched, and reported in the tagged response.
+        modified = [msg_uid if uid else msn
+                    for (msn, msg_uid, modseq) in modseqs
+                    if modseq > unchangedsince]
+        unchanged = [msg_uid if uid else msn
+                     for (msn, msg_uid, modseq) in modseqs
+                     if modseq <= unchangedsince]
+        if not unchanged:
+            return {}, modified
+        d = maybeDeferred(
+            self.mbox.store, _makeMessageSet(unchanged), flags, mode, uid=uid)
+        d.addCallback(lambda result: (result, modified))
+        return d
+
+    def _cbStore(self, result, tag, uid, silent):
+        result, modified = result
+        result = result or {}
+
+        def send_responses(modseqs):
+            for msgid, flags in sorted(result.items()):
+                items = []
+                if not silent:
+                    items.append('FLAGS (%s)' % ' '.join(flags))
+                if uid:
+                    items.append('UID %d' % self.mbox.getUID(msgid))
+                if msgid in modseqs:
+                    items.append('MODSEQ (%d)' % modseqs[msgid])
+                elif silent:
+                    continue
+                self.sendUntaggedResponse(
+                    '%d FETCH (%s)' % (msgid, ' '.join(items)))
+            if modified:
+                self.sendPositiveResponse(
+                    tag, '[MODIFIED %s] Conditional STORE failed' %
+                    _formatSequenceSet(modified))
+            else:
+                self.sendPositiveResponse(tag, 'STORE completed')
+
+        # the results are keyed by message sequence number.
+        d = defer.succeed([])
+        if result and self._condstore:
+            d = maybeDeferred(
+                self.mbox.get_modseqs, _makeMessageSet(result), 0)
+        d.addCallback(lambda modseqs: dict(
+            (msn, modseq) for (msn, _, modseq) in modseqs))
+        d.addCallback(send_responses)
+        return d
+
+    def _ebStore(self, failure, tag):
+        self.log.failure('Error on STORE', failure)
+        self.sendBadResponse(tag, 'Server error: ' + str(failure.value))
+
+    def opt_store_modifiers(self, line):
+        """
+        Optional store modifiers: UNCHANGEDSINCE (rfc 7162).
+        """
+        if not line.startswith('('):
+            return None, line
+        items, rest = self.arg_plist(line)
+        if len(items) != 2 or str(items[0]).upper() != 'UNCHANGEDSINCE':
+            raise IllegalClientResponse("Bad STORE modifier")
+        try:
+            return int(items[1]), rest
+        except (TypeError, ValueError):
+            raise IllegalClientResponse("Bad UNCHANGEDSINCE modifier")
+
+    select_STORE = (do_STORE, imap4.IMAP4Server.arg_seqset,
+                    opt_store_modifiers, imap4.IMAP4Server.arg_atom,
+                    imap4.IMAP4Server.arg_flaglist)
+
+    def do_EXPUNGE(self, tag):
+        """
+        Patched to send a VANISHED response instead of the EXPUNGE ones once
+        QRESYNC is enabled.
+        """
+        if not self._qresync:
+            return imap4.IMAP4Server.do_EXPUNGE(self, tag)
+        if not self.mbox.isWriteable():
+            self.sendNegativeResponse(
+                tag, 'EXPUNGE ignored on read-only mailbox')
+            return
+        d = maybeDeferred(self.mbox.expunge, uids=True)
+        d.addCallback(self._cbExpungeVanished, tag)
+        d.addErrback(self._ebExpungeVanished, tag)
+
+    select_EXPUNGE = (do_EXPUNGE,)
+
+    def _cbExpungeVanished(self, uids, tag):
+        self._sendVanished(uids)
+        self.sendPositiveResponse(tag, 'EXPUNGE completed')
+
+    def _ebExpungeVanished(self, failure, tag):
+        self.log.failure('Error on EXPUNGE', failure)
+        self.sendBadResponse(tag, 'EXPUNGE failed: ' + str(failure.value))
+    # -----------------------------------------------------------------------
+
     # Need to override the command table after patching
     # arg_astring and arg_literal, except on the methods that we are already
     # overriding.
@@ -655,9 +1756,6 @@ class LEAPIMAPServer(imap4.IMAP4Server):
     # -------------------------------------------------
     do_LOGIN = imap4.IMAP4Server.do_LOGIN
     do_STATUS = imap4.IMAP4Server.do_STATUS
-    do_COPY = imap4.IMAP4Server.do_COPY
-
-    _selectWork = imap4.IMAP4Server._selectWork
 
     arg_plist = imap4.IMAP4Server.arg_plist
     arg_seqset = imap4.IMAP4Server.arg_seqset
@@ -666,13 +1764,14 @@ class LEAPIMAPServer(imap4.IMAP4Server):
 
     unauth_LOGIN = (do_LOGIN, arg_astring, arg_astring)
 
-    auth_SELECT = (_selectWork, arg_astring, 1, 'SELECT')
+    auth_SELECT = (_selectWork, arg_astring, opt_select_params, 1, 'SELECT')
     select_SELECT = auth_SELECT
 
     auth_CREATE = (do_CREATE, arg_astring)
     select_CREATE = auth_CREATE
 
-    auth_EXAMINE = (_selectWork, arg_astring, 0, 'EXAMINE')
+    auth_EXAMINE = (
+        _selectWork, arg_astring, opt_select_params, 0, 'EXAMINE')
     select_EXAMINE = auth_EXAMINE
 
     # TODO -----------------------------------------------
@@ -704,6 +1803,7 @@ class LEAPIMAPServer(imap4.IMAP4Server):
     select_STATUS = auth_STATUS
 
     select_COPY = (do_COPY, arg_seqset, arg_astring)
+    select_MOVE = (do_MOVE, arg_seqset, arg_astring)
 
     #############################################################
     # END of Twisted imap4 patch to support LITERAL+ extension
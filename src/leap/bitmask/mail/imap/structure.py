@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# imap/structure.py
+# Copyright (C) 2016 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+IMAP ENVELOPE and BODYSTRUCTURE of parsed messages.
+
+These are computed when a message is stored, so this module must not depend
+on the IMAP server.
+"""
+import StringIO
+
+from twisted.mail import imap4
+from zope.interface import implements
+
+from leap.bitmask.mail.imap.messages import _format_headers
+
+
+def _getContentType(msg):
+
+    """
+    Return a two-tuple of the main and subtype of the given message.
+    """
+    attrs = None
+    mm = msg.getHeaders(False, 'content-type').get('content-type', None)
+    if mm:
+        mm = ''.join(mm.splitlines())
+        mimetype = mm.split(';')
+        if mimetype:
+            type = mimetype[0].split('/', 1)
+            if len(type) == 1:
+                major = type[0]
+                minor = None
+            elif len(type) == 2:
+                major, minor = type
+            else:
+                major = minor = None
+            # XXX patched ---------------------------------------------
+            attrs = dict(x.strip().split('=', 1) for x in mimetype[1:])
+            # XXX patched ---------------------------------------------
+        else:
+            major = minor = None
+    else:
+        major = minor = None
+    return major, minor, attrs
+
+
+class _ParsedMessagePart(object):
+    """
+    An IMessagePart over a parsed email.message.Message, used to compute the
+    ENVELOPE and BODYSTRUCTURE of a message before it is stored.
+    """
+    implements(imap4.IMessagePart)
+
+    def __init__(self, msg):
+        self._msg = msg
+
+    def _get_body(self):
+        payload = self._msg.get_payload()
+        if isinstance(payload, list):
+            # message/rfc822 parts hold the encapsulated message.
+            return ''.join([part.as_string() for part in payload])
+        return payload
+
+    def getBodyFile(self):
+        return StringIO.StringIO(self._get_body())
+
+    def getSize(self):
+        return len(self._get_body())
+
+    def getHeaders(self, negate, *names):
+        return _format_headers(self._msg.items(), negate, *names)
+
+    def isMultipart(self):
+        return self._msg.is_multipart()
+
+    def getSubPart(self, part):
+        if not self.isMultipart():
+            raise TypeError
+        return _ParsedMessagePart(self._msg.get_payload()[part])
+
+
+def get_envelope(msg):
+    """
+    Compute the IMAP ENVELOPE of a parsed message.
+
+    :param msg: the parsed message.
+    :type msg: email.message.Message
+    :rtype: list
+    """
+    return _to_list(imap4.getEnvelope(_ParsedMessagePart(msg)))
+
+
+def get_body_structure(msg):
+    """
+    Compute the extended IMAP BODYSTRUCTURE of a parsed message.
+
+    :param msg: the parsed message.
+    :type msg: email.message.Message
+    :rtype: list
+    """
+    return _to_list(imap4.getBodyStructure(_ParsedMessagePart(msg), True))
+
+
+def _to_list(structure):
+    if isinstance(structure, (list, tuple)):
+        return [_to_list(item) for item in structure]
+    return structure
+
+
+# Monkey-patch _getContentType to avoid bug that passes lower-case boundary in
+# BODYSTRUCTURE response. The server applies it too, for the messages whose
+# BODYSTRUCTURE was not stored.
+
+imap4._getContentType = _getContentType
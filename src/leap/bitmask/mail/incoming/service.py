@@ -292,10 +292,12 @@ class IncomingMail(Service):
             elif self._is_msg(keys):
                 # TODO this pipeline is a bit obscure!
                 d = self._decrypt_doc(doc)
-                d.addCallbacks(self._add_message_locally, self._errback)
+                d.addErrback(self._errback)
                 deferreds.append(d)
 
+        # the decrypted messages are added to the inbox in a single batch
         d = defer.gatherResults(deferreds, consumeErrors=True)
+        d.addCallback(self._add_messages_locally)
         d.addCallback(lambda _: doclist)
         return d
 
@@ -863,6 +865,66 @@ class IncomingMail(Service):
         d.addCallbacks(msgSavedCallback, self._errback)
         return d
 
+    def _add_messages_locally(self, msgtuples):
+        """
+        Adds several messages to local inbox in a single batch, and delete
+        them from the incoming db in soledad.
+
+        The messages that cannot be stored with the batch are tried again one
+        by one, so that a bad message does not hold back the rest of them.
+        The messages that were already stored are found in the inbox when
+        they are tried again, so they are not added twice.
+
+        :param msgtuples: a list of tuples like the ones expected by
+                          `_add_message_locally`. The entries that are not
+                          a successfully decrypted message are skipped.
+        :type msgtuples: list
+
+        :return: A Deferred that will be fired when the messages are stored
+        :rtype: Defferred
+        """
+        msgtuples = [
+            msgtuple for msgtuple in msgtuples
+            if isinstance(msgtuple, tuple) and
+            isinstance(msgtuple[1], basestring) and msgtuple[1]]
+        if not msgtuples:
+            return defer.succeed(None)
+        if len(msgtuples) == 1:
+            return self._add_message_locally(msgtuples[0])
+
+        insertion_date = formatdate(time.time())
+        self.log.info('Adding %d messages to local db' % len(msgtuples))
+
+        def signal_deleted(doc_id):
+            emit_async(catalog.MAIL_MSG_DELETED_INCOMING,
+                       self._userid)
+            return doc_id
+
+        def msgsSavedCallback(msgs):
+            deferreds = []
+            for msgtuple, msg in zip(msgtuples, msgs):
+                if msg is None:
+                    deferreds.append(self._add_message_locally(msgtuple))
+                    continue
+                doc, _ = msgtuple
+                emit_async(catalog.MAIL_MSG_SAVED_LOCALLY, self._userid)
+                d = self._delete_incoming_message(doc)
+                d.addCallback(signal_deleted)
+                deferreds.append(d)
+            return defer.gatherResults(deferreds, consumeErrors=True)
+
+        def addOneByOne(failure):
+            self._errback(failure)
+            return defer.gatherResults(
+                [self._add_message_locally(msgtuple)
+                 for msgtuple in msgtuples], consumeErrors=True)
+
+        d = self._inbox_collection.add_msgs(
+            [raw_data for _, raw_data in msgtuples], (self.RECENT_FLAG,),
+            date=insertion_date)
+        d.addCallbacks(msgsSavedCallback, addOneByOne)
+        return d
+
     #
     # helpers
     #
@@ -118,6 +118,19 @@ class IMailAdaptor(Interface):
         :rtype: implementor of leap.mail.IMessage
         """
 
+    def get_msg_from_string_async(self, MessageClass, raw_msg):
+        """
+        Get an instance of a MessageClass initialized with a MessageWrapper
+        that contains all the parts obtained from parsing the raw string for
+        the message, possibly parsing it out of the reactor thread.
+
+        :param MessageClass: an implementor of IMessage
+        :type raw_msg: str
+        :return: a deferred that will fire with an implementor of
+                 leap.mail.IMessage
+        :rtype: Deferred
+        """
+
     def get_msg_from_docs(self, MessageClass, mdoc, fdoc, hdoc, cdocs=None,
                           uid=None):
         """
@@ -144,6 +157,17 @@ class IMailAdaptor(Interface):
         :rtype: defer.Deferred
         """
 
+    def create_msgs(self, store, msgs):
+        """
+        :param store: an instance of soledad, or anything that behaves alike
+        :param msgs: a list of Message objects.
+
+        :return: a Deferred that is fired with the doc_ids of the
+                 meta-documents when all the underlying documents have been
+                 created.
+        :rtype: defer.Deferred
+        """
+
     def update_msg(self, store, msg):
         """
         :param msg: a Message object.
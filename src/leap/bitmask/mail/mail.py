@@ -23,6 +23,7 @@ entry point for message and account manipulation, in a protocol-agnostic way.
 In the future, pluggable transports will expose this generic API.
 """
 import itertools
+import re
 import uuid
 import StringIO
 import time
@@ -32,14 +33,20 @@ from collections import defaultdict
 
 from twisted.internet import defer
 from twisted.logger import Logger
+from twisted.python import failure
 
 from leap.common.check import leap_assert_type
 from leap.common.events import emit_async, catalog
+from leap.bitmask.mail.adaptors.soledad import ContentDocCache
 from leap.bitmask.mail.adaptors.soledad import SoledadMailAdaptor
 from leap.bitmask.mail.constants import INBOX_NAME
 from leap.bitmask.mail.constants import MessageFlags
+from leap.bitmask.mail.constants import METAMSGID, METAMSGID_CHASH_RE
+from leap.bitmask.mail.errors import MessageStorageError
+from leap.bitmask.mail.imap.mailbox import normalize_mailbox
 from leap.bitmask.mail.mailbox_indexer import MailboxIndexer
 from leap.bitmask.mail.plugins import soledad_sync_hooks
+from leap.bitmask.mail.search_indexer import SearchIndexer
 from leap.bitmask.mail.utils import find_charset, CaseInsensitiveDict
 
 log = Logger()
@@ -50,11 +57,11 @@ log = Logger()
 #     too generic (there's also IncomingMail, and OutgoingMail
 # [ ] Profile add_msg.
 
-def _get_mdoc_id(mbox, chash):
+def _get_mdoc_id(mbox_uuid, chash):
     """
     Get the doc_id for the metamsg document.
     """
-    return "M+{mbox}+{chash}".format(mbox=mbox, chash=chash)
+    return METAMSGID.format(mbox_uuid=mbox_uuid.replace('-', '_'), chash=chash)
 
 
 def _write_and_rewind(payload):
@@ -162,12 +169,9 @@ class MessagePart(object):
         """
         Size of the body, in octets.
         """
-        total = self._pmap['size']
-        _h = self.get_headers()
-        headers = len(
-            '\n'.join(["%s: %s" % (k, v) for k, v in dict(_h).items()]))
-        # have to subtract 2 blank lines
-        return total - headers - 2
+        # the size of the payload is stored in the part map when the message
+        # is parsed.
+        return self._pmap.get('size', 0)
 
     def get_body_file(self):
         payload = ""
@@ -259,6 +263,27 @@ class Message(object):
         """
         return self._wrapper.hdoc.date
 
+    def get_envelope(self):
+        """
+        Get the IMAP ENVELOPE computed when the message was stored.
+
+        :return: the envelope, or an empty list for messages stored before it
+                 was kept in the headers document.
+        :rtype: list
+        """
+        return self._wrapper.hdoc.envelope
+
+    def get_body_structure(self):
+        """
+        Get the extended IMAP BODYSTRUCTURE computed when the message was
+        stored.
+
+        :return: the body structure, or an empty list for messages stored
+                 before it was kept in the headers document.
+        :rtype: list
+        """
+        return self._wrapper.hdoc.bodystructure
+
     # imap.IMessageParts
 
     def get_headers(self):
@@ -329,6 +354,178 @@ class Flagsmode(object):
     SET = 0
 
 
+class MailboxCounters(object):
+    """
+    A cache for the counters of the mailboxes of an account: the number of
+    messages, of unseen and recent messages, and the next uid.
+
+    The counters are updated in place when messages are added, flagged or
+    deleted, and they are only counted again in the store after they have
+    been invalidated (for instance, when a sync brought changes to a
+    mailbox).
+    """
+
+    MESSAGES = 'messages'
+    UNSEEN = 'unseen'
+    RECENT = 'recent'
+    UIDNEXT = 'uidnext'
+
+    def __init__(self):
+        self._values = defaultdict(dict)
+        # number of changes seen for each mailbox, so that we do not cache a
+        # count that was started before a change.
+        self._changes = defaultdict(int)
+
+    def get(self, mbox_uuid, name, count_fun, *args):
+        """
+        Get the value of a counter, counting it with count_fun if it is not
+        cached.
+
+        :return: a deferred that will fire with the value of the counter.
+        :rtype: Deferred
+        """
+        values = self._values[mbox_uuid]
+        if name in values:
+            return defer.succeed(values[name])
+
+        changes = self._changes[mbox_uuid]
+
+        def cache_value(value):
+            if value is not None and self._changes[mbox_uuid] == changes:
+                self._values[mbox_uuid][name] = value
+            return value
+
+        d = defer.maybeDeferred(count_fun, *args)
+        d.addCallback(cache_value)
+        return d
+
+    def update(self, mbox_uuid, name, delta):
+        """
+        Add delta to a counter, if it is cached.
+        """
+        self._changes[mbox_uuid] += 1
+        values = self._values[mbox_uuid]
+        if name in values:
+            values[name] += delta
+
+    def invalidate(self, mbox_uuid, *names):
+        """
+        Forget the passed counters of a mailbox, or all of them if no name is
+        passed.
+        """
+        self._changes[mbox_uuid] += 1
+        values = self._values[mbox_uuid]
+        if not names:
+            values.clear()
+        for name in names:
+            values.pop(name, None)
+
+
+class MailboxCatalogue(object):
+    """
+    An in-memory catalogue of the mailboxes of an account, indexed by name
+    and by uuid, so that listing and looking up the mailboxes does not need to
+    query the store every time.
+
+    It is loaded from the store the first time it is needed, it is kept up to
+    date by the local operations on the mailboxes, and it is invalidated when
+    a sync brings mailbox documents.
+    """
+
+    def __init__(self):
+        self._by_name = None
+        self._by_uuid = {}
+        # number of changes seen, so that we do not keep a listing that was
+        # started before a change.
+        self._changes = 0
+
+    @property
+    def loaded(self):
+        return self._by_name is not None
+
+    def load(self, get_all_fun, *args):
+        """
+        Get all the mailboxes, listing them with get_all_fun if the catalogue
+        is not loaded.
+
+        :return: a deferred that will fire with a list of MailboxWrappers.
+        :rtype: Deferred
+        """
+        if self.loaded:
+            return defer.succeed(self.get_all())
+
+        changes = self._changes
+
+        def fill_catalogue(wrappers):
+            if self._changes == changes:
+                self._by_name = {}
+                self._by_uuid = {}
+                for wrapper in wrappers:
+                    self._add(wrapper)
+            return wrappers
+
+        d = defer.maybeDeferred(get_all_fun, *args)
+        d.addCallback(fill_catalogue)
+        return d
+
+    def get_all(self):
+        return sorted(self._by_name.values(), key=lambda w: w.mbox)
+
+    def get(self, name):
+        """
+        :return: the MailboxWrapper with this name, or None if it is not in
+                 the catalogue.
+        """
+        if not self.loaded:
+            return None
+        return self._by_name.get(normalize_mailbox(name))
+
+    def get_by_uuid(self, mbox_uuid):
+        return self._by_uuid.get(mbox_uuid)
+
+    def add(self, wrapper):
+        """
+        Add a created mailbox to the catalogue, if it is loaded.
+        """
+        self._changes += 1
+        if self.loaded:
+            self._add(wrapper)
+
+    def _add(self, wrapper):
+        self._by_name[normalize_mailbox(wrapper.mbox)] = wrapper
+        if wrapper.uuid:
+            self._by_uuid[wrapper.uuid] = wrapper
+
+    def remove(self, name):
+        """
+        Remove a deleted mailbox from the catalogue.
+        """
+        self._changes += 1
+        if self.loaded:
+            wrapper = self._by_name.pop(normalize_mailbox(name), None)
+            if wrapper is not None:
+                self._by_uuid.pop(wrapper.uuid, None)
+
+    def rename(self, oldname, newname):
+        """
+        Index a renamed mailbox by its new name.
+        """
+        self._changes += 1
+        if self.loaded:
+            wrapper = self._by_name.pop(normalize_mailbox(oldname), None)
+            if wrapper is not None:
+                self._by_name[normalize_mailbox(newname)] = wrapper
+
+    def invalidate(self):
+        """
+        Forget all the mailboxes, so that they are listed again from the store
+        the next time they are needed.
+        """
+        self._changes += 1
+        self._by_name = None
+        self._by_uuid = {}
+
+
 class MessageCollection(object):
 
     """
@@ -368,12 +565,27 @@ class MessageCollection(object):
     store = None
     messageklass = Message
 
-    def __init__(self, adaptor, store, mbox_indexer=None, mbox_wrapper=None):
+    # When more than this fraction of the messages of the mailbox is
+    # requested, the flags are retrieved for the whole mailbox with a single
+    # index query.
+    bulk_flags_ratio = 0.5
+
+    def __init__(self, adaptor, store, mbox_indexer=None, mbox_wrapper=None,
+                 counters=None, search_indexer=None):
         """
         Constructor for a MessageCollection.
+
+        :param counters: optional, the MailboxCounters to cache the counts
+                         of this collection in.
+        :type counters: MailboxCounters
+        :param search_indexer: optional, the SearchIndexer to keep the
+                               messages of this collection searchable.
+        :type search_indexer: SearchIndexer
         """
         self.adaptor = adaptor
         self.store = store
+        self.counters = counters
+        self.search_indexer = search_indexer
 
         # XXX think about what to do when there is no mbox passed to
         # the initialization. We could still get the MetaMsg by index, instead
@@ -426,24 +638,25 @@ class MessageCollection(object):
             # pointers-to-docs.
             raise NotImplementedError()
 
-        metamsg_id = _get_mdoc_id(self.mbox_name, chash)
-
-        return self.adaptor.get_msg_from_mdoc_id(
-            self.messageklass, self.store,
-            metamsg_id, get_cdocs=get_cdocs)
+        metamsg_id = _get_mdoc_id(self.mbox_uuid, chash)
+        return self.get_message_by_doc_id(metamsg_id, get_cdocs=get_cdocs)
 
     def get_message_by_sequence_number(self, msn, get_cdocs=False):
         """
-        Retrieve a message by its Message Sequence Number.
+        Retrieve a message by its Message Sequence Number, in the order of
+        the uids of the messages in the mailbox now.
+
+        The IMAP sessions resolve the numbers of a client against the
+        messages that it knows about instead.
         :rtype: Deferred
         """
-        def get_uid_for_msn(all_uid):
-            return all_uid[msn - 1]
-        d = self.all_uid_iter()
-        d.addCallback(get_uid_for_msn)
-        d.addCallback(
-            lambda uid: self.get_message_by_uid(
-                uid, get_cdocs=get_cdocs))
+        def get_message(uid):
+            if uid is None:
+                return None
+            return self.get_message_by_uid(uid, get_cdocs=get_cdocs)
+
+        d = self.mbox_indexer.get_uid_from_msn(self.mbox_uuid, msn)
+        d.addCallback(get_message)
         d.addErrback(self.log.error('Error getting msg by seq'))
         return d
 
@@ -463,15 +676,52 @@ class MessageCollection(object):
 
         get_doc_fun = self.mbox_indexer.get_doc_id_from_uid
 
-        def get_msg_from_mdoc_id(doc_id):
-            if doc_id is None:
-                return None
-            return self.adaptor.get_msg_from_mdoc_id(
-                self.messageklass, self.store,
-                doc_id, uid=uid, get_cdocs=get_cdocs)
-
         d = get_doc_fun(self.mbox_uuid, uid)
-        d.addCallback(get_msg_from_mdoc_id)
+        d.addCallback(
+            self.get_message_by_doc_id, uid=uid, get_cdocs=get_cdocs)
+        return d
+
+    def get_message_by_doc_id(self, doc_id, uid=None, get_cdocs=False):
+        """
+        Retrieve a message by the doc_id of its MetaMsg document.
+
+        Use this when the doc_id has already been resolved from the UID
+        table, to avoid a second lookup.
+        :rtype: Deferred
+        """
+        if doc_id is None:
+            return defer.succeed(None)
+        return self.adaptor.get_msg_from_mdoc_id(
+            self.messageklass, self.store,
+            doc_id, uid=uid, get_cdocs=get_cdocs)
+
+    def get_messages_by_doc_ids(self, pairs, get_hdoc=True, get_cdocs=False):
+        """
+        Retrieve several messages at once, by the doc_ids of their MetaMsg
+        documents.
+
+        :param pairs: an iterable of (uid, doc_id) tuples, as returned by
+                      `get_doc_ids_from_uids`.
+        :param get_hdoc: whether to retrieve the header documents.
+        :param get_cdocs: whether to retrieve the content documents.
+        :return: a Deferred that will fire with a list of (uid, message)
+                 tuples, skipping the messages that could not be retrieved.
+        :rtype: Deferred
+        """
+        pairs = [(uid, doc_id) for (uid, doc_id) in pairs
+                 if doc_id is not None]
+        if not pairs:
+            return defer.succeed([])
+        uids, doc_ids = zip(*pairs)
+
+        def pair_with_uids(msgs):
+            return [(uid, msg) for (uid, msg) in zip(uids, msgs)
+                    if msg is not None]
+
+        d = self.adaptor.get_msgs_from_mdoc_ids(
+            self.messageklass, self.store,
+            doc_ids, uids=uids, get_hdoc=get_hdoc, get_cdocs=get_cdocs)
+        d.addCallback(pair_with_uids)
         return d
 
     def get_flags_by_uid(self, uid, absolute=True):
@@ -479,20 +729,70 @@ class MessageCollection(object):
         if not absolute:
             raise NotImplementedError("Does not support relative ids yet")
 
-        def get_flags_from_mdoc_id(doc_id):
-            if doc_id is None:  # XXX needed? or bug?
-                return None
-            return self.adaptor.get_flags_from_mdoc_id(
-                self.store, doc_id)
+        d = self.mbox_indexer.get_doc_id_from_uid(self.mbox_uuid, uid)
+        d.addCallback(lambda doc_id: self.get_flags_by_doc_id(doc_id, uid))
+        return d
 
+    def get_flags_by_doc_id(self, doc_id, uid):
+        """
+        Get the flags for the message with the given MetaMsg doc_id.
+
+        :return: a Deferred that will fire with a (uid, flags) tuple.
+        :rtype: Deferred
+        """
         def wrap_in_tuple(flags):
             return (uid, flags)
 
-        d = self.mbox_indexer.get_doc_id_from_uid(self.mbox_uuid, uid)
-        d.addCallback(get_flags_from_mdoc_id)
+        if doc_id is None:  # XXX needed? or bug?
+            return defer.succeed((uid, None))
+        d = self.adaptor.get_flags_from_mdoc_id(self.store, doc_id)
         d.addCallback(wrap_in_tuple)
         return d
 
+    def get_flags_by_doc_ids(self, pairs):
+        """
+        Get the flags for several messages at once.
+
+        For sets that cover most of the mailbox (like the 1:* FLAGS query
+        that the MUAs issue at the beginning of a session) the flags documents
+        for the whole mailbox are retrieved with a single index query, and
+        joined with the passed doc_ids by content hash. Smaller sets are
+        retrieved one by one, see `bulk_flags_ratio`.
+
+        :param pairs: an iterable of (uid, doc_id) tuples, as returned by
+                      `get_doc_ids_from_uids`.
+        :return: a Deferred that will fire with a list of (uid, flags)
+                 tuples.
+        :rtype: Deferred
+        """
+        pairs = list(pairs)
+
+        def get_flags(count):
+            if len(pairs) <= count * self.bulk_flags_ratio:
+                return defer.gatherResults([
+                    self.get_flags_by_doc_id(doc_id, uid)
+                    for (uid, doc_id) in pairs])
+            d = self.adaptor.get_all_flags_by_chash(
+                self.store, self.mbox_uuid)
+            d.addCallback(join_by_chash)
+            return d
+
+        def join_by_chash(flags_by_chash):
+            result = []
+            for uid, doc_id in pairs:
+                if doc_id is None:
+                    result.append((uid, None))
+                    continue
+                chash = re.findall(METAMSGID_CHASH_RE, doc_id)[0]
+                result.append((uid, flags_by_chash.get(chash, [])))
+            return result
+
+        if not pairs:
+            return defer.succeed([])
+        d = self.count()
+        d.addCallback(get_flags)
+        return d
+
     def count(self):
         """
         Count the messages in this collection.
@@ -502,8 +802,8 @@ class MessageCollection(object):
         if not self.is_mailbox_collection():
             raise NotImplementedError()
 
-        d = self.mbox_indexer.count(self.mbox_uuid)
-        return d
+        return self._get_counter(
+            MailboxCounters.MESSAGES, self.mbox_indexer.count, self.mbox_uuid)
 
     def count_recent(self):
         """
@@ -513,7 +813,9 @@ class MessageCollection(object):
         """
         if not self.is_mailbox_collection():
             raise NotImplementedError()
-        return self.adaptor.get_count_recent(self.store, self.mbox_uuid)
+        return self._get_counter(
+            MailboxCounters.RECENT, self.adaptor.get_count_recent,
+            self.store, self.mbox_uuid)
 
     def count_unseen(self):
         """
@@ -523,7 +825,9 @@ class MessageCollection(object):
         """
         if not self.is_mailbox_collection():
             raise NotImplementedError()
-        return self.adaptor.get_count_unseen(self.store, self.mbox_uuid)
+        return self._get_counter(
+            MailboxCounters.UNSEEN, self.adaptor.get_count_unseen,
+            self.store, self.mbox_uuid)
 
     def get_uid_next(self):
         """
@@ -532,7 +836,29 @@ class MessageCollection(object):
         :return: a Deferred that will fire with the integer for the next uid.
         :rtype: Deferred
         """
-        return self.mbox_indexer.get_next_uid(self.mbox_uuid)
+        return self._get_counter(
+            MailboxCounters.UIDNEXT, self.mbox_indexer.get_next_uid,
+            self.mbox_uuid)
+
+    def _get_counter(self, name, count_fun, *args):
+        if self.counters is None:
+            return count_fun(*args)
+        return self.counters.get(self.mbox_uuid, name, count_fun, *args)
+
+    def _update_counters(self, messages=0, unseen=0, recent=0, uidnext=0):
+        if self.counters is None:
+            return
+        for name, delta in ((MailboxCounters.MESSAGES, messages),
+                            (MailboxCounters.UNSEEN, unseen),
+                            (MailboxCounters.RECENT, recent),
+                            (MailboxCounters.UIDNEXT, uidnext)):
+            if delta:
+                self.counters.update(self.mbox_uuid, name, delta)
+
+    def _invalidate_counters(self, *names):
+        if self.counters is None:
+            return
+        self.counters.invalidate(self.mbox_uuid, *names)
 
     def get_last_uid(self):
         """
@@ -546,6 +872,59 @@ class MessageCollection(object):
         """
         return self.mbox_indexer.all_uid_iter(self.mbox_uuid)
 
+    def get_doc_ids_from_uids(self, uids):
+        """
+        Get the (uid, mdoc_id) pairs for the existing messages in a set of
+        UIDs.
+
+        :param uids: a MessageSet, or an iterable of UIDs.
+        :return: a Deferred that will fire with a list of tuples, sorted by
+                 uid.
+        :rtype: Deferred
+        """
+        return self.mbox_indexer.get_doc_ids_from_uids(self.mbox_uuid, uids)
+
+    # Modification sequences (rfc 7162). The indexer gives a new modseq to
+    # the messages that it inserts or deletes, so only the changes in the
+    # flags have to be signaled.
+
+    def get_highest_modseq(self):
+        """
+        Get the highest modseq for this mailbox.
+        """
+        return self.mbox_indexer.get_highest_modseq(self.mbox_uuid)
+
+    def get_modseqs(self, uids=None, changedsince=None):
+        """
+        Get the (uid, modseq) pairs for the messages in a set of UIDs, or in
+        the whole mailbox.
+
+        :param uids: optional, a MessageSet or an iterable of UIDs.
+        :param changedsince: optional, return only the messages that changed
+                             after this modseq.
+        :type changedsince: int
+        :return: a Deferred that will fire with a list of tuples, sorted by
+                 uid.
+        :rtype: Deferred
+        """
+        return self.mbox_indexer.get_modseqs(
+            self.mbox_uuid, uids, changedsince)
+
+    def get_expunged(self, changedsince, uids=None):
+        """
+        Get the UIDs of the messages expunged from this mailbox after a given
+        modseq.
+
+        :param changedsince: the modseq.
+        :type changedsince: int
+        :param uids: optional, a MessageSet or an iterable of UIDs to restrict
+                     the search to.
+        :return: a Deferred that will fire with the sorted list of uids.
+        :rtype: Deferred
+        """
+        return self.mbox_indexer.get_expunged(
+            self.mbox_uuid, changedsince, uids)
+
     def get_uid_from_msgid(self, msgid):
         """
         Return the UID(s) of the matching msg-ids for this mailbox collection.
@@ -565,6 +944,94 @@ class MessageCollection(object):
         d.addCallback(get_uid)
         return d
 
+    @defer.inlineCallbacks
+    def search(self, query, uids):
+        """
+        Search the messages of this mailbox collection.
+
+        The messages that are not in the search index yet (because they came
+        with a sync, for instance) are indexed first.
+
+        :param query: the IMAP search keys.
+        :type query: list
+        :param uids: the sorted uids that the sequence numbers refer to.
+        :type uids: list or MessageSequence
+        :return: a deferred that will fire with the sorted list of the uids
+                 of the matching messages.
+        :rtype: Deferred
+        """
+        yield self._index_unindexed()
+        result = yield self.search_indexer.search(
+            self.mbox_uuid, query, uids)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def sort(self, criteria, query, uids):
+        """
+        Search the messages of this mailbox collection, and sort the result
+        by the given criteria (rfc 5256).
+
+        :param criteria: the sort criteria.
+        :type criteria: list
+        :param query: the IMAP search keys.
+        :type query: list
+        :param uids: the sorted uids that the sequence numbers refer to.
+        :type uids: list or MessageSequence
+        :return: a deferred that will fire with the sorted list of the uids
+                 of the matching messages.
+        :rtype: Deferred
+        """
+        yield self._index_unindexed()
+        result = yield self.search_indexer.sort(
+            self.mbox_uuid, criteria, query, uids)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def thread(self, algorithm, query, uids):
+        """
+        Search the messages of this mailbox collection, and thread the
+        result with the given algorithm (rfc 5256).
+
+        :param algorithm: the threading algorithm.
+        :type algorithm: str
+        :param query: the IMAP search keys.
+        :type query: list
+        :param uids: the sorted uids that the sequence numbers refer to.
+        :type uids: list or MessageSequence
+        :return: a deferred that will fire with the threads of the uids of
+                 the matching messages.
+        :rtype: Deferred
+        """
+        yield self._index_unindexed()
+        result = yield self.search_indexer.thread(
+            self.mbox_uuid, algorithm, query, uids)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _index_unindexed(self):
+        if not self.is_mailbox_collection() or self.search_indexer is None:
+            raise NotImplementedError()
+
+        # the documents of the unindexed messages are loaded a window at a
+        # time, so that a big mailbox does not have all its bodies in memory.
+        pairs = yield self.search_indexer.get_unindexed(self.mbox_uuid)
+        step = self.search_indexer.max_index_msgs
+        for i in range(0, len(pairs), step):
+            msgs = yield self.get_messages_by_doc_ids(
+                pairs[i:i + step], get_cdocs=True)
+            yield self.search_indexer.index_msgs(
+                [msg.get_wrapper() for (uid, msg) in msgs])
+
+    def _update_search_index(self, method, *args):
+        # the search index can always be rebuilt, so an error there is not
+        # fatal for the operation on the messages.
+        if self.search_indexer is None:
+            return defer.succeed(None)
+        d = getattr(self.search_indexer, method)(*args)
+        d.addErrback(lambda f: self.log.failure(
+            'Error updating the search index', f))
+        return d
+
     # Manipulate messages
 
     @defer.inlineCallbacks
@@ -588,35 +1055,94 @@ class MessageCollection(object):
         """
         # TODO watch out if the use of this method in IMAP COPY/APPEND is
         # passing the right date.
+        results = yield self._add_msgs([raw_msg], flags, tags, date)
+        result = results[0]
+        if isinstance(result, failure.Failure):
+            result.raiseException()
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def add_msgs(self, raw_msgs, flags=tuple(), tags=tuple(), date=""):
+        """
+        Add several messages to this collection, in a single batch.
+
+        The documents for all the messages are written together, the uids
+        are assigned in bulk (in the same order than raw_msgs), and the
+        unread signal and the notification to the listeners are emitted only
+        once for the whole batch.
+
+        :param raw_msgs: an iterable with the raw messages
+        :param flags: tuple of flags for every message
+        :param tags: tuple of tags for every message
+        :param date:
+            formatted date, it will be used to retrieve the internal
+            date for every message. See `add_msg`.
+        :type date: str
+
+        :returns: a deferred that will fire with a list with a Message for
+                  every raw message, in the same order, or None for the ones
+                  that could not be parsed or stored. It fails if the
+                  messages cannot be indexed in the mailbox.
+        :rtype: deferred
+        """
+        results = yield self._add_msgs(raw_msgs, flags, tags, date)
+        msgs = []
+        for result in results:
+            if isinstance(result, failure.Failure):
+                self.log.failure('Error adding message', result)
+                result = None
+            msgs.append(result)
+        defer.returnValue(msgs)
+
+    @defer.inlineCallbacks
+    def _add_msgs(self, raw_msgs, flags, tags, date):
+        # returns a Message, or the Failure of the message, for every one of
+        # the raw messages.
+
         # XXX mdoc ref is a leaky abstraction here. generalize, that SHOULD be
         # moved inside soledad adaptor.
         leap_assert_type(flags, tuple)
         leap_assert_type(date, str)
 
-        msg = self.adaptor.get_msg_from_string(Message, raw_msg)
-        wrapper = msg.get_wrapper()
-
         if not self.is_mailbox_collection():
             raise NotImplementedError()
 
+        results = yield defer.DeferredList([
+            self.adaptor.get_msg_from_string_async(Message, raw_msg)
+            for raw_msg in raw_msgs], consumeErrors=True)
+        results = [result for (_, result) in results]
+        parsed = [
+            (i, msg) for (i, msg) in enumerate(results)
+            if not isinstance(msg, failure.Failure)]
+        if not parsed:
+            defer.returnValue(results)
+
         mbox_id = self.mbox_uuid
         assert mbox_id is not None
-        wrapper.set_mbox_uuid(mbox_id)
-        wrapper.set_flags(flags)
-        wrapper.set_tags(tags)
-        wrapper.set_date(date)
+        for _, msg in parsed:
+            wrapper = msg.get_wrapper()
+            wrapper.set_mbox_uuid(mbox_id)
+            wrapper.set_flags(flags)
+            wrapper.set_tags(tags)
+            wrapper.set_date(date)
 
         try:
-            updated_wrapper = yield wrapper.create(self.store)
-            doc_id = updated_wrapper.mdoc.doc_id
-            if not doc_id:
-                doc_id = updated_wrapper.mdoc.future_doc_id
-            assert doc_id
-
+            doc_ids = yield self.adaptor.create_msgs(
+                self.store, [msg for (_, msg) in parsed])
         except Exception:
-            self.log.failure('Error creating message')
+            self.log.failure('Error creating messages')
             raise
 
+        stored = []
+        for (i, msg), doc_id in zip(parsed, doc_ids):
+            if doc_id:
+                stored.append((i, msg, doc_id))
+            else:
+                results[i] = failure.Failure(
+                    MessageStorageError('The message could not be stored'))
+        if not stored:
+            defer.returnValue(results)
+
         # XXX BUG sometimes the table is not yet created,
         # so workaround is to make sure we always check for it before
         # inserting the doc. I should debug into the real cause.
@@ -625,25 +1151,89 @@ class MessageCollection(object):
         # indexer.
         try:
             yield self.mbox_indexer.create_table(self.mbox_uuid)
-            uid = yield self.mbox_indexer.insert_doc(self.mbox_uuid, doc_id)
+            last_uid = yield self.mbox_indexer.get_last_uid(self.mbox_uuid)
+            uids = yield self.mbox_indexer.insert_docs(
+                self.mbox_uuid, [doc_id for (_, _, doc_id) in stored])
         except Exception:
-            self.log.failure('Error indexing message')
-        else:
-            self.cb_signal_unread_to_ui()
-            self.notify_new_to_listeners()
-            defer.returnValue(Message(wrapper, uid))
+            self.log.failure('Error indexing messages')
+            self._invalidate_counters()
+            raise
+
+        # the messages that were already in the mailbox keep their uid, and
+        # they are not counted again.
+        new_fdocs = []
+        new_uids = set()
+        for (i, msg, _), uid in zip(stored, uids):
+            results[i] = Message(msg.get_wrapper(), uid)
+            if uid > last_uid and uid not in new_uids:
+                new_uids.add(uid)
+                new_fdocs.append(msg.get_wrapper().fdoc)
+
+        yield self._update_search_index(
+            'index_msgs', [msg.get_wrapper() for (_, msg, _) in stored])
+        self._update_counters(
+            messages=len(new_fdocs),
+            unseen=sum(int(not fdoc.seen) for fdoc in new_fdocs),
+            recent=sum(int(fdoc.recent) for fdoc in new_fdocs),
+            uidnext=len(new_fdocs))
+        self.cb_signal_unread_to_ui()
+        self.notify_new_to_listeners(sorted(new_uids))
+        defer.returnValue(results)
 
     # Listeners
 
+    # A listener is notified of the new messages with notify_new(), or with
+    # notify_added(uids) if it implements it and the uids are known. The
+    # listeners that want to know about the expunged messages and the flags
+    # implement notify_expunged(uids) and notify_flags(flags), where flags
+    # is a dict mapping uids to the new flags of the messages.
+
     def addListener(self, listener):
         self._listeners.add(listener)
 
     def removeListener(self, listener):
         self._listeners.remove(listener)
 
-    def notify_new_to_listeners(self):
-        for listener in self._listeners:
-            listener.notify_new()
+    def notify_new_to_listeners(self, uids=None):
+        for listener in list(self._listeners):
+            if uids is not None and hasattr(listener, 'notify_added'):
+                listener.notify_added(uids)
+            else:
+                listener.notify_new()
+
+    def notify_expunged_to_listeners(self, uids):
+        self._notify_listeners('notify_expunged', uids)
+
+    def notify_flags_to_listeners(self, flags):
+        self._notify_listeners('notify_flags', flags)
+
+    def notify_synced_flags(self, doc_ids):
+        """
+        Notify the listeners about the flags of several messages that changed
+        in a sync.
+
+        :param doc_ids: the doc_ids of the MetaMsg documents of the messages.
+        :type doc_ids: list
+        :return: a deferred that will fire when the listeners are notified.
+        :rtype: Deferred
+        """
+        if not any(hasattr(listener, 'notify_flags')
+                   for listener in self._listeners):
+            return defer.succeed(None)
+        d = self.mbox_indexer.get_uids_from_doc_ids(self.mbox_uuid, doc_ids)
+        d.addCallback(self.get_flags_by_doc_ids)
+        d.addCallback(lambda flags: self.notify_flags_to_listeners(dict(
+            (uid, tuple(flags)) for (uid, flags) in flags
+            if flags is not None)))
+        return d
+
+    def _notify_listeners(self, name, *args):
+        # the listeners of other users of the collection might only know
+        # about the new messages.
+        for listener in list(self._listeners):
+            notify = getattr(listener, name, None)
+            if notify is not None:
+                notify(*args)
 
     def cb_signal_unread_to_ui(self, *args):
         """
@@ -715,15 +1305,74 @@ class MessageCollection(object):
 
             d = self.mbox_indexer.create_table(new_mbox_uuid)
             d.addBoth(insert_doc, new_mbox_uuid, doc_id)
+            d.addCallback(lambda result: self._update_search_index(
+                'copy_entries', [wrapper.mdoc.doc_id], [doc_id]).addCallback(
+                    lambda _: result))
             return d
 
+        def invalidate_counters(result):
+            # the copy can replace an existing message in the target
+            # mailbox, so its counters are counted again.
+            if self.counters is not None:
+                self.counters.invalidate(new_mbox_uuid)
+            return result
+
         wrapper = msg.get_wrapper()
 
         d = wrapper.copy(self.store, new_mbox_uuid)
         d.addCallback(insert_copied_mdoc_id)
+        d.addBoth(invalidate_counters)
         d.addCallback(lambda _: self.notify_new_to_listeners())
         return d
 
+    def copy_msgs(self, doc_ids, new_mbox_uuid):
+        """
+        Copy several messages to another collection, in bulk. (it only makes
+        sense for mailbox collections)
+
+        The copies get new uids in the target mailbox, assigned in the same
+        order as the doc_ids, even if a message was already there.
+
+        :param doc_ids: the doc_ids of the MetaMsg documents of the messages.
+        :type doc_ids: list
+        :param new_mbox_uuid: the uuid of the target mailbox.
+        :type new_mbox_uuid: str
+        :return: a deferred that will fire with the uids of the copies.
+        :rtype: Deferred
+        """
+        if not self.is_mailbox_collection():
+            raise NotImplementedError()
+
+        indexer = self.mbox_indexer
+
+        def index_copies(new_doc_ids):
+            d = indexer.create_table(new_mbox_uuid)
+            # the messages that were already in the target mailbox get a new
+            # uid, like with copy_msg.
+            d.addCallback(lambda _: indexer.delete_docs_by_hash(
+                new_mbox_uuid, new_doc_ids))
+            d.addCallback(lambda _: indexer.insert_docs(
+                new_mbox_uuid, new_doc_ids))
+            d.addCallback(lambda uids: self._update_search_index(
+                'copy_entries', doc_ids, new_doc_ids).addCallback(
+                    lambda _: uids))
+            return d
+
+        def invalidate_counters(result):
+            if self.counters is not None:
+                self.counters.invalidate(new_mbox_uuid)
+            return result
+
+        def notify_new(uids):
+            self.notify_new_to_listeners(uids)
+            return uids
+
+        d = self.adaptor.copy_msgs(self.store, doc_ids, new_mbox_uuid)
+        d.addCallback(index_copies)
+        d.addBoth(invalidate_counters)
+        d.addCallback(notify_new)
+        return d
+
     def delete_msg(self, msg):
         """
         Delete this message.
@@ -732,41 +1381,72 @@ class MessageCollection(object):
 
         def delete_mdoc_id(_, wrapper):
             doc_id = wrapper.mdoc.doc_id
-            return self.mbox_indexer.delete_doc_by_hash(
-                self.mbox_uuid, doc_id)
+            d = self.mbox_indexer.delete_doc_by_hash(self.mbox_uuid, doc_id)
+            d.addCallback(lambda result: self._update_search_index(
+                'delete_entries', [doc_id]).addCallback(lambda _: result))
+            return d
+
+        def update_counters(result, fdoc):
+            self._update_counters(
+                messages=-1, unseen=-int(not fdoc.seen),
+                recent=-int(fdoc.recent))
+            if msg.get_uid() is not None:
+                self.notify_expunged_to_listeners([msg.get_uid()])
+            return result
+
         d = wrapper.delete(self.store)
         d.addCallback(delete_mdoc_id, wrapper)
+        d.addCallback(update_counters, wrapper.fdoc)
         return d
 
     def delete_all_flagged(self):
         """
         Delete all messages flagged as \\Deleted.
         Used from IMAPMailbox.expunge()
+
+        :return: a deferred that will fire with the sorted list of the uids
+                 of the deleted messages.
+        :rtype: Deferred
         """
-        def get_uid_list(hashes):
-            d = []
-            for h in hashes:
-                d.append(self.mbox_indexer.get_uid_from_doc_id(
-                         self.mbox_uuid, h))
-            return defer.gatherResults(d), hashes
+        mdocs_deleted = self.adaptor.del_all_flagged_messages(
+            self.store, self.mbox_uuid)
+        return self._delete_uid_entries(mdocs_deleted)
 
-        def delete_uid_entries((uids, hashes)):
-            d = []
-            for h in hashes:
-                d.append(self.mbox_indexer.delete_doc_by_hash(
-                         self.mbox_uuid, h))
+    def delete_msgs(self, doc_ids):
+        """
+        Delete several messages at once.
 
-            def return_uids_when_deleted(ignored):
-                return uids
+        :param doc_ids: the doc_ids of the MetaMsg documents of the messages.
+        :type doc_ids: list
+        :return: a deferred that will fire with the sorted list of the uids
+                 of the deleted messages.
+        :rtype: Deferred
+        """
+        mdocs_deleted = self.adaptor.del_msgs(self.store, doc_ids)
+        return self._delete_uid_entries(mdocs_deleted)
 
-            all_deleted = defer.gatherResults(d).addCallback(
-                return_uids_when_deleted)
-            return all_deleted
+    def _delete_uid_entries(self, mdocs_deleted):
+        def delete_uid_entries(hashes):
+            d = self.mbox_indexer.delete_docs_by_hash(self.mbox_uuid, hashes)
+            d.addCallback(update_message_counter)
+            d.addCallback(lambda uids: self._update_search_index(
+                'delete_entries', hashes).addCallback(lambda _: uids))
+            return d
+
+        def update_message_counter(uids):
+            self._update_counters(messages=-len(uids))
+            if uids:
+                self.notify_expunged_to_listeners(uids)
+            return uids
+
+        def invalidate_flag_counters(result):
+            # the flags of the deleted messages are not known here.
+            self._invalidate_counters(
+                MailboxCounters.UNSEEN, MailboxCounters.RECENT)
+            return result
 
-        mdocs_deleted = self.adaptor.del_all_flagged_messages(
-            self.store, self.mbox_uuid)
-        mdocs_deleted.addCallback(get_uid_list)
         mdocs_deleted.addCallback(delete_uid_entries)
+        mdocs_deleted.addBoth(invalidate_flag_counters)
         return mdocs_deleted
 
     # TODO should add a delete-by-uid to collection?
@@ -780,8 +1460,13 @@ class MessageCollection(object):
                 deferreds.append(d)
             return defer.gatherResults(deferreds)
 
+        def invalidate_counters(result):
+            self._invalidate_counters()
+            return result
+
         d = self.all_uid_iter()
         d.addCallback(del_all_uid)
+        d.addBoth(invalidate_counters)
         return d
 
     def update_flags(self, msg, flags, mode):
@@ -793,11 +1478,29 @@ class MessageCollection(object):
         newflags = map(str, self._update_flags_or_tags(current, flags, mode))
         wrapper.fdoc.flags = newflags
 
+        was_seen = wrapper.fdoc.seen
         wrapper.fdoc.seen = MessageFlags.SEEN_FLAG in newflags
         wrapper.fdoc.deleted = MessageFlags.DELETED_FLAG in newflags
 
+        def update_counters(_):
+            self._update_counters(
+                unseen=int(was_seen) - int(wrapper.fdoc.seen))
+            if msg.get_uid() is not None:
+                self.notify_flags_to_listeners(
+                    {msg.get_uid(): tuple(newflags)})
+            return newflags
+
+        def bump_modseq(_):
+            if not self.is_mailbox_collection():
+                return
+            return self.mbox_indexer.bump_modseq(
+                self.mbox_uuid, [wrapper.mdoc.doc_id])
+
         d = self.adaptor.update_msg(self.store, msg)
-        d.addCallback(lambda _: newflags)
+        d.addCallback(lambda _: self._update_search_index(
+            'update_flags', wrapper.mdoc.doc_id, newflags))
+        d.addCallback(bump_modseq)
+        d.addCallback(update_counters)
         return d
 
     def update_tags(self, msg, tags, mode):
@@ -857,12 +1560,30 @@ class Account(object):
     # tree we can let it be an instance attribute.
     _collection_mapping = defaultdict(weakref.WeakValueDictionary)
 
+    # The counters of the mailboxes, indexed by userid. They are shared for
+    # the same reason.
+    _counters_mapping = defaultdict(MailboxCounters)
+
+    # The caches of content documents, indexed by userid, so that the bodies
+    # fetched by any of the users of the account are retrieved only once.
+    _cdoc_cache_mapping = defaultdict(ContentDocCache)
+
+    # The Account instances shared by the imap sessions, the incoming mail
+    # service and the bouncer, indexed by userid. See `Account.acquire`.
+    _shared_accounts = {}
+    _refs = 0
+
     def __init__(self, store, user_id, ready_cb=None):
         self.store = store
         self.user_id = user_id
         self.adaptor = self.adaptor_class()
 
         self.mbox_indexer = MailboxIndexer(self.store)
+        self.search_indexer = SearchIndexer(self.store)
+        self.mbox_counters = self._counters_mapping[user_id]
+        self.mbox_catalogue = MailboxCatalogue()
+        self.cdoc_cache = self._cdoc_cache_mapping[user_id]
+        self.adaptor.cdoc_cache = self.cdoc_cache
 
         # This flag is only used from the imap service for the moment.
         # In the future, we should prevent any public method to continue if
@@ -897,9 +1618,20 @@ class Account(object):
         """
         Execute the callback when the initialization of the Account is ready.
         Note that the callback will receive a first meaningless parameter.
+
+        Every caller gets its own deferred, so that the result (or the
+        failure) of a callback is not passed to the callbacks of the other
+        users of a shared Account.
         """
-        self.deferred_initialization.addCallback(cb, *args, **kw)
-        return self.deferred_initialization
+        d = defer.Deferred()
+
+        def fire(result):
+            d.callback(result)
+            return result
+
+        self.deferred_initialization.addCallback(fire)
+        d.addCallback(cb, *args, **kw)
+        return d
 
     # Sync hooks
 
@@ -907,7 +1639,7 @@ class Account(object):
         soledad_sync_hooks.post_sync_uid_reindexer.set_account(self)
 
     def _teardown_sync_hooks(self):
-        soledad_sync_hooks.post_sync_uid_reindexer.set_account(None)
+        soledad_sync_hooks.post_sync_uid_reindexer.unset_account(self)
 
     #
     # Public API Starts
@@ -923,12 +1655,43 @@ class Account(object):
         return d
 
     def get_all_mailboxes(self):
+        return self.mbox_catalogue.load(self._get_all_mailboxes)
+
+    def _get_all_mailboxes(self):
+
+        # the collections that are alive keep their own wrapper, share it so
+        # that changes to the mailbox attributes are seen in the catalogue.
+        def use_collection_wrappers(wrappers):
+            collections = self._collection_mapping[self.user_id]
+            shared = []
+            for wrapper in wrappers:
+                collection = collections.get(wrapper.mbox)
+                if collection is not None and collection.mbox_wrapper:
+                    wrapper = collection.mbox_wrapper
+                shared.append(wrapper)
+            return shared
+
         d = self.adaptor.get_all_mboxes(self.store)
+        d.addCallback(use_collection_wrappers)
+        return d
+
+    def _get_or_create_mbox(self, name):
+        wrapper = self.mbox_catalogue.get(name)
+        if wrapper is not None:
+            return defer.succeed(wrapper)
+
+        def add_to_catalogue(wrapper):
+            self.mbox_catalogue.add(wrapper)
+            return wrapper
+
+        d = self.adaptor.get_or_create_mbox(self.store, name)
+        d.addCallback(add_to_catalogue)
         return d
 
     def add_mailbox(self, name, creation_ts=None):
-        return self.adaptor.atomic.run(
-            self._add_mailbox, name, creation_ts=creation_ts)
+        return self.adaptor.run_with_mbox_lock(
+            self.store, (name,), self._add_mailbox, name,
+            creation_ts=creation_ts)
 
     def _add_mailbox(self, name, creation_ts=None):
 
@@ -958,31 +1721,47 @@ class Account(object):
             d.addCallback(lambda _: wrapper)
             return d
 
-        d = self.adaptor.get_or_create_mbox(self.store, name)
+        d = self._get_or_create_mbox(name)
         d.addCallback(set_creation_ts)
         d.addCallback(create_uuid)
         d.addCallback(create_uid_table_cb)
+        d.addCallback(self._add_to_catalogue)
         return d
 
+    def _add_to_catalogue(self, wrapper):
+        # the uuid might have been created after the mailbox was added to the
+        # catalogue.
+        self.mbox_catalogue.add(wrapper)
+        return wrapper
+
     def delete_mailbox(self, name):
-        return self.adaptor.atomic.run(
-            self._delete_mailbox, name)
+        return self.adaptor.run_with_mbox_lock(
+            self.store, (name,), self._delete_mailbox, name)
 
     def _delete_mailbox(self, name):
 
         def delete_uid_table_cb(wrapper):
+            self.mbox_counters.invalidate(wrapper.uuid)
             d = self.mbox_indexer.delete_table(wrapper.uuid)
+            d.addCallback(
+                lambda _: self.search_indexer.delete_mailbox(wrapper.uuid))
             d.addCallback(lambda _: wrapper)
             return d
 
-        d = self.adaptor.get_or_create_mbox(self.store, name)
+        def remove_from_catalogue(result):
+            self.mbox_catalogue.remove(name)
+            return result
+
+        d = self._get_or_create_mbox(name)
         d.addCallback(delete_uid_table_cb)
         d.addCallback(
             lambda wrapper: self.adaptor.delete_mbox(self.store, wrapper))
+        d.addCallback(remove_from_catalogue)
         return d
 
     def rename_mailbox(self, oldname, newname):
-        return self.adaptor.atomic.run(
+        return self.adaptor.run_with_mbox_lock(
+            self.store, (oldname, newname),
             self._rename_mailbox, oldname, newname)
 
     def _rename_mailbox(self, oldname, newname):
@@ -993,10 +1772,32 @@ class Account(object):
             d.addCallback(lambda result: wrapper)
             return d
 
-        d = self.adaptor.get_or_create_mbox(self.store, oldname)
+        def rename_in_catalogue(wrapper):
+            self.mbox_catalogue.rename(oldname, newname)
+            return wrapper
+
+        d = self._get_or_create_mbox(oldname)
         d.addCallback(_rename_mbox)
+        d.addCallback(rename_in_catalogue)
         return d
 
+    @defer.inlineCallbacks
+    def index_msgs_for_search(self, mdoc_ids):
+        """
+        Add several messages to the search index, retrieving their documents
+        from the store, `max_index_msgs` messages at a time.
+
+        :param mdoc_ids: the doc_ids of the MetaMsgs of the messages.
+        :type mdoc_ids: list
+        :rtype: Deferred
+        """
+        step = self.search_indexer.max_index_msgs
+        for i in range(0, len(mdoc_ids), step):
+            msgs = yield self.adaptor.get_msgs_from_mdoc_ids(
+                Message, self.store, mdoc_ids[i:i + step], get_cdocs=True)
+            yield self.search_indexer.index_msgs(
+                [msg.get_wrapper() for msg in msgs if msg is not None])
+
     # Get Collections
 
     def get_collection_by_mailbox(self, name):
@@ -1004,8 +1805,8 @@ class Account(object):
         :rtype: deferred
         :return: a deferred that will fire with a MessageCollection
         """
-        return self.adaptor.atomic.run(
-            self._get_collection_by_mailbox, name)
+        return self.adaptor.run_with_mbox_lock(
+            self.store, (name,), self._get_collection_by_mailbox, name)
 
     def _get_collection_by_mailbox(self, name):
         collection = self._collection_mapping[self.user_id].get(
@@ -1016,14 +1817,27 @@ class Account(object):
         # imap select will use this, passing the collection to SoledadMailbox
         def get_collection_for_mailbox(mbox_wrapper):
             collection = MessageCollection(
-                self.adaptor, self.store, self.mbox_indexer, mbox_wrapper)
+                self.adaptor, self.store, self.mbox_indexer, mbox_wrapper,
+                counters=self.mbox_counters,
+                search_indexer=self.search_indexer)
             self._collection_mapping[self.user_id][name] = collection
             return collection
 
-        d = self.adaptor.get_or_create_mbox(self.store, name)
+        d = self._get_or_create_mbox(name)
         d.addCallback(get_collection_for_mailbox)
         return d
 
+    def get_open_collection(self, mbox_uuid):
+        """
+        Get the collection of a mailbox if some user of the account has it
+        open, without creating it.
+
+        :return: a MessageCollection, or None
+        """
+        for collection in self._collection_mapping[self.user_id].values():
+            if collection.mbox_uuid == mbox_uuid:
+                return collection
+
     def get_collection_by_docs(self, docs):
         """
         :rtype: MessageCollection
@@ -1053,6 +1867,47 @@ class Account(object):
         d.addCallback(get_msg_from_mdoc)
         return d
 
+    # Shared instances
+
+    @classmethod
+    def acquire(cls, store, user_id):
+        """
+        Get the Account shared by all the services of a user, creating it if
+        there is none for this store yet.
+
+        This avoids initializing the store, listing the mailboxes and
+        registering the sync hooks again for every imap login, and lets all
+        the users of the account share its collections and caches. Every call
+        has to be paired with a call to `release`.
+
+        If the store of the user changed (after logging in again, for
+        instance) a new Account replaces the shared one. The holders of the
+        old one can still use it and release it.
+
+        :param store: an instance of Soledad.
+        :param user_id: the identifier of the user.
+        :type user_id: str
+        :rtype: Account
+        """
+        account = cls._shared_accounts.get(user_id)
+        if account is None or account.store is not store:
+            account = cls(store, user_id)
+            cls._shared_accounts[user_id] = account
+        account._refs += 1
+        return account
+
+    def release(self):
+        """
+        Release a reference to a shared Account. The session of the account
+        is ended when nobody holds it anymore.
+        """
+        self._refs -= 1
+        if self._refs > 0:
+            return
+        if self._shared_accounts.get(self.user_id) is self:
+            del self._shared_accounts[self.user_id]
+        self.end_session()
+
     # Session handling
 
     def end_session(self):
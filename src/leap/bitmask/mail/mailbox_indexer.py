@@ -22,7 +22,10 @@ Local tables to store the message Unique Identifiers for a given mailbox.
 import re
 import uuid
 
+from twisted.internet import defer
+
 from leap.bitmask.mail.constants import METAMSGID_RE
+from leap.bitmask.mail.constants import SQLITE_MAX_VARIABLES
 
 
 def _maybe_first_query_item(thing):
@@ -75,6 +78,12 @@ class MailboxIndexer(object):
     3501), although they can be useful for other non-imap store
     implementations.
 
+    Next to the UID table, every mailbox has a table with the modification
+    sequence (rfc 7162) of its messages. It is a local-only counter that is
+    increased every time that messages are added, expunged or get their flags
+    changed, and the messages that were expunged are kept in it too, so that
+    the changes after a given modseq can be retrieved without looking at the
+    whole mailbox.
     """
     # The uids are expected to be 32-bits values, but the ROWIDs in sqlite
     # are 64-bit values. I *don't* think it really matters for any
@@ -83,9 +92,23 @@ class MailboxIndexer(object):
 
     store = None
     table_preffix = "leapmail_uid_"
+    modseq_table_preffix = "leapmail_modseq_"
+
+    # the modseq of the messages that were in the mailbox before their
+    # modseqs were kept, and the highest modseq of a mailbox without changes.
+    initial_modseq = 1
+
+    # how many ranges of a sequence set go into a single query, every range
+    # takes up to two values.
+    max_query_ranges = SQLITE_MAX_VARIABLES // 2
+
+    # how many documents go into a single insert or delete
+    max_insert_docs = 400
 
     def __init__(self, store):
         self.store = store
+        # the tables that we know that already exist
+        self._tables = set()
 
     def _query(self, *args, **kw):
         assert self.store is not None
@@ -103,11 +126,33 @@ class MailboxIndexer(object):
         :rtype: Deferred
         """
         check_good_uuid(mailbox_uuid)
+        name = sanitize(mailbox_uuid)
+        if name in self._tables:
+            return defer.succeed(None)
+
+        def remember_table(result):
+            self._tables.add(name)
+            return result
+
         sql = ("CREATE TABLE if not exists {preffix}{name}( "
                "uid  INTEGER PRIMARY KEY AUTOINCREMENT, "
                "hash TEXT UNIQUE NOT NULL)".format(
-                   preffix=self.table_preffix, name=sanitize(mailbox_uuid)))
-        return self._operation(sql)
+                   preffix=self.table_preffix, name=name))
+        # the modseq table is created for the mailboxes that already had an
+        # UID table too.
+        sql_modseq = ("CREATE TABLE if not exists {preffix}{name}( "
+                      "uid INTEGER PRIMARY KEY, "
+                      "modseq INTEGER NOT NULL, "
+                      "expunged INTEGER NOT NULL DEFAULT 0)".format(
+                          preffix=self.modseq_table_preffix, name=name))
+        sql_index = ("CREATE INDEX if not exists {preffix}{name}_modseq "
+                     "ON {preffix}{name} (modseq)".format(
+                         preffix=self.modseq_table_preffix, name=name))
+        d = self._operation(sql)
+        d.addCallback(lambda _: self._operation(sql_modseq))
+        d.addCallback(lambda _: self._operation(sql_index))
+        d.addCallback(remember_table)
+        return d
 
     def delete_table(self, mailbox_uuid):
         """
@@ -117,9 +162,68 @@ class MailboxIndexer(object):
         :rtype: Deferred
         """
         check_good_uuid(mailbox_uuid)
+        self._tables.discard(sanitize(mailbox_uuid))
         sql = ("DROP TABLE if exists {preffix}{name}".format(
             preffix=self.table_preffix, name=sanitize(mailbox_uuid)))
-        return self._operation(sql)
+        sql_modseq = ("DROP TABLE if exists {preffix}{name}".format(
+            preffix=self.modseq_table_preffix, name=sanitize(mailbox_uuid)))
+        d = self._operation(sql)
+        d.addCallback(lambda _: self._operation(sql_modseq))
+        return d
+
+    def _set_modseq(self, mailbox_uuid, condition, values, expunged=False):
+        """
+        Give the next modseq of a mailbox to the messages that match a
+        condition on its UID table, with a single statement.
+
+        All the messages get the same modseq, that is higher than any other
+        in the mailbox.
+
+        :param condition: the WHERE clause for the UID table.
+        :type condition: str
+        :param values: the values for the condition.
+        :type values: tuple
+        :param expunged: whether the messages are being expunged.
+        :type expunged: bool
+        :rtype: Deferred
+        """
+        name = sanitize(mailbox_uuid)
+        sql = ("INSERT OR REPLACE INTO {modseq_preffix}{name} "
+               "(uid, modseq, expunged) "
+               "SELECT uid, (SELECT COALESCE(MAX(modseq), ?) + 1 "
+               "FROM {modseq_preffix}{name}), ? "
+               "FROM {preffix}{name} WHERE {condition}".format(
+                   modseq_preffix=self.modseq_table_preffix,
+                   preffix=self.table_preffix, name=name,
+                   condition=condition))
+        values = (self.initial_modseq, int(expunged)) + tuple(values)
+        d = self.create_table(mailbox_uuid)
+        d.addCallback(lambda _: self._operation(sql, values))
+        return d
+
+    def bump_modseq(self, mailbox_uuid, doc_ids):
+        """
+        Give the next modseq of a mailbox to several of its messages, because
+        they have changed.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param doc_ids: the doc_ids for the MetaMsgs of the messages.
+        :type doc_ids: list
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+
+        @defer.inlineCallbacks
+        def bump_all():
+            step = self.max_insert_docs
+            for i in range(0, len(doc_ids), step):
+                chunk = tuple(doc_ids[i:i + step])
+                yield self._set_modseq(
+                    mailbox_uuid,
+                    "hash IN (%s)" % ", ".join(["?"] * len(chunk)), chunk)
+
+        return bump_all()
 
     def insert_doc(self, mailbox_uuid, doc_id):
         """
@@ -139,6 +243,7 @@ class MailboxIndexer(object):
         """
         check_good_uuid(mailbox_uuid)
         assert doc_id
+        mbox_uuid = mailbox_uuid
         mailbox_uuid = mailbox_uuid.replace('-', '_')
 
         if not re.findall(METAMSGID_RE.format(mbox_uuid=mailbox_uuid), doc_id):
@@ -156,12 +261,89 @@ class MailboxIndexer(object):
                     "LIMIT 1;").format(
             preffix=self.table_preffix, name=sanitize(mailbox_uuid))
 
-        d = self._operation(sql, values)
+        def set_modseq(uid):
+            d = self._set_modseq(mbox_uuid, "uid = ?", (uid,))
+            d.addCallback(lambda _: uid)
+            return d
+
+        d = self.create_table(mbox_uuid)
+        d.addCallback(lambda _: self._operation(sql, values))
         d.addCallback(lambda _: self._query(sql_last))
         d.addCallback(get_rowid)
+        d.addCallback(set_modseq)
         d.addErrback(lambda f: f.printTraceback())
         return d
 
+    def insert_docs(self, mailbox_uuid, doc_ids):
+        """
+        Insert the doc_ids for several MetaMsgs in the UID table for a given
+        mailbox, in the passed order.
+
+        The documents are inserted with a single statement for every
+        `max_insert_docs` of them, so each batch is inserted in its own
+        transaction instead of one per document. The doc_ids that were
+        already in the table keep their uid, and their modseq.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param doc_ids: the doc_ids for the MetaMsgs, in the same format
+                        expected by `insert_doc`.
+        :type doc_ids: list
+        :return: a deferred that will fire with the list of uids of the
+                 documents, in the same order as the doc_ids.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        doc_id_re = re.compile(
+            METAMSGID_RE.format(mbox_uuid=sanitize(mailbox_uuid)))
+        for doc_id in doc_ids:
+            if not doc_id or not doc_id_re.search(doc_id):
+                raise WrongMetaDocIDError(
+                    "Wrong format for the MetaMsg doc_id")
+
+        table = "{preffix}{name}".format(
+            preffix=self.table_preffix, name=sanitize(mailbox_uuid))
+
+        def select_chunk(chunk):
+            sql = "SELECT hash, uid FROM {table} WHERE hash IN ({qs})".format(
+                table=table, qs=", ".join(["?"] * len(chunk)))
+            return self._query(sql, tuple(chunk))
+
+        def insert_chunk(chunk):
+            sql = "INSERT OR IGNORE INTO {table} (hash) VALUES {rows}".format(
+                table=table, rows=", ".join(["(?)"] * len(chunk)))
+            return self._operation(sql, tuple(chunk))
+
+        @defer.inlineCallbacks
+        def insert_all():
+            # the chunks go one after the other, so that the uids follow the
+            # order of the doc_ids. The doc_ids already in the table are left
+            # out of the insert, since even an ignored row would use up an
+            # uid.
+            uids = {}
+            step = self.max_insert_docs
+            yield self.create_table(mailbox_uuid)
+            for i in range(0, len(doc_ids), step):
+                chunk = doc_ids[i:i + step]
+                rows = yield select_chunk(chunk)
+                uids.update(rows)
+                missing = []
+                for doc_id in chunk:
+                    if doc_id not in uids:
+                        uids[doc_id] = None
+                        missing.append(doc_id)
+                if missing:
+                    yield insert_chunk(missing)
+                    rows = yield select_chunk(missing)
+                    uids.update(rows)
+                    yield self._set_modseq(
+                        mailbox_uuid,
+                        "uid IN (%s)" % ", ".join(["?"] * len(rows)),
+                        tuple(uid for _, uid in rows))
+            defer.returnValue([uids.get(doc_id) for doc_id in doc_ids])
+
+        return insert_all()
+
     def delete_doc_by_uid(self, mailbox_uuid, uid):
         """
         Delete the entry for a MetaMsg in the UID table for a given mailbox.
@@ -178,7 +360,9 @@ class MailboxIndexer(object):
                "WHERE uid=?".format(
                    preffix=self.table_preffix, name=sanitize(mailbox_uuid)))
         values = (uid,)
-        return self._query(sql, values)
+        d = self._set_modseq(mailbox_uuid, "uid=?", values, expunged=True)
+        d.addCallback(lambda _: self._query(sql, values))
+        return d
 
     def delete_doc_by_hash(self, mailbox_uuid, doc_id):
         """
@@ -201,7 +385,51 @@ class MailboxIndexer(object):
                "WHERE hash=?".format(
                    preffix=self.table_preffix, name=sanitize(mailbox_uuid)))
         values = (doc_id,)
-        return self._query(sql, values)
+        d = self._set_modseq(mailbox_uuid, "hash=?", values, expunged=True)
+        d.addCallback(lambda _: self._query(sql, values))
+        return d
+
+    def delete_docs_by_hash(self, mailbox_uuid, doc_ids):
+        """
+        Delete the entries for several MetaMsgs in the UID table for a given
+        mailbox, with a single query for every `max_insert_docs` of them.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param doc_ids: the doc_ids for the MetaMsgs
+        :type doc_ids: list
+        :return: a deferred that will fire with the sorted list of the uids
+                 that were deleted.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        table = "{preffix}{name}".format(
+            preffix=self.table_preffix, name=sanitize(mailbox_uuid))
+
+        def delete_chunk(chunk):
+            qs = ", ".join(["?"] * len(chunk))
+            sql_uids = "SELECT uid FROM {table} WHERE hash IN ({qs})".format(
+                table=table, qs=qs)
+            sql = "DELETE FROM {table} WHERE hash IN ({qs})".format(
+                table=table, qs=qs)
+            d = self._set_modseq(
+                mailbox_uuid, "hash IN (%s)" % qs, tuple(chunk),
+                expunged=True)
+            d.addCallback(lambda _: self._query(sql_uids, tuple(chunk)))
+            d.addCallback(lambda rows: self._operation(
+                sql, tuple(chunk)).addCallback(lambda _: rows))
+            return d
+
+        @defer.inlineCallbacks
+        def delete_all():
+            uids = []
+            step = self.max_insert_docs
+            for i in range(0, len(doc_ids), step):
+                rows = yield delete_chunk(doc_ids[i:i + step])
+                uids.extend(row[0] for row in rows)
+            defer.returnValue(sorted(uids))
+
+        return delete_all()
 
     def get_doc_id_from_uid(self, mailbox_uuid, uid):
         """
@@ -242,10 +470,222 @@ class MailboxIndexer(object):
         d.addCallback(get_uid)
         return d
 
+    def get_uids_from_doc_ids(self, mailbox_uuid, doc_ids):
+        """
+        Get the (uid, doc_id) pairs for several MetaMsg doc_ids of a given
+        mailbox, with one query for every `max_insert_docs` of them.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param doc_ids: the doc_ids for the MetaMsgs.
+        :type doc_ids: list
+        :return: a deferred that will fire with a list of tuples, sorted by
+                 uid, for the doc_ids that are in the mailbox.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        table = "{preffix}{name}".format(
+            preffix=self.table_preffix, name=sanitize(mailbox_uuid))
+
+        def select_chunk(chunk):
+            sql = "SELECT uid, hash FROM {table} WHERE hash IN ({qs})".format(
+                table=table, qs=", ".join(["?"] * len(chunk)))
+            return self._query(sql, tuple(chunk))
+
+        @defer.inlineCallbacks
+        def select_all():
+            pairs = []
+            step = self.max_insert_docs
+            for i in range(0, len(doc_ids), step):
+                rows = yield select_chunk(doc_ids[i:i + step])
+                pairs.extend(tuple(row) for row in rows)
+            defer.returnValue(sorted(set(pairs)))
+
+        return select_all()
+
     def get_doc_ids_from_uids(self, mailbox_uuid, uids):
-        # For IMAP relative numbering /sequences.
-        # XXX dereference the range (n,*)
-        raise NotImplementedError()
+        """
+        Get the (uid, doc_id) pairs for a set of UIDs in a given mailbox.
+
+        The UIDs are resolved with bounded queries against the UID table,
+        so only the rows that do exist in the mailbox are returned. An open
+        range (n:*) is dereferenced against the highest UID in the table,
+        as mandated by rfc 3501: if n is greater than that UID, the last
+        message is still returned.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param uids: the UIDs to look up. It can be a MessageSet, in which
+                     case a None upper bound in a range stands for '*', or
+                     any iterable of integers.
+        :type uids: MessageSet or iterable
+        :return: a deferred that will fire with a list of (uid, doc_id)
+                 tuples, sorted by uid.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        table = "{preffix}{name}".format(
+            preffix=self.table_preffix, name=sanitize(mailbox_uuid))
+        sql = "SELECT uid, hash FROM {table} WHERE {{cond}}".format(
+            table=table)
+        return self._query_uids(mailbox_uuid, sql, uids)
+
+    def _query_uids(self, mailbox_uuid, sql, uids, values=()):
+        """
+        Run a query for the messages in a set of UIDs, with one query for
+        every `max_query_ranges` ranges of the set.
+
+        :param sql: the query, with a {cond} placeholder for the condition
+                    on the uid column.
+        :type sql: str
+        :param uids: the UIDs, as for `get_doc_ids_from_uids`, or None for
+                     all of them.
+        :type uids: MessageSet or iterable
+        :param values: the values for the placeholders that go before the
+                       condition.
+        :type values: tuple
+        :return: a deferred that will fire with the sorted rows.
+        :rtype: Deferred
+        """
+        table = "{preffix}{name}".format(
+            preffix=self.table_preffix, name=sanitize(mailbox_uuid))
+
+        if uids is None:
+            ranges = [(1, None)]
+        else:
+            ranges = getattr(uids, 'ranges', None)
+            if ranges is None:
+                ranges = [(uid, uid) for uid in uids]
+
+        def get_condition(lo, hi):
+            # MessageSet normalizes the ranges so that None comes last
+            if lo is None:
+                return "uid = (SELECT MAX(uid) FROM %s)" % table, ()
+            if hi is None:
+                return ("(uid >= ? OR uid = (SELECT MAX(uid) FROM %s))"
+                        % table, (lo,))
+            if lo == hi:
+                return "uid = ?", (lo,)
+            return "uid BETWEEN ? AND ?", (lo, hi)
+
+        def query_chunk(chunk):
+            conditions, chunk_values = [], list(values)
+            for lo, hi in chunk:
+                cond, val = get_condition(lo, hi)
+                conditions.append(cond)
+                chunk_values.extend(val)
+            return self._query(
+                sql.format(cond="(%s)" % " OR ".join(conditions)),
+                tuple(chunk_values))
+
+        def merge_results(results):
+            rows = set()
+            for chunk_rows in results:
+                rows.update(tuple(row) for row in chunk_rows)
+            return sorted(rows)
+
+        if not ranges:
+            return defer.succeed([])
+
+        step = self.max_query_ranges - len(values)
+        d = defer.gatherResults([
+            query_chunk(ranges[i:i + step])
+            for i in range(0, len(ranges), step)])
+        d.addCallback(merge_results)
+        return d
+
+    def get_highest_modseq(self, mailbox_uuid):
+        """
+        Get the highest modseq of a given mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :return: a deferred that will fire with the modseq.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        sql = ("SELECT MAX(modseq) FROM {preffix}{name}".format(
+            preffix=self.modseq_table_preffix, name=sanitize(mailbox_uuid)))
+
+        def get_modseq(result):
+            return _maybe_first_query_item(result) or self.initial_modseq
+
+        d = self.create_table(mailbox_uuid)
+        d.addCallback(lambda _: self._query(sql))
+        d.addCallback(get_modseq)
+        return d
+
+    def get_modseqs(self, mailbox_uuid, uids=None, changedsince=None):
+        """
+        Get the modseqs of the messages in a given mailbox.
+
+        When a modseq is passed, only the messages that changed after it are
+        returned, and they are found through the index of the modseq table,
+        so the cost depends on the number of changes and not on the size of
+        the mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param uids: optional, the UIDs of the messages, as for
+                     `get_doc_ids_from_uids`. All the messages in the mailbox
+                     if not passed.
+        :type uids: MessageSet or iterable
+        :param changedsince: optional, return only the messages with a higher
+                             modseq than this one.
+        :type changedsince: int
+        :return: a deferred that will fire with a list of (uid, modseq)
+                 tuples, sorted by uid.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        name = sanitize(mailbox_uuid)
+
+        if changedsince is not None and changedsince >= self.initial_modseq:
+            sql = ("SELECT uid, modseq FROM {preffix}{name} "
+                   "WHERE modseq > ? AND expunged = 0 AND {{cond}}".format(
+                       preffix=self.modseq_table_preffix, name=name))
+            values = (changedsince,)
+        else:
+            # the messages that were not changed since the modseqs are kept
+            # have no entry in the modseq table.
+            sql = ("SELECT uid, COALESCE((SELECT modseq FROM "
+                   "{modseq_preffix}{name} m WHERE m.uid = u.uid), ?) "
+                   "FROM {preffix}{name} u WHERE {{cond}}".format(
+                       modseq_preffix=self.modseq_table_preffix,
+                       preffix=self.table_preffix, name=name))
+            values = (self.initial_modseq,)
+
+        d = self.create_table(mailbox_uuid)
+        d.addCallback(
+            lambda _: self._query_uids(mailbox_uuid, sql, uids, values))
+        return d
+
+    def get_expunged(self, mailbox_uuid, changedsince, uids=None):
+        """
+        Get the UIDs of the messages of a given mailbox that were expunged
+        after a given modseq.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param changedsince: the modseq.
+        :type changedsince: int
+        :param uids: optional, only look for these UIDs, as for
+                     `get_doc_ids_from_uids`.
+        :type uids: MessageSet or iterable
+        :return: a deferred that will fire with the sorted list of uids.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        sql = ("SELECT uid FROM {preffix}{name} "
+               "WHERE modseq > ? AND expunged = 1 AND {{cond}}".format(
+                   preffix=self.modseq_table_preffix,
+                   name=sanitize(mailbox_uuid)))
+
+        d = self.create_table(mailbox_uuid)
+        d.addCallback(lambda _: self._query_uids(
+            mailbox_uuid, sql, uids, (changedsince,)))
+        d.addCallback(lambda rows: [uid for (uid,) in rows])
+        return d
 
     def count(self, mailbox_uuid):
         """
@@ -307,6 +747,28 @@ class MailboxIndexer(object):
         d.addCallback(getit)
         return d
 
+    def get_uid_from_msn(self, mailbox_uuid, msn):
+        """
+        Get the UID of the message with a given sequence number, in the
+        order of the UIDs of a given mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param msn: the message sequence number, starting from 1.
+        :type msn: int
+        :return: a deferred that will fire with the uid, or None.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        if msn < 1:
+            return defer.succeed(None)
+        sql = ("SELECT uid FROM {preffix}{name} "
+               "ORDER BY uid LIMIT 1 OFFSET ?").format(
+            preffix=self.table_preffix, name=sanitize(mailbox_uuid))
+        d = self._query(sql, (msn - 1,))
+        d.addCallback(_maybe_first_query_item)
+        return d
+
     def all_uid_iter(self, mailbox_uuid):
         """
         Get a sequence of all the uids in this mailbox.
@@ -0,0 +1,850 @@
+# -*- coding: utf-8 -*-
+# search_indexer.py
+# Copyright (C) 2016 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+.. :py:module::search_indexer
+
+Local tables to search the messages of a given mailbox.
+"""
+import base64
+import datetime
+import quopri
+import re
+
+from email.header import decode_header
+from email.utils import getaddresses, mktime_tz, parsedate_tz
+
+from twisted.internet import defer
+from twisted.mail.imap4 import parseIdList, IllegalIdentifierError
+
+from leap.bitmask.mail.constants import MessageFlags, METAMSGID_CHASH_RE
+from leap.bitmask.mail.constants import SQLITE_MAX_VARIABLES
+from leap.bitmask.mail.mailbox_indexer import MailboxIndexer
+from leap.bitmask.mail.mailbox_indexer import check_good_uuid, sanitize
+from leap.bitmask.mail.sorting import ThreadMessage, get_base_subject
+from leap.bitmask.mail.sorting import parse_message_ids
+from leap.bitmask.mail.sorting import thread_ordered_subject
+from leap.bitmask.mail.sorting import thread_references
+
+
+class SearchQueryError(Exception):
+    pass
+
+
+class SearchIndexer(object):
+    """
+    This class contains the commands needed to maintain and query a
+    local-only index of the messages, to search them without loading their
+    documents.
+
+    The index has four tables:
+
+    * the content table, with a row for every distinct message (by content
+      hash), that keeps its internal date, its sent date and its size.
+    * the text table, a full text search table with the headers and the
+      decoded text parts of every message in the content table.
+    * the sort table, with the keys to sort and thread every message in the
+      content table (rfc 5256).
+    * the messages table, with a row for every MetaMsg, that keeps its
+      flags.
+
+    The searches are joined with the UID table of the mailbox, so that they
+    only see the messages that are in it. The search keys are those of the
+    IMAP specification (rfc 3501). The text keys are matched against the
+    words of the messages, so a search string will match the messages that
+    contain its words, in the same order, the last one possibly as a prefix
+    of a longer word.
+    """
+
+    store = None
+    table_preffix = "leapmail_search_"
+    uid_table_preffix = MailboxIndexer.table_preffix
+
+    # how many documents go into a single insert or delete. The rows of the
+    # sort table take 11 values.
+    max_insert_docs = SQLITE_MAX_VARIABLES // 11
+
+    # how many messages get their documents loaded at once, when indexing
+    # the messages that are not in the index yet.
+    max_index_msgs = 100
+
+    text_columns = ('from_', 'to_', 'cc', 'bcc', 'subject', 'headers', 'body')
+
+    sort_columns = ('arrival', 'date', 'from_', 'to_', 'cc', 'subject',
+                    'reply', 'message_id', 'in_reply_to', 'refs')
+
+    # the sort criteria of rfc 5256, and their column. The addresses and the
+    # subject are compared with the i;ascii-casemap collation.
+    sort_keys = {
+        'ARRIVAL': 's.arrival', 'CC': 's.cc COLLATE NOCASE',
+        'DATE': 's.date', 'FROM': 's.from_ COLLATE NOCASE',
+        'SIZE': 'c.size', 'SUBJECT': 's.subject COLLATE NOCASE',
+        'TO': 's.to_ COLLATE NOCASE'}
+
+    thread_algorithms = {
+        'ORDEREDSUBJECT': thread_ordered_subject,
+        'REFERENCES': thread_references}
+
+    def __init__(self, store):
+        self.store = store
+        self._tables_created = False
+
+    def _query(self, *args, **kw):
+        assert self.store is not None
+        return self.store.raw_sqlcipher_query(*args, **kw)
+
+    def _operation(self, *args, **kw):
+        assert self.store is not None
+        return self.store.raw_sqlcipher_operation(*args, **kw)
+
+    @property
+    def _content(self):
+        return self.table_preffix + "content"
+
+    @property
+    def _text(self):
+        return self.table_preffix + "text"
+
+    @property
+    def _sort(self):
+        return self.table_preffix + "sort"
+
+    @property
+    def _msgs(self):
+        return self.table_preffix + "msgs"
+
+    @defer.inlineCallbacks
+    def create_tables(self):
+        """
+        Create the tables for the search index, if they do not exist yet.
+
+        :rtype: Deferred
+        """
+        if self._tables_created:
+            return
+        yield self._operation(
+            "CREATE TABLE if not exists {content}( "
+            "id INTEGER PRIMARY KEY, "
+            "chash TEXT UNIQUE NOT NULL, "
+            "internaldate INTEGER, "
+            "sentdate INTEGER, "
+            "size INTEGER)".format(content=self._content))
+        yield self._operation(
+            "CREATE VIRTUAL TABLE if not exists {text} "
+            "USING fts4({columns}, tokenize=unicode61)".format(
+                text=self._text, columns=", ".join(self.text_columns)))
+        yield self._operation(
+            "CREATE TABLE if not exists {sort}( "
+            "chash TEXT PRIMARY KEY, "
+            "arrival INTEGER, "
+            "date INTEGER, "
+            "from_ TEXT, "
+            "to_ TEXT, "
+            "cc TEXT, "
+            "subject TEXT, "
+            "reply INTEGER, "
+            "message_id TEXT, "
+            "in_reply_to TEXT, "
+            "refs TEXT)".format(sort=self._sort))
+        yield self._operation(
+            "CREATE TABLE if not exists {msgs}( "
+            "mdoc TEXT PRIMARY KEY, "
+            "chash TEXT NOT NULL, "
+            "seen INTEGER, "
+            "answered INTEGER, "
+            "flagged INTEGER, "
+            "deleted INTEGER, "
+            "draft INTEGER, "
+            "recent INTEGER, "
+            "keywords TEXT)".format(msgs=self._msgs))
+        yield self._operation(
+            "CREATE INDEX if not exists {msgs}_chash "
+            "ON {msgs}(chash)".format(msgs=self._msgs))
+        self._tables_created = True
+
+    @defer.inlineCallbacks
+    def index_msgs(self, wrappers):
+        """
+        Add several messages to the index, or update their entries.
+
+        :param wrappers: the MessageWrappers of the messages. Their
+                         content-documents are needed to index the text of
+                         the messages that are not in the index yet.
+        :type wrappers: list
+        :rtype: Deferred
+        """
+        yield self.create_tables()
+        step = self.max_insert_docs
+        for i in range(0, len(wrappers), step):
+            yield self._index_chunk(wrappers[i:i + step])
+
+    @defer.inlineCallbacks
+    def _index_chunk(self, wrappers):
+        mdoc_ids = [wrapper.mdoc.doc_id or wrapper.mdoc.future_doc_id
+                    for wrapper in wrappers]
+        mdoc_chashes = [_get_chash(mdoc_id) for mdoc_id in mdoc_ids]
+        by_chash = dict(zip(mdoc_chashes, wrappers))
+        chashes = by_chash.keys()
+
+        # the content and text rows are shared by all the copies of a
+        # message, so they are only added for new content.
+        known = yield self._get_content_ids(chashes)
+        new = [chash for chash in chashes if chash not in known]
+        if new:
+            rows = [_get_content_row(by_chash[chash]) for chash in new]
+            yield self._operation(
+                "INSERT OR IGNORE INTO {content} "
+                "(chash, internaldate, sentdate, size) VALUES {rows}".format(
+                    content=self._content,
+                    rows=", ".join(["(?, ?, ?, ?)"] * len(new))),
+                tuple(_flatten(
+                    [chash] + row for chash, row in zip(new, rows))))
+            ids = yield self._get_content_ids(new)
+            rows = [[ids[chash]] + _get_text_row(by_chash[chash])
+                    for chash in new]
+            yield self._operation(
+                "INSERT OR REPLACE INTO {text} (docid, {columns}) "
+                "VALUES {rows}".format(
+                    text=self._text, columns=", ".join(self.text_columns),
+                    rows=", ".join(
+                        ["(%s)" % ", ".join(["?"] * 8)] * len(rows))),
+                tuple(_flatten(rows)))
+
+        # the content indexed before there was a sort table gets its sort
+        # keys too.
+        known = yield self._get_sorted(chashes)
+        new = [chash for chash in chashes if chash not in known]
+        if new:
+            rows = [[chash] + _get_sort_row(by_chash[chash]) for chash in new]
+            yield self._operation(
+                "INSERT OR REPLACE INTO {sort} (chash, {columns}) "
+                "VALUES {rows}".format(
+                    sort=self._sort, columns=", ".join(self.sort_columns),
+                    rows=", ".join(
+                        ["(%s)" % ", ".join(["?"] * 11)] * len(rows))),
+                tuple(_flatten(rows)))
+
+        rows = []
+        for mdoc_id, chash, wrapper in zip(mdoc_ids, mdoc_chashes, wrappers):
+            rows.append([mdoc_id, chash] +
+                        _get_flags_row(wrapper.fdoc.flags) +
+                        [int(bool(wrapper.fdoc.recent))])
+        yield self._operation(
+            "INSERT OR REPLACE INTO {msgs} (mdoc, chash, seen, answered, "
+            "flagged, deleted, draft, keywords, recent) "
+            "VALUES {rows}".format(
+                msgs=self._msgs,
+                rows=", ".join(["(%s)" % ", ".join(["?"] * 9)] * len(rows))),
+            tuple(_flatten(rows)))
+
+    def _get_content_ids(self, chashes):
+        sql = "SELECT chash, id FROM {content} WHERE chash IN ({qs})".format(
+            content=self._content, qs=", ".join(["?"] * len(chashes)))
+        d = self._query(sql, tuple(chashes))
+        d.addCallback(dict)
+        return d
+
+    def _get_sorted(self, chashes):
+        sql = "SELECT chash FROM {sort} WHERE chash IN ({qs})".format(
+            sort=self._sort, qs=", ".join(["?"] * len(chashes)))
+        d = self._query(sql, tuple(chashes))
+        d.addCallback(lambda rows: set(row[0] for row in rows))
+        return d
+
+    @defer.inlineCallbacks
+    def copy_entries(self, mdoc_ids, new_mdoc_ids):
+        """
+        Add to the index the copies of several messages, with the flags of
+        the original ones. Each copy is matched with its original by the
+        content hash in their doc_ids.
+
+        :param mdoc_ids: the doc_ids of the MetaMsgs of the original messages.
+        :type mdoc_ids: list
+        :param new_mdoc_ids: the doc_ids of the MetaMsgs of the copies.
+        :type new_mdoc_ids: list
+        :rtype: Deferred
+        """
+        yield self.create_tables()
+        originals = dict(
+            (_get_chash(mdoc_id), mdoc_id) for mdoc_id in mdoc_ids)
+        pairs = [(new_mdoc_id, originals[_get_chash(new_mdoc_id)])
+                 for new_mdoc_id in new_mdoc_ids
+                 if _get_chash(new_mdoc_id) in originals]
+        step = self.max_insert_docs
+        for i in range(0, len(pairs), step):
+            chunk = pairs[i:i + step]
+            sources = sorted(set(mdoc_id for (_, mdoc_id) in chunk))
+            rows = yield self._query(
+                "SELECT mdoc, chash, seen, answered, flagged, deleted, "
+                "draft, recent, keywords FROM {msgs} "
+                "WHERE mdoc IN ({qs})".format(
+                    msgs=self._msgs, qs=", ".join(["?"] * len(sources))),
+                tuple(sources))
+            by_mdoc = dict((row[0], list(row[1:])) for row in rows)
+            rows = [[new_mdoc_id] + by_mdoc[mdoc_id]
+                    for (new_mdoc_id, mdoc_id) in chunk
+                    if mdoc_id in by_mdoc]
+            if not rows:
+                continue
+            yield self._operation(
+                "INSERT OR REPLACE INTO {msgs} (mdoc, chash, seen, "
+                "answered, flagged, deleted, draft, recent, keywords) "
+                "VALUES {rows}".format(
+                    msgs=self._msgs,
+                    rows=", ".join(
+                        ["(%s)" % ", ".join(["?"] * 9)] * len(rows))),
+                tuple(_flatten(rows)))
+
+    @defer.inlineCallbacks
+    def update_flags(self, mdoc_id, flags):
+        """
+        Update the flags of a message in the index.
+
+        The messages that are not in the index yet are left alone, they will
+        be indexed with their current flags.
+
+        :param mdoc_id: the doc_id of the MetaMsg of the message.
+        :type mdoc_id: str
+        :param flags: the new flags of the message.
+        :type flags: list
+        :rtype: Deferred
+        """
+        yield self.create_tables()
+        sql = ("UPDATE {msgs} SET seen = ?, answered = ?, flagged = ?, "
+               "deleted = ?, draft = ?, keywords = ? WHERE mdoc = ?".format(
+                   msgs=self._msgs))
+        yield self._operation(sql, tuple(_get_flags_row(flags) + [mdoc_id]))
+
+    @defer.inlineCallbacks
+    def update_flags_from_docs(self, fdoc_ids):
+        """
+        Update the flags of several messages in the index, reading them from
+        their flags documents. This is used when the flags documents have
+        been changed by another replica.
+
+        :param fdoc_ids: the doc_ids of the flags documents.
+        :type fdoc_ids: list
+        :rtype: Deferred
+        """
+        docs = yield self.store.get_docs(fdoc_ids)
+        for doc in docs:
+            if doc.content:
+                yield self.update_flags(
+                    "M" + doc.doc_id[1:], doc.content.get('flags', []))
+
+    @defer.inlineCallbacks
+    def delete_entries(self, mdoc_ids):
+        """
+        Delete several messages from the index.
+
+        :param mdoc_ids: the doc_ids of the MetaMsgs of the messages.
+        :type mdoc_ids: list
+        :rtype: Deferred
+        """
+        yield self.create_tables()
+        step = self.max_insert_docs
+        for i in range(0, len(mdoc_ids), step):
+            chunk = mdoc_ids[i:i + step]
+            yield self._operation(
+                "DELETE FROM {msgs} WHERE mdoc IN ({qs})".format(
+                    msgs=self._msgs, qs=", ".join(["?"] * len(chunk))),
+                tuple(chunk))
+            chashes = set(_get_chash(mdoc_id) for mdoc_id in chunk)
+            yield self._delete_unused_content(sorted(chashes))
+
+    @defer.inlineCallbacks
+    def delete_mailbox(self, mailbox_uuid):
+        """
+        Delete all the messages of a mailbox from the index.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        yield self.create_tables()
+        yield self._operation(
+            "DELETE FROM {msgs} WHERE mdoc GLOB ?".format(msgs=self._msgs),
+            ("M-%s-*" % sanitize(mailbox_uuid),))
+        yield self._delete_unused_content()
+
+    @defer.inlineCallbacks
+    def _delete_unused_content(self, chashes=None):
+        # the content is kept while there is any copy of the message left.
+        sql = ("SELECT id, chash FROM {content} WHERE "
+               "chash NOT IN (SELECT chash FROM {msgs})".format(
+                   content=self._content, msgs=self._msgs))
+        values = ()
+        if chashes is not None:
+            if not chashes:
+                return
+            sql += " AND chash IN (%s)" % ", ".join(["?"] * len(chashes))
+            values = tuple(chashes)
+        rows = yield self._query(sql, values)
+        ids = [row[0] for row in rows]
+        unused = [row[1] for row in rows]
+        step = self.max_insert_docs
+        for i in range(0, len(ids), step):
+            qs = ", ".join(["?"] * len(ids[i:i + step]))
+            values = tuple(ids[i:i + step])
+            yield self._operation(
+                "DELETE FROM {text} WHERE docid IN ({qs})".format(
+                    text=self._text, qs=qs), values)
+            yield self._operation(
+                "DELETE FROM {sort} WHERE chash IN ({qs})".format(
+                    sort=self._sort, qs=qs), tuple(unused[i:i + step]))
+            yield self._operation(
+                "DELETE FROM {content} WHERE id IN ({qs})".format(
+                    content=self._content, qs=qs), values)
+
+    @defer.inlineCallbacks
+    def get_unindexed(self, mailbox_uuid):
+        """
+        Get the messages of a mailbox that are not in the index, like the
+        ones that were received with a sync before they could be indexed, or
+        that have no sort keys yet.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :return: a deferred that will fire with a list of (uid, mdoc_id)
+                 tuples.
+        :rtype: Deferred
+        """
+        check_good_uuid(mailbox_uuid)
+        yield self.create_tables()
+        sql = ("SELECT u.uid, u.hash FROM {uids} u "
+               "LEFT JOIN {msgs} m ON m.mdoc = u.hash "
+               "LEFT JOIN {sort} s ON s.chash = m.chash "
+               "WHERE m.mdoc IS NULL OR s.chash IS NULL".format(
+                   uids=self.uid_table_preffix + sanitize(mailbox_uuid),
+                   msgs=self._msgs, sort=self._sort))
+        rows = yield self._query(sql)
+        defer.returnValue([tuple(row) for row in rows])
+
+    def search(self, mailbox_uuid, query, uids):
+        """
+        Search the messages of a mailbox.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param query: the search keys, as parsed by the IMAP server.
+        :type query: list
+        :param uids: the sorted uids that the sequence numbers refer to, to
+                     resolve the ones in the query.
+        :type uids: list or MessageSequence
+        :return: a deferred that will fire with the sorted list of the uids
+                 of the matching messages.
+        :rtype: Deferred
+        :raises: SearchQueryError if the query is not valid.
+        """
+        d = self._select(mailbox_uuid, "u.uid", query, uids, "u.uid")
+        d.addCallback(lambda rows: [row[0] for row in rows])
+        return d
+
+    def sort(self, mailbox_uuid, criteria, query, uids):
+        """
+        Search the messages of a mailbox, and sort the result.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param criteria: the sort criteria of rfc 5256, like ARRIVAL or
+                         SUBJECT, each one optionally preceded by REVERSE.
+        :type criteria: list
+        :param query: the search keys, as parsed by the IMAP server.
+        :type query: list
+        :param uids: the sorted uids that the sequence numbers refer to, to
+                     resolve the ones in the query.
+        :type uids: list or MessageSequence
+        :return: a deferred that will fire with the sorted list of the uids
+                 of the matching messages.
+        :rtype: Deferred
+        :raises: SearchQueryError if the criteria or the query are not valid.
+        """
+        order = []
+        reverse = False
+        for criterion in criteria:
+            name = criterion.upper()
+            if name == 'REVERSE' and not reverse:
+                reverse = True
+                continue
+            if name not in self.sort_keys:
+                raise SearchQueryError("Unknown sort criterion: %s" % name)
+            order.append(self.sort_keys[name] + (" DESC" if reverse else ""))
+            reverse = False
+        if not order or reverse:
+            raise SearchQueryError("Invalid sort criteria")
+        # the ties are sorted by sequence number.
+        order.append("u.uid")
+        d = self._select(
+            mailbox_uuid, "u.uid", query, uids, ", ".join(order))
+        d.addCallback(lambda rows: [row[0] for row in rows])
+        return d
+
+    def thread(self, mailbox_uuid, algorithm, query, uids):
+        """
+        Search the messages of a mailbox, and thread the result.
+
+        :param mailbox_uuid: the mailbox uuid
+        :type mailbox_uuid: str
+        :param algorithm: the threading algorithm, ORDEREDSUBJECT or
+                          REFERENCES.
+        :type algorithm: str
+        :param query: the search keys, as parsed by the IMAP server.
+        :type query: list
+        :param uids: the sorted uids that the sequence numbers refer to, to
+                     resolve the ones in the query.
+        :type uids: list or MessageSequence
+        :return: a deferred that will fire with the threads, as described in
+                 leap.bitmask.mail.sorting.
+        :rtype: Deferred
+        :raises: SearchQueryError if the algorithm or the query are not
+                 valid.
+        """
+        thread = self.thread_algorithms.get(algorithm.upper())
+        if thread is None:
+            raise SearchQueryError(
+                "Unknown threading algorithm: %s" % algorithm)
+
+        def get_messages(rows):
+            return [ThreadMessage(
+                uid, date, subject, bool(reply), message_id,
+                parse_message_ids(refs) or parse_message_ids(in_reply_to)[:1])
+                for (uid, date, subject, reply, message_id, in_reply_to, refs)
+                in rows]
+
+        d = self._select(
+            mailbox_uuid, "u.uid, s.date, s.subject, s.reply, s.message_id, "
+            "s.in_reply_to, s.refs", query, uids, "u.uid")
+        d.addCallback(get_messages)
+        d.addCallback(thread)
+        return d
+
+    @defer.inlineCallbacks
+    def _select(self, mailbox_uuid, columns, query, uids, order):
+        check_good_uuid(mailbox_uuid)
+        condition, values = _QueryCompiler(self._text, uids).compile(query)
+        if not uids:
+            defer.returnValue([])
+        yield self.create_tables()
+        sql = ("SELECT {columns} FROM {uids} u "
+               "JOIN {msgs} m ON m.mdoc = u.hash "
+               "JOIN {content} c ON c.chash = m.chash "
+               "LEFT JOIN {sort} s ON s.chash = m.chash "
+               "WHERE {cond} ORDER BY {order}".format(
+                   columns=columns,
+                   uids=self.uid_table_preffix + sanitize(mailbox_uuid),
+                   msgs=self._msgs, content=self._content, sort=self._sort,
+                   cond=condition, order=order))
+        rows = yield self._query(sql, tuple(values))
+        defer.returnValue(rows)
+
+
+class _QueryCompiler(object):
+    """
+    Translate a list of IMAP search keys into an SQL condition over the
+    tables of the search index.
+    """
+
+    flag_keys = {
+        'ANSWERED': 'm.answered', 'DELETED': 'm.deleted',
+        'DRAFT': 'm.draft', 'FLAGGED': 'm.flagged',
+        'RECENT': 'm.recent', 'SEEN': 'm.seen'}
+
+    text_keys = {
+        'BCC': 'bcc', 'BODY': 'body', 'CC': 'cc', 'FROM': 'from_',
+        'SUBJECT': 'subject', 'TO': 'to_'}
+
+    date_keys = {
+        'BEFORE': ('c.internaldate', '<'), 'ON': ('c.internaldate', '='),
+        'SINCE': ('c.internaldate', '>='), 'SENTBEFORE': ('c.sentdate', '<'),
+        'SENTON': ('c.sentdate', '='), 'SENTSINCE': ('c.sentdate', '>=')}
+
+    def __init__(self, text_table, uids):
+        self.text_table = text_table
+        self.uids = uids
+
+    def compile(self, query):
+        """
+        :return: the condition and the values for its parameters.
+        :rtype: tuple
+        """
+        values = []
+        conditions = []
+        keys = list(query)
+        if not keys:
+            raise SearchQueryError("Empty search query")
+        while keys:
+            conditions.append(self._compile_key(keys, values))
+        return " AND ".join(conditions), values
+
+    def _compile_key(self, keys, values):
+        key = keys.pop(0)
+        if isinstance(key, list):
+            condition, sub_values = self.compile(key)
+            values.extend(sub_values)
+            return "(%s)" % condition
+
+        name = key.upper()
+        if name == 'ALL':
+            return "1"
+        if name in self.flag_keys:
+            return "%s = 1" % self.flag_keys[name]
+        if name.startswith('UN') and name[2:] in self.flag_keys:
+            return "%s = 0" % self.flag_keys[name[2:]]
+        if name == 'NEW':
+            return "(m.recent = 1 AND m.seen = 0)"
+        if name == 'OLD':
+            return "m.recent = 0"
+        if name == 'NOT':
+            return "NOT (%s)" % self._compile_key(keys, values)
+        if name == 'OR':
+            first = self._compile_key(keys, values)
+            second = self._compile_key(keys, values)
+            return "(%s OR %s)" % (first, second)
+        if name in ('KEYWORD', 'UNKEYWORD'):
+            values.append("% " + _escape_like(
+                self._pop_arg(keys, name).lower()) + " %")
+            condition = "m.keywords LIKE ? ESCAPE '\\'"
+            if name == 'UNKEYWORD':
+                return "NOT (%s)" % condition
+            return condition
+        if name in self.text_keys:
+            return self._match(
+                self.text_keys[name], self._pop_arg(keys, name), values)
+        if name == 'TEXT':
+            return self._match(self.text_table, self._pop_arg(keys, name),
+                               values)
+        if name == 'HEADER':
+            field = self._pop_arg(keys, name)
+            string = self._pop_arg(keys, name)
+            return self._match('headers', field + ' ' + string, values)
+        if name in self.date_keys:
+            column, op = self.date_keys[name]
+            values.append(_parse_search_date(self._pop_arg(keys, name)))
+            return "%s %s ?" % (column, op)
+        if name in ('LARGER', 'SMALLER'):
+            try:
+                values.append(int(self._pop_arg(keys, name)))
+            except ValueError:
+                raise SearchQueryError("Invalid size for %s" % name)
+            return "c.size %s ?" % ('>' if name == 'LARGER' else '<')
+        if name == 'UID':
+            last = self.uids[-1] if self.uids else None
+            return self._uid_ranges(self._parse_set(
+                self._pop_arg(keys, name), last).ranges)
+        if _SEQUENCE_SET_RE.match(key):
+            return self._uid_ranges(self._msn_to_uid_ranges(
+                self._parse_set(key, len(self.uids)).ranges))
+        raise SearchQueryError("Unknown search key: %s" % (key,))
+
+    def _pop_arg(self, keys, name):
+        if not keys or isinstance(keys[0], list):
+            raise SearchQueryError("Missing argument for %s" % name)
+        return keys.pop(0)
+
+    def _parse_set(self, string, last):
+        if last is None:
+            # an empty mailbox, the set matches nothing anyway.
+            last = 1
+        try:
+            return parseIdList(string, last)
+        except IllegalIdentifierError:
+            raise SearchQueryError("Invalid sequence set: %s" % string)
+
+    def _msn_to_uid_ranges(self, ranges):
+        uid_ranges = []
+        for lo, hi in ranges:
+            hi = min(hi, len(self.uids))
+            if lo <= hi:
+                uid_ranges.append((self.uids[lo - 1], self.uids[hi - 1]))
+        return uid_ranges
+
+    def _uid_ranges(self, ranges):
+        # the bounds are integers, so they go into the statement instead of
+        # taking up parameters.
+        conditions = ["u.uid BETWEEN %d AND %d" % (lo, hi)
+                      for lo, hi in ranges]
+        if not conditions:
+            return "0"
+        return "(%s)" % " OR ".join(conditions)
+
+    def _match(self, column, string, values):
+        words = _WORD_RE.findall(_to_unicode(string).lower())
+        if not words:
+            return "1"
+        values.append(u'"%s*"' % u" ".join(words))
+        return ("c.id IN (SELECT docid FROM {text} "
+                "WHERE {column} MATCH ?)".format(
+                    text=self.text_table, column=column))
+
+
+_CHASH_RE = re.compile(METAMSGID_CHASH_RE)
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_SEQUENCE_SET_RE = re.compile(r'^[0-9*:,]+$')
+_TAGS_RE = re.compile(r'<[^>]*>')
+
+
+def _flatten(rows):
+    return [value for row in rows for value in row]
+
+
+def _get_chash(mdoc_id):
+    return _CHASH_RE.findall(mdoc_id)[0]
+
+
+def _escape_like(string):
+    return re.sub(r'([\\%_])', r'\\\1', string)
+
+
+def _to_unicode(string, charset='utf-8'):
+    if isinstance(string, unicode):
+        return string
+    try:
+        return unicode(string, charset or 'utf-8', 'replace')
+    except LookupError:
+        return unicode(string, 'utf-8', 'replace')
+
+
+def _decode_header(value):
+    try:
+        return u" ".join(_to_unicode(part, charset)
+                         for part, charset in decode_header(value))
+    except Exception:
+        return _to_unicode(value)
+
+
+def _parse_search_date(string):
+    try:
+        return datetime.datetime.strptime(string, '%d-%b-%Y').toordinal()
+    except (TypeError, ValueError):
+        raise SearchQueryError("Invalid date: %s" % (string,))
+
+
+def _get_day(date):
+    # rfc 3501 compares the dates disregarding the time and the timezone.
+    parsed = parsedate_tz(date or "")
+    if not parsed:
+        return None
+    try:
+        return datetime.date(*parsed[:3]).toordinal()
+    except ValueError:
+        return None
+
+
+def _get_flags_row(flags):
+    """
+    Values for the seen, answered, flagged, deleted, draft and keywords
+    columns.
+    """
+    flags = set(flags)
+    keywords = [flag.lower() for flag in flags if not flag.startswith('\\')]
+    return [int(MessageFlags.SEEN_FLAG in flags),
+            int(MessageFlags.ANSWERED_FLAG in flags),
+            int(MessageFlags.FLAGGED_FLAG in flags),
+            int(MessageFlags.DELETED_FLAG in flags),
+            int(MessageFlags.DRAFT_FLAG in flags),
+            " %s " % " ".join(keywords)]
+
+
+def _get_headers(wrapper):
+    return dict((key.lower(), value)
+                for key, value in wrapper.hdoc.headers.items())
+
+
+def _get_content_row(wrapper):
+    """
+    Values for the internaldate, sentdate and size columns.
+    """
+    headers = _get_headers(wrapper)
+    return [_get_day(wrapper.hdoc.date), _get_day(headers.get('date')),
+            wrapper.fdoc.size]
+
+
+def _get_timestamp(date):
+    parsed = parsedate_tz(date or "")
+    if not parsed:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+
+def _get_mailbox(value):
+    # the local part of the first address, as rfc 5256 sorts by it.
+    addresses = getaddresses([value or ''])
+    if not addresses:
+        return u""
+    return _to_unicode(addresses[0][1].split('@')[0])
+
+
+def _get_sort_row(wrapper):
+    """
+    Values for the columns of the sort table.
+    """
+    headers = _get_headers(wrapper)
+    arrival = _get_timestamp(wrapper.hdoc.date) or 0
+    subject, reply = get_base_subject(
+        _decode_header(headers.get('subject', '')))
+    message_ids = parse_message_ids(headers.get('message-id'))
+    return [arrival,
+            # the messages without a valid sent date are sorted by their
+            # internal date.
+            _get_timestamp(headers.get('date')) or arrival,
+            _get_mailbox(headers.get('from')),
+            _get_mailbox(headers.get('to')),
+            _get_mailbox(headers.get('cc')),
+            subject, int(reply),
+            _to_unicode(message_ids[0]) if message_ids else None,
+            _to_unicode(headers.get('in-reply-to', '')),
+            _to_unicode(headers.get('references', ''))]
+
+
+def _get_text_row(wrapper):
+    """
+    Values for the text columns.
+    """
+    headers = _get_headers(wrapper)
+    row = [_decode_header(headers.get(key, ''))
+           for key in ('from', 'to', 'cc', 'bcc', 'subject')]
+    row.append(u"\n".join(
+        u"%s: %s" % (key, _decode_header(value))
+        for key, value in sorted(headers.items())))
+    row.append(u"\n".join(_get_text_parts(wrapper)))
+    return row
+
+
+def _get_text_parts(wrapper):
+    for index in sorted(wrapper.cdocs):
+        cdoc = wrapper.cdocs[index]
+        ctype = (cdoc.content_type or cdoc.ctype or "").lower()
+        if not ctype.startswith('text/'):
+            continue
+        if (cdoc.content_disposition or "").lower() == 'attachment':
+            continue
+        payload = cdoc.raw
+        encoding = (cdoc.content_transfer_encoding or "").lower()
+        try:
+            if encoding == 'base64':
+                payload = base64.b64decode(payload)
+            elif encoding == 'quoted-printable':
+                payload = quopri.decodestring(payload)
+        except Exception:
+            pass
+        text = _to_unicode(payload, cdoc.charset)
+        if ctype == 'text/html':
+            text = _TAGS_RE.sub(u" ", text)
+        yield text
@@ -53,8 +53,17 @@ class Bouncer(object):
     # attaching the report and the original message. Leaving this for a future
     # iteration.
 
-    def __init__(self, inbox_collection):
+    def __init__(self, inbox_collection, account=None):
         self._inbox_collection = inbox_collection
+        self._account = account
+
+    def close(self):
+        """
+        Release the account that the bounces are delivered to.
+        """
+        if self._account is not None:
+            self._account.release()
+            self._account = None
 
     def bounce_message(self, error_data, to, date=None, orig=''):
         if not date:
@@ -84,9 +93,13 @@ class Bouncer(object):
 
 def bouncerFactory(soledad):
     user_id = soledad.uuid
-    # TODO should reuse same account that is used in other places, otherwise
-    # new mail in here won't be notified.
-    acc = Account(soledad, user_id)
+    acc = Account.acquire(soledad, user_id)
+
+    def release(failure):
+        acc.release()
+        return failure
+
     d = acc.callWhenReady(lambda _: acc.get_collection_by_mailbox(INBOX_NAME))
-    d.addCallback(lambda inbox: Bouncer(inbox))
+    d.addCallback(lambda inbox: Bouncer(inbox, acc))
+    d.addErrback(release)
     return d
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# sorting.py
+# Copyright (C) 2016 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+.. :py:module::sorting
+
+The base subject of a message and the threading algorithms of the IMAP SORT
+and THREAD extensions (rfc 5256).
+
+A thread is returned as a list of nodes, each node being a tuple with the
+uid of a message (None for a message that is only known by the references
+of others) and the list of the nodes of its children.
+"""
+import re
+
+from collections import namedtuple
+
+
+ThreadMessage = namedtuple(
+    'ThreadMessage',
+    ['uid', 'date', 'subject', 'reply', 'message_id', 'references'])
+"""
+The threading keys of a message: its uid, its sent date as a timestamp, its
+base subject, whether the subject is the one of a reply or a forward, its
+Message-ID and the Message-IDs that it refers to.
+"""
+
+
+_WSP_RE = re.compile(r'\s+', re.UNICODE)
+_BLOB = r'\[[^\[\]]*\] ?'
+_LEADER_RE = re.compile(
+    r'^(?:%s)*(?:re|fwd?) ?(?:%s)?:' % (_BLOB, _BLOB), re.I)
+_BLOB_RE = re.compile(r'^' + _BLOB)
+_MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+
+
+def get_base_subject(subject):
+    """
+    Extract the base subject of a subject, as described in rfc 5256.
+
+    :param subject: the decoded subject.
+    :type subject: unicode
+    :return: the base subject, and whether the subject was the one of a
+             reply or a forward.
+    :rtype: tuple
+    """
+    subject = _WSP_RE.sub(u' ', subject or u'')
+    reply = False
+    while True:
+        # (2) the trailers
+        while True:
+            if subject.endswith(u' '):
+                subject = subject[:-1]
+            elif subject.lower().endswith(u'(fwd)'):
+                subject = subject[:-5]
+                reply = True
+            else:
+                break
+        # (3) and (4) the leaders, and the blobs that are not the whole
+        # subject
+        while True:
+            subject = subject.lstrip(u' ')
+            match = _LEADER_RE.match(subject)
+            if match:
+                subject = subject[match.end():]
+                reply = True
+                continue
+            match = _BLOB_RE.match(subject)
+            if match and subject[match.end():]:
+                subject = subject[match.end():]
+                continue
+            break
+        # (5) a forward header around the whole subject
+        if subject.lower().startswith(u'[fwd:') and subject.endswith(u']'):
+            subject = subject[5:-1]
+            reply = True
+            continue
+        return subject, reply
+
+
+def parse_message_ids(value):
+    """
+    :return: the message ids in a Message-ID, In-Reply-To or References
+             header.
+    :rtype: list
+    """
+    return _MESSAGE_ID_RE.findall(value or '')
+
+
+def thread_ordered_subject(messages):
+    """
+    Thread messages with the ORDEREDSUBJECT algorithm: the messages with the
+    same base subject are children of the first one of them.
+
+    :param messages: the ThreadMessages, by sequence number.
+    :type messages: list
+    :return: the threads.
+    :rtype: list
+    """
+    keys = dict((msg.uid, (msg.date, seq)) for seq, msg in enumerate(messages))
+    threads = {}
+    for msg in sorted(messages, key=lambda msg: keys[msg.uid]):
+        threads.setdefault(msg.subject, []).append(msg.uid)
+    threads = sorted(threads.values(), key=lambda uids: keys[uids[0]])
+    return [(uids[0], [(uid, []) for uid in uids[1:]]) for uids in threads]
+
+
+class _Container(object):
+
+    def __init__(self, msg=None, seq=None):
+        self.msg = msg
+        self.seq = seq
+        self.parent = None
+        self.children = []
+
+    def key(self):
+        if self.msg is None:
+            return self.children[0].key()
+        return (self.msg.date, self.seq)
+
+    def subject(self):
+        if self.msg is None:
+            return self.children[0].subject()
+        return self.msg.subject
+
+    def is_ancestor_of(self, container):
+        while container is not None:
+            if container is self:
+                return True
+            container = container.parent
+        return False
+
+    def add_child(self, child):
+        if child.parent is not None:
+            child.parent.children.remove(child)
+        child.parent = self
+        self.children.append(child)
+
+    def node(self):
+        uid = self.msg.uid if self.msg is not None else None
+        return (uid, [child.node() for child in self.children])
+
+
+def thread_references(messages):
+    """
+    Thread messages with the REFERENCES algorithm: the messages are linked
+    by their Message-ID, In-Reply-To and References headers, and the threads
+    left with the same base subject are merged.
+
+    :param messages: the ThreadMessages, by sequence number.
+    :type messages: list
+    :return: the threads.
+    :rtype: list
+    """
+    by_id = {}
+    containers = []
+
+    def get_container(message_id):
+        container = by_id.get(message_id)
+        if container is None:
+            container = by_id[message_id] = _Container()
+            containers.append(container)
+        return container
+
+    # (1) link the messages with their references
+    for seq, msg in enumerate(messages):
+        container = by_id.get(msg.message_id)
+        if container is None or container.msg is not None:
+            # a missing or duplicated id makes for a message of its own
+            container = _Container()
+            containers.append(container)
+            if msg.message_id and msg.message_id not in by_id:
+                by_id[msg.message_id] = container
+        container.msg = msg
+        container.seq = seq
+
+        parent = None
+        for ref in msg.references:
+            ref_container = get_container(ref)
+            if (parent is not None and ref_container.parent is None and
+                    not ref_container.is_ancestor_of(parent)):
+                parent.add_child(ref_container)
+            parent = ref_container
+        if container.parent is not None:
+            container.parent.children.remove(container)
+            container.parent = None
+        if parent is not None and not container.is_ancestor_of(parent):
+            parent.add_child(container)
+
+    # (2) and (3) gather the roots, and prune the dummies
+    roots = _prune([c for c in containers if c.parent is None], True)
+
+    # (4) sort the roots
+    for root in roots:
+        _sort_children(root)
+    roots.sort(key=_Container.key)
+
+    # (5) merge the roots with the same base subject
+    table = {}
+    for root in roots:
+        subject = root.subject()
+        if not subject:
+            continue
+        other = table.get(subject)
+        if (other is None or
+                (other.msg is not None and root.msg is None) or
+                (other.msg is not None and other.msg.reply and
+                 root.msg is not None and not root.msg.reply)):
+            table[subject] = root
+    merged = []
+    for root in roots:
+        subject = root.subject()
+        other = table.get(subject) if subject else None
+        if other is None or other is root:
+            merged.append(root)
+            continue
+        if other.msg is None and root.msg is None:
+            for child in list(root.children):
+                other.add_child(child)
+        elif other.msg is None:
+            other.add_child(root)
+        elif root.msg.reply and not other.msg.reply:
+            other.add_child(root)
+        else:
+            dummy = _Container()
+            merged[merged.index(other)] = dummy
+            dummy.add_child(other)
+            dummy.add_child(root)
+            table[subject] = dummy
+
+    # (6) sort the siblings
+    for root in merged:
+        _sort_children(root)
+    merged.sort(key=_Container.key)
+    return [root.node() for root in merged]
+
+
+def _prune(containers, roots):
+    pruned = []
+    for container in containers:
+        container.children = _prune(container.children, False)
+        for child in container.children:
+            child.parent = container
+        if container.msg is None:
+            if not container.children:
+                continue
+            if not roots or len(container.children) == 1:
+                # the children take the place of the dummy
+                for child in container.children:
+                    child.parent = container.parent
+                pruned.extend(container.children)
+                continue
+        pruned.append(container)
+    return pruned
+
+
+def _sort_children(container):
+    for child in container.children:
+        _sort_children(child)
+    container.children.sort(key=_Container.key)
@@ -22,6 +22,7 @@ Process every new document of interest after every soledad synchronization,
 using the hooks that soledad exposes via plugins.
 """
 
+from collections import defaultdict
 from re import compile as regex_compile
 
 from zope.interface import implements
@@ -30,6 +31,8 @@ from twisted.plugin import IPlugin
 from twisted.logger import Logger
 
 from leap.bitmask.mail import constants
+from leap.bitmask.mail.adaptors import soledad_indexes as indexes
+from leap.bitmask.mail.adaptors.soledad import MailboxWrapper
 from leap.soledad.client.interfaces import ISoledadPostSyncPlugin
 
 log = Logger()
@@ -44,23 +47,35 @@ class MailProcessingPostSyncHook(object):
     implements(IPlugin, ISoledadPostSyncPlugin)
 
     META_DOC_PREFFIX = _get_doc_type_preffix(constants.METAMSGID)
-    watched_doc_types = (META_DOC_PREFFIX, )
+    FLAGS_DOC_PREFFIX = _get_doc_type_preffix(constants.FDOCID)
+    CONTENT_DOC_PREFFIX = _get_doc_type_preffix(constants.CDOCID)
+    watched_doc_types = (META_DOC_PREFFIX, FLAGS_DOC_PREFFIX)
+    # the mailbox documents do not have a known doc_id, so they get the
+    # generic one that soledad gives to any document created without an id.
+    GENERIC_DOC_PREFFIX = 'D-'
 
     _account = None
     _pending_docs = []
     _processing_deferreds = []
 
     def process_received_docs(self, doc_id_list):
+        self._processing_deferreds = []
+        watched_doc_ids = [
+            doc_id for doc_id in doc_id_list
+            if _get_doc_type_preffix(doc_id) in self.watched_doc_types]
+
+        for doc_id in watched_doc_ids:
+            log.info("Mail post-sync hook: processing %s" % doc_id)
+
         if self._has_configured_account():
-            process_fun = self._make_uid_index
+            self._process_docs(watched_doc_ids)
         else:
-            self._processing_deferreds = []
-            process_fun = self._queue_doc_id
+            for doc_id in watched_doc_ids:
+                self._queue_doc_id(doc_id)
 
-        for doc_id in doc_id_list:
-            if _get_doc_type_preffix(doc_id) in self.watched_doc_types:
-                log.info("Mail post-sync hook: processing %s" % doc_id)
-                process_fun(doc_id)
+        if self._has_configured_account():
+            self._invalidate_mbox_catalogue(doc_id_list)
+            self._discard_cached_cdocs(doc_id_list)
 
         return defer.gatherResults(self._processing_deferreds)
 
@@ -69,28 +84,153 @@ class MailProcessingPostSyncHook(object):
         if account:
             self._process_queued_docs()
 
+    def unset_account(self, account):
+        # an account that was replaced by another one for the same user must
+        # not unset the new one.
+        if self._account is account:
+            self.set_account(None)
+
     def _has_configured_account(self):
         return self._account is not None
 
     def _queue_doc_id(self, doc_id):
         self._pending_docs.append(doc_id)
 
-    def _make_uid_index(self, mdoc_id):
-        indexer = self._account.mbox_indexer
-        mbox_uuid = _get_mbox_uuid(mdoc_id)
+    def _process_docs(self, doc_ids):
+        # the meta docs are indexed in bulk, one insert for each mailbox.
+        mdoc_ids = defaultdict(list)
+        fdoc_ids = []
+        for doc_id in doc_ids:
+            if _get_doc_type_preffix(doc_id) == self.META_DOC_PREFFIX:
+                mbox_uuid = _get_mbox_uuid(doc_id)
+                if mbox_uuid:
+                    mdoc_ids[mbox_uuid].append(doc_id)
+            else:
+                self._invalidate_flags_counters(doc_id)
+                fdoc_ids.append(doc_id)
+
+        for mbox_uuid, mbox_mdoc_ids in mdoc_ids.items():
+            self._make_uid_index(mbox_uuid, mbox_mdoc_ids)
+        if fdoc_ids:
+            self._update_search_flags(fdoc_ids)
+            self._bump_modseqs(fdoc_ids)
+
+    def _invalidate_flags_counters(self, fdoc_id):
+        # the flags of a message changed remotely, so the counters of its
+        # mailbox have to be counted again.
+        mbox_uuid = _get_mbox_uuid_from_fdoc(fdoc_id)
         if mbox_uuid:
-            chash = _get_chash_from_mdoc(mdoc_id)
-            log.debug('Making index table for %s:%s' % (mbox_uuid, chash))
-            index_docid = constants.METAMSGID.format(
+            self._account.mbox_counters.invalidate(mbox_uuid)
+
+    def _make_uid_index(self, mbox_uuid, mdoc_ids):
+        indexer = self._account.mbox_indexer
+        counters = self._account.mbox_counters
+        log.debug('Making index table for %s: %d docs' % (
+            mbox_uuid, len(mdoc_ids)))
+        index_docids = [
+            constants.METAMSGID.format(
                 mbox_uuid=mbox_uuid.replace('-', '_'),
-                chash=chash)
-            # XXX could avoid creating table if I track which ones I already
-            # have seen -- but make sure *it's already created* before
-            # inserting the index entry!.
-            d = indexer.create_table(mbox_uuid)
-            d.addBoth(lambda _: indexer.insert_doc(mbox_uuid, index_docid))
+                chash=_get_chash_from_mdoc(mdoc_id))
+            for mdoc_id in mdoc_ids]
+
+        def invalidate_counters(result):
+            counters.invalidate(mbox_uuid)
+            return result
+
+        def notify_new(uids):
+            # the imap sessions that selected the mailbox are told about the
+            # new messages.
+            collection = self._account.get_open_collection(mbox_uuid)
+            if collection is not None:
+                collection.notify_new_to_listeners(sorted(set(uids)))
+
+        def index_for_search(uids):
+            d = self._account.index_msgs_for_search(index_docids)
+            d.addCallback(lambda _: uids)
+            return d
+
+        # the indexer remembers the tables that it already created.
+        d = indexer.create_table(mbox_uuid)
+        d.addBoth(lambda _: indexer.insert_docs(mbox_uuid, index_docids))
+        d.addCallback(index_for_search)
+        d.addBoth(invalidate_counters)
+        d.addCallback(notify_new)
+        d.addErrback(lambda f: log.failure(
+            'Error while indexing docs for %s' % mbox_uuid, f))
+        self._processing_deferreds.append(d)
+
+    def _bump_modseqs(self, fdoc_ids):
+        # the messages whose flags changed remotely get a new modseq, like
+        # the ones that are indexed in _make_uid_index.
+        indexer = self._account.mbox_indexer
+        mdoc_ids = defaultdict(list)
+        for fdoc_id in fdoc_ids:
+            mbox_uuid = _get_mbox_uuid_from_fdoc(fdoc_id)
+            chash = _get_chash_from_fdoc(fdoc_id)
+            if mbox_uuid and chash:
+                mdoc_ids[mbox_uuid].append(constants.METAMSGID.format(
+                    mbox_uuid=mbox_uuid.replace('-', '_'), chash=chash))
+
+        def notify_flags(_, mbox_uuid, mbox_mdoc_ids):
+            collection = self._account.get_open_collection(mbox_uuid)
+            if collection is not None:
+                return collection.notify_synced_flags(mbox_mdoc_ids)
+
+        for mbox_uuid, mbox_mdoc_ids in mdoc_ids.items():
+            d = indexer.bump_modseq(mbox_uuid, mbox_mdoc_ids)
+            d.addCallback(notify_flags, mbox_uuid, mbox_mdoc_ids)
+            d.addErrback(lambda f: log.failure(
+                'Error while updating the modseqs', f))
             self._processing_deferreds.append(d)
 
+    def _discard_cached_cdocs(self, doc_ids):
+        # the content documents do not change, but they could have been
+        # deleted by another replica.
+        cache = self._account.cdoc_cache
+        for doc_id in doc_ids:
+            if _get_doc_type_preffix(doc_id) == self.CONTENT_DOC_PREFFIX:
+                cache.discard(doc_id[len(self.CONTENT_DOC_PREFFIX):])
+
+    def _invalidate_mbox_catalogue(self, doc_ids):
+        # other documents get the generic doc_id too (the keys, for
+        # instance), so the catalogue is only invalidated if one of them is a
+        # mailbox. A deleted document has lost its type, so it could have been
+        # a mailbox.
+        generic_doc_ids = [
+            doc_id for doc_id in doc_ids
+            if _get_doc_type_preffix(doc_id) == self.GENERIC_DOC_PREFFIX]
+        if not generic_doc_ids:
+            return
+        store = self._account.store
+        catalogue = self._account.mbox_catalogue
+
+        def is_mbox_doc(doc):
+            if doc is None:
+                return False
+            if doc.is_tombstone():
+                return True
+            return doc.content.get(indexes.TYPE) == MailboxWrapper.model.type_
+
+        def invalidate_if_mbox_docs(docs):
+            if any(is_mbox_doc(doc) for doc in docs):
+                catalogue.invalidate()
+
+        d = defer.gatherResults([
+            store.get_doc(doc_id, include_deleted=True)
+            for doc_id in generic_doc_ids])
+        d.addCallback(invalidate_if_mbox_docs)
+        d.addErrback(lambda f: log.failure(
+            'Error while looking for mailbox docs', f))
+        self._processing_deferreds.append(d)
+
+    def _update_search_flags(self, fdoc_ids):
+        # the flags of the messages changed remotely, and they have to be
+        # searched by their new values.
+        d = self._account.search_indexer.update_flags_from_docs(fdoc_ids)
+        d.addErrback(lambda f: log.failure(
+            'Error while updating the search index', f))
+        self._processing_deferreds.append(d)
+
     def _process_queued_docs(self):
         assert(self._has_configured_account())
         pending = self._pending_docs
@@ -107,6 +247,8 @@ class MailProcessingPostSyncHook(object):
 
 _mbox_uuid_regex = regex_compile(constants.METAMSGID_MBOX_RE)
 _mdoc_chash_regex = regex_compile(constants.METAMSGID_CHASH_RE)
+_fdoc_mbox_uuid_regex = regex_compile(constants.FDOCID_MBOX_RE)
+_fdoc_chash_regex = regex_compile(constants.FDOCID_CHASH_RE)
 
 
 def _get_mbox_uuid(doc_id):
@@ -115,7 +257,19 @@ def _get_mbox_uuid(doc_id):
         return matches[0].replace('_', '-')
 
 
+def _get_mbox_uuid_from_fdoc(doc_id):
+    matches = _fdoc_mbox_uuid_regex.findall(doc_id)
+    if matches:
+        return matches[0].replace('_', '-')
+
+
 def _get_chash_from_mdoc(doc_id):
     matches = _mdoc_chash_regex.findall(doc_id)
     if matches:
         return matches[0]
+
+
+def _get_chash_from_fdoc(doc_id):
+    matches = _fdoc_chash_regex.findall(doc_id)
+    if matches:
+        return matches[0]
@@ -169,6 +169,7 @@ class IMAP4HelperMixin(SoledadTestMixin):
         return d
 
     def tearDown(self):
+        self.acc.logout()
         SoledadTestMixin.tearDown(self)
         del self._soledad
         del self.client
@@ -30,25 +30,60 @@ crypto_backend = default_backend()
 _parser = Parser()
 
 
+# XXX what other ctypes should be considered body?
+BODY_CTYPES = ("text/plain", "text/html")
+
+
+def walk_msg(msg):
+    """
+    Walk the message tree once, hashing each payload only once.
+
+    This is what the ingestion of every incoming, appended or copied message
+    goes through, so it should not walk the message, or hash a payload,
+    more than once.
+
+    :param msg: the parsed message
+    :type msg: email.message.Message
+    :return: a tuple with the part map of the message (see `get_tree`), the
+             list of raw docs for its non-multipart parts (see
+             `get_raw_docs`) and the payload-hash of its body (see
+             `get_body_phash`).
+    :rtype: tuple
+    """
+    raw_docs = []
+    body_phash = []
+
+    def walk_part(part):
+        payload = part.get_payload()
+        ctype = part.get_content_type()
+        p = {}
+        p['ctype'] = ctype
+        p['headers'] = part.items()
+
+        is_multi = part.is_multipart()
+        if is_multi:
+            p['part_map'] = dict(
+                [(idx, walk_part(sub)) for idx, sub in enumerate(payload, 1)])
+            p['parts'] = len(payload)
+            p['phash'] = None
+        else:
+            phash = get_hash(payload)
+            p['parts'] = 0
+            p['size'] = len(payload)
+            p['phash'] = phash
+            p['part_map'] = {}
+            raw_docs.append(_get_raw_doc(part, ctype, payload, phash))
+            if not body_phash and ctype in BODY_CTYPES:
+                body_phash.append(phash)
+        p['multi'] = is_multi
+        return p
+
+    tree = walk_part(msg)
+    return tree, raw_docs, first(body_phash)
+
+
 def get_tree(msg):
-    p = {}
-    p['ctype'] = msg.get_content_type()
-    p['headers'] = msg.items()
-
-    payload = msg.get_payload()
-    is_multi = msg.is_multipart()
-    if is_multi:
-        p['part_map'] = dict(
-            [(idx, get_tree(part)) for idx, part in enumerate(payload, 1)])
-        p['parts'] = len(payload)
-        p['phash'] = None
-    else:
-        p['parts'] = 0
-        p['size'] = len(payload)
-        p['phash'] = get_hash(payload)
-        p['part_map'] = {}
-    p['multi'] = is_multi
-    return p
+    return walk_msg(msg)[0]
 
 
 def get_tree_from_string(messagestr):
@@ -59,11 +94,7 @@ def get_body_phash(msg):
     """
     Find the body payload-hash for this message.
     """
-    for part in msg.walk():
-        # XXX what other ctypes should be considered body?
-        if part.get_content_type() in ("text/plain", "text/html"):
-            # XXX avoid hashing again
-            return get_hash(part.get_payload())
+    return walk_msg(msg)[2]
 
 
 def get_raw_docs(msg):
@@ -72,17 +103,21 @@ def get_raw_docs(msg):
     index the content. Here we remove any mutable part, as the the filename
     in the content disposition.
     """
-    return (
-        {'type': 'cnt',
-         'raw': part.get_payload(),
-         'phash': get_hash(part.get_payload()),
-         'content-type': part.get_content_type(),
-         'charset': part.get_content_charset(),
-         'content-disposition': first(part.get(
-             'content-disposition', '').split(';')),
-         'content-transfer-encoding': part.get(
-             'content-transfer-encoding', '')
-         } for part in msg.walk() if not isinstance(part.get_payload(), list))
+    return iter(walk_msg(msg)[1])
+
+
+def _get_raw_doc(part, ctype, payload, phash):
+    return {
+        'type': 'cnt',
+        'raw': payload,
+        'phash': phash,
+        'content-type': ctype,
+        'charset': part.get_content_charset(),
+        'content-disposition': first(part.get(
+            'content-disposition', '').split(';')),
+        'content-transfer-encoding': part.get(
+            'content-transfer-encoding', '')
+    }
 
 
 def get_hash(s):
@@ -23,9 +23,11 @@ from functools import partial
 from twisted.internet import defer
 
 from leap.bitmask.mail.adaptors import models
+from leap.bitmask.mail.adaptors.soledad import ContentDocCache
 from leap.bitmask.mail.adaptors.soledad import SoledadDocumentWrapper
 from leap.bitmask.mail.adaptors.soledad import SoledadIndexMixin
 from leap.bitmask.mail.adaptors.soledad import SoledadMailAdaptor
+from leap.bitmask.mail.adaptors.soledad import content_dedup_stats
 from leap.bitmask.mail.testing.common import SoledadTestMixin
 
 from email.MIMEMultipart import MIMEMultipart
@@ -326,7 +328,7 @@ class SoledadMailAdaptorTestCase(SoledadTestMixin):
         self.assertTrue(msg.wrapper.cdocs is not None)
         self.assertEquals(len(msg.wrapper.cdocs), 1)
         self.assertEquals(msg.wrapper.fdoc.chash, chash)
-        self.assertEquals(msg.wrapper.fdoc.size, 3837)
+        self.assertEquals(msg.wrapper.fdoc.size, 3834)
         self.assertEquals(msg.wrapper.hdoc.chash, chash)
         self.assertEqual(dict(msg.wrapper.hdoc.headers)['Subject'],
                          subject)
@@ -350,6 +352,62 @@ class SoledadMailAdaptorTestCase(SoledadTestMixin):
         self.assertEqual(
             'YSB1dGY4IG1lc3NhZ2U=\n', msg.wrapper.cdocs[1].raw)
 
+    @defer.inlineCallbacks
+    def test_get_msg_from_string_async(self):
+        with open(os.path.join(HERE, '..', 'rfc822.multi.message')) as f:
+            raw = f.read()
+        adaptor = self.get_adaptor()
+        inline = adaptor.get_msg_from_string(MessageClass, raw)
+
+        msg = yield adaptor.get_msg_from_string_async(MessageClass, raw)
+        self.assertEqual(msg.wrapper.hdoc.serialize(),
+                         inline.wrapper.hdoc.serialize())
+
+        self.patch(SoledadMailAdaptor, '_parsing_pool', None)
+        self.patch(adaptor, 'parsing_pool_threshold', 0)
+        pool = SoledadMailAdaptor.start_parsing_pool(1)
+        self.addCleanup(SoledadMailAdaptor.stop_parsing_pool)
+        run = pool.run
+        ran = []
+
+        def record_run(f, *args):
+            ran.append(f.__name__)
+            return run(f, *args)
+
+        self.patch(pool, 'run', record_run)
+        msg = yield adaptor.get_msg_from_string_async(MessageClass, raw)
+        self.assertEqual(ran, ['_split_into_parts'])
+        self.assertEqual(msg.wrapper.mdoc.serialize(),
+                         inline.wrapper.mdoc.serialize())
+        self.assertEqual(msg.wrapper.fdoc.serialize(),
+                         inline.wrapper.fdoc.serialize())
+        self.assertEqual(msg.wrapper.hdoc.serialize(),
+                         inline.wrapper.hdoc.serialize())
+        self.assertEqual(
+            [cdoc.serialize() for cdoc in msg.wrapper.cdocs.values()],
+            [cdoc.serialize() for cdoc in inline.wrapper.cdocs.values()])
+
+    def test_get_msg_from_string_fetch_items(self):
+        msg = MIMEMultipart()
+        msg['Subject'] = 'Test multipart mail'
+        msg['From'] = 'foo@bar.com'
+        msg.attach(MIMEText(u'a utf8 message', _charset='utf-8'))
+        adaptor = self.get_adaptor()
+
+        msg = adaptor.get_msg_from_string(MessageClass, msg.as_string())
+
+        envelope = msg.wrapper.hdoc.envelope
+        self.assertEqual('Test multipart mail', envelope[1])
+        self.assertEqual([[None, None, 'foo', 'bar.com']], envelope[2])
+
+        structure = msg.wrapper.hdoc.bodystructure
+        self.assertEqual('mixed', structure[1])
+        text = structure[0]
+        self.assertEqual(['text', 'plain'], text[:2])
+        self.assertEqual('base64', text[5])
+        self.assertEqual(len('YSB1dGY4IG1lc3NhZ2U=\n'), text[6])
+        self.assertEqual(1, text[7])
+
     def test_get_msg_from_docs(self):
         adaptor = self.get_adaptor()
         mdoc = dict(
@@ -407,6 +465,63 @@ class SoledadMailAdaptorTestCase(SoledadTestMixin):
         d.addCallback(check_create_result)
         return d
 
+    @defer.inlineCallbacks
+    def test_create_msg_skips_existing_cdocs(self):
+        adaptor = self.get_adaptor()
+        with open(os.path.join(HERE, '..', 'rfc822.multi.message')) as f:
+            raw = f.read()
+        msg = adaptor.get_msg_from_string(MessageClass, raw)
+        msg.get_wrapper().set_mbox_uuid('inbox')
+        yield adaptor.create_msg(adaptor.store, msg)
+
+        # the same message, delivered to another mailbox, only writes its
+        # meta and flags documents.
+        created = []
+        create_doc = adaptor.store.create_doc
+
+        def record_create_doc(content, doc_id=None):
+            created.append(doc_id)
+            return create_doc(content, doc_id=doc_id)
+
+        adaptor.store.create_doc = record_create_doc
+        skipped_docs = content_dedup_stats.skipped_docs
+        saved_bytes = content_dedup_stats.saved_bytes
+        msg = adaptor.get_msg_from_string(MessageClass, raw)
+        msg.get_wrapper().set_mbox_uuid('archive')
+        yield adaptor.create_msgs(adaptor.store, [msg])
+        self.assertEqual(
+            sorted(doc_id[0] for doc_id in created), ['F', 'H', 'M'])
+        cdocs = msg.get_wrapper().cdocs.values()
+        for cdoc in cdocs:
+            self.assertTrue(cdoc.doc_id.startswith('C-'))
+        self.assertEqual(
+            content_dedup_stats.skipped_docs - skipped_docs, len(cdocs))
+        self.assertEqual(
+            content_dedup_stats.saved_bytes - saved_bytes,
+            sum(len(cdoc.raw) for cdoc in cdocs))
+
+    @defer.inlineCallbacks
+    def test_del_msgs_missing_docs(self):
+        adaptor = self.get_adaptor()
+        with open(os.path.join(HERE, '..', 'rfc822.message')) as f:
+            raw = f.read()
+        msg = adaptor.get_msg_from_string(MessageClass, raw)
+        msg.get_wrapper().set_mbox_uuid('inbox')
+        wrapper = yield adaptor.create_msg(adaptor.store, msg)
+        mdoc_id = wrapper.mdoc.doc_id
+        fdoc_id = wrapper.fdoc.doc_id
+        adaptor.cdoc_cache = ContentDocCache()
+        cdoc = wrapper.cdocs[1]
+        adaptor.cdoc_cache.add(cdoc.phash, cdoc)
+
+        missing = 'M-inbox-' + 'f' * 32
+        deleted = yield adaptor.del_msgs(adaptor.store, [mdoc_id, missing])
+        self.assertEqual(deleted, [mdoc_id, missing])
+        self.assertEqual(len(adaptor.cdoc_cache), 0)
+        docs = yield defer.gatherResults([
+            adaptor.store.get_doc(mdoc_id), adaptor.store.get_doc(fdoc_id)])
+        self.assertEqual(docs, [None, None])
+
     def test_update_msg(self):
         adaptor = self.get_adaptor()
         with open(os.path.join(HERE, '..', 'rfc822.message')) as f:
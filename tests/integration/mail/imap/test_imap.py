@@ -28,6 +28,7 @@ XXX add authors from the original twisted tests.
 import os
 import string
 import types
+import zlib
 
 
 from twisted.mail import imap4
@@ -37,8 +38,11 @@ from twisted.python import failure
 
 from twisted import cred
 
-from leap.bitmask.mail.imap.mailbox import IMAPMailbox
+from leap.bitmask.mail.adaptors import soledad as soledad_adaptor
+from leap.bitmask.mail.imap.mailbox import IMAPMailbox, MailboxEvents
 from leap.bitmask.mail.imap.messages import CaseInsensitiveDict
+from leap.bitmask.mail.imap.server import _DeflateTransport
+from leap.bitmask.mail.mail import MessageCollection
 from leap.bitmask.mail.testing.imap import IMAP4HelperMixin
 
 
@@ -485,7 +489,10 @@ class LEAPIMAP4ServerTestCase(IMAP4HelperMixin):
 
         d = defer.gatherResults([self.loopback(), d1])
         expected = {'IMAP4rev1': None, 'NAMESPACE': None, 'LITERAL+': None,
-                    'IDLE': None}
+                    'IDLE': None, 'MOVE': None, 'ENABLE': None,
+                    'CONDSTORE': None, 'QRESYNC': None,
+                    'COMPRESS': ['DEFLATE'], 'SORT': None,
+                    'THREAD': ['ORDEREDSUBJECT', 'REFERENCES']}
         d.addCallback(lambda _: self.assertEqual(expected, caps))
         return d
 
@@ -505,7 +512,10 @@ class LEAPIMAP4ServerTestCase(IMAP4HelperMixin):
         d = defer.gatherResults([self.loopback(), d1])
 
         expCap = {'IMAP4rev1': None, 'NAMESPACE': None,
-                  'IDLE': None, 'LITERAL+': None,
+                  'IDLE': None, 'LITERAL+': None, 'MOVE': None,
+                  'ENABLE': None, 'CONDSTORE': None, 'QRESYNC': None,
+                  'COMPRESS': ['DEFLATE'], 'SORT': None,
+                  'THREAD': ['ORDEREDSUBJECT', 'REFERENCES'],
                   'AUTH': ['CRAM-MD5']}
 
         d.addCallback(lambda _: self.assertEqual(expCap, caps))
@@ -1040,6 +1050,873 @@ class LEAPIMAP4ServerTestCase(IMAP4HelperMixin):
         # the uids of the deleted messages
         self.assertItemsEqual(self.results, [1, 3])
 
+    def testExpungeSequenceNumbers(self):
+        """
+        Test that expunge returns the sequence numbers of the messages, from
+        the highest to the lowest.
+        """
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxexpungemsn'
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def save_mailbox(mailbox):
+            self.mailbox = mailbox
+
+        def get_mailbox():
+            d = acc.getMailbox(mailbox_name)
+            d.addCallback(save_mailbox)
+            return d
+
+        def add_messages():
+            # the first uid is expunged, so that uids and sequence numbers
+            # do not match.
+            d = self.mailbox.addMessage('test 0', flags=('\\Deleted',))
+            d.addCallback(lambda _: self.mailbox.expunge())
+            for i, flags in enumerate([('\\Deleted',), (), ('\\Deleted',),
+                                       (), ()]):
+                d.addCallback(lambda _, i=i, flags=flags:
+                              self.mailbox.addMessage(
+                                  'test %d' % (i + 1), flags=flags))
+            return d
+
+        def expunge():
+            return self.client.expunge()
+
+        def expunged(results):
+            self.results = results
+
+        self.results = None
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallback(strip(get_mailbox))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(expunge), self._ebGeneral)
+        d1.addCallbacks(expunged, self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda _: self.mailbox.collection.all_uid_iter())
+        return d.addCallback(self._cbTestExpungeSequenceNumbers)
+
+    def _cbTestExpungeSequenceNumbers(self, uids):
+        self.assertEqual(sorted(uids), [3, 5, 6])
+        self.assertEqual(self.results, [3, 1])
+
+    def testCopyAndMove(self):
+        """
+        Test the bulk COPY, and the UID MOVE command.
+        """
+        acc = self.server.theAccount
+        mailboxes = {}
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def add_mailboxes():
+            d = acc.addMailbox('copysource')
+            d.addCallback(lambda _: acc.addMailbox('copytarget'))
+            d.addCallback(lambda _: acc.getMailbox('copysource'))
+            d.addCallback(save_mailbox, 'source')
+            d.addCallback(lambda _: acc.getMailbox('copytarget'))
+            d.addCallback(save_mailbox, 'target')
+            return d
+
+        def save_mailbox(mailbox, key):
+            mailboxes[key] = mailbox
+
+        def add_messages():
+            source = mailboxes['source']
+            d = source.addMessage('test 1', flags=('\\Seen',))
+            d.addCallback(lambda _: source.addMessage('test 2', ()))
+            d.addCallback(lambda _: source.addMessage('test 3', ()))
+            return d
+
+        def select():
+            return self.client.select('copysource')
+
+        def copy():
+            return self.client.copy('1:2', 'copytarget', uid=False)
+
+        def move():
+            cmd = imap4.Command(
+                'UID MOVE', '2:3 copytarget', wantResponse=('EXPUNGE',))
+            return self.client.sendCommand(cmd)
+
+        def moved((lines, _)):
+            self.expunged = [int(parts[0]) for parts in lines
+                             if parts[1:] == ['EXPUNGE']]
+
+        def get_uids():
+            return defer.gatherResults([
+                mailboxes['source'].collection.all_uid_iter(),
+                mailboxes['target'].collection.all_uid_iter()])
+
+        d1 = self.connected.addCallback(strip(login))
+        d1.addCallbacks(strip(add_mailboxes), self._ebGeneral)
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(copy), self._ebGeneral)
+        d1.addCallbacks(strip(move), self._ebGeneral)
+        d1.addCallbacks(moved, self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(strip(get_uids))
+        return d.addCallback(self._cbTestCopyAndMove)
+
+    def _cbTestCopyAndMove(self, (source_uids, target_uids)):
+        self.assertEqual(sorted(source_uids), [1])
+        # message 2 was copied and then moved, so it got a new uid
+        self.assertEqual(sorted(target_uids), [1, 3, 4])
+        self.assertEqual(self.expunged, [3, 2])
+
+    def testMoveToSelectedMailbox(self):
+        """
+        Test that a MOVE to the selected mailbox is refused, and that the
+        messages are kept.
+        """
+        acc = self.server.theAccount
+        mailboxes = {}
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def add_messages():
+            d = acc.addMailbox('movesource')
+            d.addCallback(lambda _: acc.getMailbox('movesource'))
+            d.addCallback(save_mailbox)
+            d.addCallback(lambda source: source.addMessage('test 1', ()))
+            d.addCallback(lambda _: mailboxes['source'].addMessage(
+                'test 2', ()))
+            return d
+
+        def save_mailbox(mailbox):
+            mailboxes['source'] = mailbox
+            return mailbox
+
+        def select():
+            return self.client.select('movesource')
+
+        def move():
+            cmd = imap4.Command('UID MOVE', '1:* movesource')
+            return self.client.sendCommand(cmd)
+
+        def refused(failure):
+            failure.trap(imap4.IMAP4Exception)
+            self.refused = True
+
+        self.refused = False
+        d1 = self.connected.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(move), self._ebGeneral)
+        d1.addErrback(refused)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(
+            lambda _: mailboxes['source'].collection.all_uid_iter())
+        return d.addCallback(self._cbTestMoveToSelectedMailbox)
+
+    def _cbTestMoveToSelectedMailbox(self, uids):
+        self.assertTrue(self.refused)
+        self.assertEqual(sorted(uids), [1, 2])
+
+    def testFetchWindows(self):
+        """
+        Test that a FETCH spanning several windows returns all the messages
+        """
+        self.patch(IMAPMailbox, 'fetch_window_size', 2)
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxfetch'
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def add_messages():
+            d = acc.getMailbox(mailbox_name)
+
+            def add(mailbox):
+                d = defer.succeed(None)
+                for i in range(5):
+                    d.addCallback(
+                        lambda _, i=i: mailbox.addMessage(
+                            'Subject: test %d\r\n\r\nbody %d' % (i, i),
+                            ()))
+                return d
+            d.addCallback(add)
+            return d
+
+        def fetch():
+            return self.client.fetchSpecific(
+                '1:*', uid=True, headerType='TEXT')
+
+        def fetched(results):
+            self.results = results
+
+        self.results = None
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(fetch), self._ebGeneral)
+        d1.addCallbacks(fetched, self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestFetchWindows)
+
+    def _cbTestFetchWindows(self, ignored):
+        self.assertEqual(sorted(self.results.keys()), [1, 2, 3, 4, 5])
+        for seq, result in self.results.items():
+            self.assertEqual(result[0][2], 'body %d' % (seq - 1))
+
+    def testFetchSequenceNumbers(self):
+        """
+        Test that the sequence numbers in FETCH and STORE refer to the
+        messages that the client knows about, and that the responses to the
+        UID commands carry them too.
+        """
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxfetchmsn'
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def add_messages():
+            d = acc.getMailbox(mailbox_name)
+
+            def add(mailbox):
+                # the first uid is expunged, so that uids and sequence
+                # numbers do not match.
+                d = mailbox.addMessage('test 0', flags=('\\Deleted',))
+                d.addCallback(lambda _: mailbox.expunge())
+                for i in range(1, 4):
+                    d.addCallback(
+                        lambda _, i=i: mailbox.addMessage(
+                            'Subject: test %d\r\n\r\nbody %d' % (i, i),
+                            ()))
+                return d
+            d.addCallback(add)
+            return d
+
+        def fetch():
+            client = self.client
+            commands = [
+                ('uids', lambda: client.fetchUID('2:*')),
+                ('flags', lambda: client.fetchFlags('2:3')),
+                ('uid_flags', lambda: client.fetchFlags('3', uid=True)),
+                ('headers', lambda: client.fetchHeaders('1')),
+                ('store', lambda: client.setFlags('1', ['\\Seen'])),
+                ('uid_store', lambda: client.setFlags(
+                    '4', ['\\Flagged'], uid=True)),
+                ('stored', lambda: client.fetchFlags('1:*'))]
+            d = defer.succeed(None)
+            for name, command in commands:
+                d.addCallback(lambda _, command=command: command())
+                d.addCallback(
+                    lambda result, name=name: self.results.update(
+                        {name: result}))
+            return d
+
+        self.results = {}
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(fetch), self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestFetchSequenceNumbers)
+
+    def _cbTestFetchSequenceNumbers(self, ignored):
+        results = self.results
+        self.assertEqual(results['uids'], {2: {'UID': '3'}, 3: {'UID': '4'}})
+        self.assertEqual(results['flags'], {2: {'FLAGS': []},
+                                            3: {'FLAGS': []}})
+        self.assertEqual(results['uid_flags'], {2: {'FLAGS': [],
+                                                    'UID': '3'}})
+        self.assertEqual(results['headers'],
+                         {1: {'RFC822.HEADER': 'Subject: test 1\r\n'}})
+        self.assertEqual(results['stored'], {1: {'FLAGS': ['\\Seen']},
+                                             2: {'FLAGS': []},
+                                             3: {'FLAGS': ['\\Flagged']}})
+
+    def testFetchWindowError(self):
+        """
+        Test that a FETCH fails if one of its windows cannot be retrieved
+        """
+        self.patch(IMAPMailbox, 'fetch_window_size', 2)
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxfetcherror'
+        calls = []
+        get_messages = MessageCollection.get_messages_by_doc_ids
+
+        def get_messages_by_doc_ids(collection, *args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                return defer.fail(RuntimeError('window error'))
+            return get_messages(collection, *args, **kwargs)
+
+        self.patch(
+            MessageCollection, 'get_messages_by_doc_ids',
+            get_messages_by_doc_ids)
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def add_messages():
+            d = acc.getMailbox(mailbox_name)
+
+            def add(mailbox):
+                d = defer.succeed(None)
+                for i in range(5):
+                    d.addCallback(
+                        lambda _, i=i: mailbox.addMessage(
+                            'Subject: test %d\r\n\r\nbody %d' % (i, i),
+                            ()))
+                return d
+            d.addCallback(add)
+            return d
+
+        def fetch():
+            return self.client.fetchSpecific(
+                '1:*', uid=True, headerType='TEXT')
+
+        def failed(failure):
+            failure.trap(imap4.IMAP4Exception)
+            self.failed = str(failure.value)
+
+        self.failed = None
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(fetch), self._ebGeneral)
+        d1.addErrback(failed)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestFetchWindowError)
+
+    def _cbTestFetchWindowError(self, ignored):
+        self.assertEqual(self.failed, 'FETCH failed: window error')
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 2)
+
+    def testFetchPartial(self):
+        """
+        Test that successive partial fetches return the requested ranges
+        """
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxpartial'
+        message = 'Subject: partial\r\n\r\n0123456789'
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def add_message():
+            d = acc.getMailbox(mailbox_name)
+            d.addCallback(lambda mailbox: mailbox.addMessage(message, ()))
+            return d
+
+        def fetch(offset):
+            d = self.client.fetchSpecific(
+                '1', uid=True, offset=offset, length=8)
+            d.addCallback(self.results.append)
+            return d
+
+        self.results = []
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallbacks(strip(add_message), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        for offset in (0, 8, 16, 24, 32):
+            d1.addCallbacks(strip(lambda o=offset: fetch(o)), self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestFetchPartial)
+
+    def _cbTestFetchPartial(self, ignored):
+        self.assertEqual(len(self.results), 5)
+        chunks = []
+        for offset, result in zip((0, 8, 16, 24, 32), self.results):
+            body = result[1][0]
+            self.assertEqual(body[:2], ['BODY', []])
+            self.assertEqual(body[2], '<%d>' % offset)
+            chunks.append(body[3])
+        self.assertEqual(chunks[-1], '')
+        self.assertTrue(''.join(chunks).endswith('\r\n\r\n0123456789'))
+
+    def testFetchBodyStructure(self):
+        """
+        Test that the stored BODYSTRUCTURE and ENVELOPE are fetched, and
+        that they are computed for messages stored without them
+        """
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxstructure'
+        message = (
+            'From: foo@bar.com\r\nSubject: structure %d\r\n'
+            'MIME-Version: 1.0\r\n'
+            'Content-Type: multipart/mixed; boundary="XX"\r\n\r\n'
+            '--XX\r\nContent-Type: text/plain\r\n\r\n'
+            'first line\r\nsecond line\r\n'
+            '--XX\r\nContent-Type: application/octet-stream\r\n'
+            'Content-Transfer-Encoding: base64\r\n\r\nAAECAwQF\r\n'
+            '--XX--\r\n')
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def add_messages():
+            d = acc.getMailbox(mailbox_name)
+
+            def add(mailbox):
+                d = mailbox.addMessage(message % 1, ())
+
+                def add_without_structure(_):
+                    self.patch(soledad_adaptor, 'get_body_structure',
+                               lambda msg: [])
+                    return mailbox.addMessage(message % 2, ())
+                d.addCallback(add_without_structure)
+                return d
+            d.addCallback(add)
+            return d
+
+        def fetch():
+            d = self.client.fetchBodyStructure('1:2', uid=True)
+            d.addCallback(lambda result: setattr(self, 'structures', result))
+            d.addCallback(
+                lambda _: self.client.fetchEnvelope('1:2', uid=True))
+            d.addCallback(lambda result: setattr(self, 'envelopes', result))
+            return d
+
+        self.structures = self.envelopes = None
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(fetch), self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestFetchBodyStructure)
+
+    def _cbTestFetchBodyStructure(self, ignored):
+        structure = self.structures[1]['BODYSTRUCTURE']
+        self.assertEqual(structure[0][:2], ['text', 'plain'])
+        self.assertEqual(structure[0][6:8], ['23', '2'])
+        self.assertEqual(structure[1][:2], ['application', 'octet-stream'])
+        self.assertEqual(structure[1][6], '8')
+        self.assertEqual(structure[2:4], ['mixed', ['boundary', 'XX']])
+        self.assertEqual(self.structures[2]['BODYSTRUCTURE'], structure)
+
+        for uid in (1, 2):
+            envelope = self.envelopes[uid]['ENVELOPE']
+            self.assertEqual(envelope[1], 'structure %d' % uid)
+            self.assertEqual(envelope[2], [[None, None, 'foo', 'bar.com']])
+
+    def testCondStore(self):
+        """
+        Test that FETCH CHANGEDSINCE only returns the messages changed after
+        a modseq, and that STORE UNCHANGEDSINCE leaves alone the messages
+        changed after it
+        """
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxcondstore'
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def add_messages():
+            d = acc.getMailbox(mailbox_name)
+
+            def add(mailbox):
+                self.mailbox = mailbox
+                d = defer.succeed(None)
+                for i in range(3):
+                    d.addCallback(
+                        lambda _, i=i: mailbox.addMessage('test %d' % i, ()))
+                d.addCallback(lambda _: mailbox.getHighestModSeq())
+                d.addCallback(lambda modseq: setattr(self, 'modseq', modseq))
+                return d
+            d.addCallback(add)
+            return d
+
+        def store():
+            return self.client.addFlags('2', ('\\Seen',), uid=True)
+
+        def fetch():
+            return self.client.sendCommand(imap4.Command(
+                'UID FETCH', '1:* (FLAGS) (CHANGEDSINCE %d)' % self.modseq,
+                wantResponse=('FETCH',)))
+
+        def fetched((lines, tagline)):
+            self.fetched = lines
+
+        def conditional_store():
+            return self.client.sendCommand(imap4.Command(
+                'UID STORE',
+                '1:2 (UNCHANGEDSINCE %d) +FLAGS (\\Flagged)' % self.modseq,
+                wantResponse=('FETCH',)))
+
+        def stored((lines, tagline)):
+            self.stored = lines
+            self.tagline = tagline
+
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(store), self._ebGeneral)
+        d1.addCallbacks(strip(fetch), self._ebGeneral)
+        d1.addCallbacks(fetched, self._ebGeneral)
+        d1.addCallbacks(strip(conditional_store), self._ebGeneral)
+        d1.addCallbacks(stored, self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda _: self.mailbox.getHighestModSeq())
+        return d.addCallback(self._cbTestCondStore)
+
+    def _cbTestCondStore(self, highest):
+        self.assertEqual(len(self.fetched), 1)
+        msgid, _, items = self.fetched[0]
+        items = dict(zip(items[::2], items[1::2]))
+        self.assertEqual(msgid, '2')
+        self.assertEqual(items['UID'], '2')
+        self.assertIn('\\Seen', items['FLAGS'])
+        self.assertEqual(items['MODSEQ'], [str(self.modseq + 1)])
+
+        # the message changed after the modseq keeps its flags
+        self.assertTrue(self.tagline.startswith("OK [MODIFIED 2]"))
+        self.assertEqual(len(self.stored), 1)
+        msgid, _, items = self.stored[0]
+        items = dict(zip(items[::2], items[1::2]))
+        self.assertEqual(items['UID'], '1')
+        self.assertIn('\\Flagged', items['FLAGS'])
+        self.assertEqual(items['MODSEQ'], [str(highest)])
+
+    def testQResync(self):
+        """
+        Test that once QRESYNC is enabled, the expunged messages are
+        reported as VANISHED, both by EXPUNGE and when resynchronizing
+        """
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxqresync'
+        self.untagged = []
+        sendUntaggedResponse = self.server.sendUntaggedResponse
+
+        def record(message, *args, **kwargs):
+            self.untagged.append(message)
+            return sendUntaggedResponse(message, *args, **kwargs)
+
+        self.patch(self.server, 'sendUntaggedResponse', record)
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def enable():
+            return self.client.sendCommand(imap4.Command(
+                'ENABLE', 'QRESYNC', wantResponse=('ENABLED',)))
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def add_messages():
+            d = acc.getMailbox(mailbox_name)
+
+            def add(mailbox):
+                self.mailbox = mailbox
+                d = defer.succeed(None)
+                for i in range(3):
+                    d.addCallback(
+                        lambda _, i=i: mailbox.addMessage('test %d' % i, ()))
+                d.addCallback(lambda _: mailbox.getHighestModSeq())
+                d.addCallback(lambda modseq: setattr(self, 'modseq', modseq))
+                return d
+            d.addCallback(add)
+            return d
+
+        def expunge():
+            d = self.client.addFlags('3', ('\\Deleted',), uid=True)
+            d.addCallback(lambda _: self.client.expunge())
+            d.addCallback(
+                lambda _: self.client.addFlags('1', ('\\Seen',), uid=True))
+            return d
+
+        def fetch():
+            return self.client.sendCommand(imap4.Command(
+                'UID FETCH',
+                '1:* (FLAGS) (CHANGEDSINCE %d VANISHED)' % self.modseq,
+                wantResponse=('FETCH',)))
+
+        def resync():
+            del self.untagged[:]
+            return self.client.sendCommand(imap4.Command(
+                'SELECT', '%s (QRESYNC (%d %d))' % (
+                    mailbox_name, self.mailbox.getUIDValidity(),
+                    self.modseq),
+                wantResponse=('FETCH',)))
+
+        def resynced((lines, tagline)):
+            self.resynced = [line for line in lines if line[1:2] == ['FETCH']]
+
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(enable), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(expunge), self._ebGeneral)
+        d1.addCallbacks(strip(fetch), self._ebGeneral)
+        d1.addCallbacks(
+            lambda _: setattr(self, 'vanished', self.untagged[:]),
+            self._ebGeneral)
+        d1.addCallbacks(strip(resync), self._ebGeneral)
+        d1.addCallbacks(resynced, self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestQResync)
+
+    def _cbTestQResync(self, ignored):
+        self.assertIn('VANISHED 3', self.vanished)
+        self.assertIn('VANISHED (EARLIER) 3', self.vanished)
+        self.assertNotIn('3 EXPUNGE', self.vanished)
+
+        self.assertIn('VANISHED (EARLIER) 3', self.untagged)
+        self.assertEqual(len(self.resynced), 1)
+        msgid, _, items = self.resynced[0]
+        items = dict(zip(items[::2], items[1::2]))
+        self.assertEqual(items['UID'], '1')
+        self.assertIn('\\Seen', items['FLAGS'])
+
+    def testIdle(self):
+        """
+        Test that the new messages are pushed to a client in IDLE, and that
+        a burst of them is sent as a single EXISTS
+        """
+        self.patch(MailboxEvents, 'delay', 60)
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxidle'
+        idling = defer.Deferred()
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def add_messages(_):
+            d = acc.getMailbox(mailbox_name)
+
+            def add(mailbox):
+                d = defer.succeed(None)
+                for i in range(5):
+                    d.addCallback(
+                        lambda _, i=i: mailbox.addMessage('test %d' % i, ()))
+                d.addCallback(lambda _: MailboxEvents.for_collection(
+                    mailbox.collection).flush())
+                return d
+            d.addCallback(add)
+            d.addCallback(lambda _: self.client.sendLine('DONE'))
+            return d
+
+        def idle():
+            d = self.client.sendCommand(imap4.Command(
+                'IDLE', continuation=lambda _: idling.callback(None)))
+            idling.addCallback(add_messages)
+            idling.addErrback(self._ebGeneral)
+            return d
+
+        def idled((lines, tagline)):
+            self.pushed = lines
+
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(idle), self._ebGeneral)
+        d1.addCallbacks(idled, self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestIdle)
+
+    def _cbTestIdle(self, ignored):
+        exists = [line for line in self.pushed if line[1:2] == ['EXISTS']]
+        self.assertEqual(exists, [['5', 'EXISTS']])
+
+    def testNoopUpdates(self):
+        """
+        Test that the changes made by other sessions to the selected mailbox
+        are sent in the response to NOOP, with the sequence numbers that the
+        client knows about
+        """
+        self.patch(MailboxEvents, 'delay', 60)
+        acc = self.server.theAccount
+        mailbox_name = 'mailboxnoop'
+
+        def add_mailbox():
+            return acc.addMailbox(mailbox_name)
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select(mailbox_name)
+
+        def add_messages():
+            d = acc.getMailbox(mailbox_name)
+
+            def add(mailbox):
+                self.mailbox = mailbox
+                d = mailbox.addMessage('test 1', ())
+                d.addCallback(lambda _: mailbox.addMessage('test 2', ()))
+                return d
+            d.addCallback(add)
+            return d
+
+        def change_messages():
+            mailbox = self.mailbox
+            d = mailbox.addMessage('test 3', ())
+            d.addCallback(lambda _: mailbox.store(
+                imap4.MessageSet(2), ('\\Seen',), 1, True))
+            d.addCallback(lambda _: mailbox.store(
+                imap4.MessageSet(1), ('\\Deleted',), 1, True))
+            d.addCallback(lambda _: mailbox.expunge())
+            return d
+
+        def noop():
+            return self.client.noop()
+
+        def nooped(lines):
+            self.updates = lines
+
+        d1 = self.connected.addCallback(strip(add_mailbox))
+        d1.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(change_messages), self._ebGeneral)
+        d1.addCallbacks(strip(noop), self._ebGeneral)
+        d1.addCallbacks(nooped, self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestNoopUpdates)
+
+    def _cbTestNoopUpdates(self, ignored):
+        updates = self.updates
+        self.assertEqual(updates[0], ['1', 'EXPUNGE'])
+        self.assertEqual(updates[1], ['2', 'EXISTS'])
+        fetch = [line for line in updates if line[1:2] == ['FETCH']]
+        self.assertEqual(len(fetch), 1)
+        msn, _, items = fetch[0]
+        self.assertEqual(msn, '1')
+        self.assertEqual(items[0], 'FLAGS')
+        self.assertIn('\\Seen', items[1])
+
+    def testCompress(self):
+        """
+        Test that the session goes on compressed after COMPRESS DEFLATE, and
+        that compression cannot be started twice
+        """
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def compress():
+            return self.client.sendCommand(imap4.Command(
+                'COMPRESS', 'DEFLATE', wantResponse=('OK',)))
+
+        def compressed((lines, tagline)):
+            self.tagline = tagline
+            client = self.client
+            inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            dataReceived = client.dataReceived
+            client.transport = _DeflateTransport(client.transport)
+            client.dataReceived = lambda data: dataReceived(
+                inflater.decompress(data))
+
+        def select():
+            return self.client.select('INBOX')
+
+        def selected(result):
+            self.selected = result
+
+        def compress_again():
+            return self.assertFailure(compress(), imap4.IMAP4Exception)
+
+        def refused(error):
+            self.error = error
+
+        d1 = self.connected.addCallback(strip(login))
+        d1.addCallbacks(strip(compress), self._ebGeneral)
+        d1.addCallbacks(compressed, self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(selected, self._ebGeneral)
+        d1.addCallbacks(strip(compress_again), self._ebGeneral)
+        d1.addCallbacks(refused, self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestCompress)
+
+    def _cbTestCompress(self, ignored):
+        self.assertEqual(self.tagline, 'OK DEFLATE active')
+        self.assertIn('UIDVALIDITY', self.selected)
+        self.assertIn('COMPRESSIONACTIVE', str(self.error))
+
 
 class AccountTestCase(IMAP4HelperMixin):
     """
@@ -1059,5 +1936,253 @@ class IMAP4ServerSearchTestCase(IMAP4HelperMixin):
     """
     Tests for the behavior of the search_* functions in L{imap5.IMAP4Server}.
     """
-    # XXX coming soon to your screens!
-    pass
+
+    messages = [
+        ('From: Alice <alice@example.org>\r\n'
+         'To: bob@example.org\r\n'
+         'Subject: Hello world\r\n'
+         'Date: Mon, 01 Feb 2016 10:00:00 +0000\r\n'
+         'Message-ID: <first.message@example.org>\r\n'
+         '\r\n'
+         'The quick brown fox.\r\n',
+         ('\\Seen',), 'Mon, 01 Feb 2016 10:00:01 +0000'),
+        ('From: Bob <bob@example.org>\r\n'
+         'To: alice@example.org\r\n'
+         'Subject: Meeting\r\n'
+         'Date: Tue, 01 Mar 2016 10:00:00 +0000\r\n'
+         '\r\n'
+         'Jumps over the lazy dog, every single day of the week.\r\n',
+         ('\\Flagged', 'work'), 'Tue, 01 Mar 2016 10:00:01 +0000'),
+        ('From: Alice <alice@example.org>\r\n'
+         'To: bob@example.org\r\n'
+         'Subject: Re: Meeting\r\n'
+         'Date: Fri, 01 Apr 2016 10:00:00 +0000\r\n'
+         'Content-Type: text/plain; charset=utf-8\r\n'
+         'Content-Transfer-Encoding: quoted-printable\r\n'
+         '\r\n'
+         'See you at the caf=C3=A9.\r\n',
+         ('\\Deleted',), 'Fri, 01 Apr 2016 10:00:01 +0000'),
+    ]
+
+    queries = [
+        ('ALL', [1, 2, 3]),
+        ('SEEN', [1]),
+        ('UNSEEN', [2, 3]),
+        ('OR FLAGGED DELETED', [2, 3]),
+        ('KEYWORD work', [2]),
+        ('UNKEYWORD work', [1, 3]),
+        ('FROM alice', [1, 3]),
+        ('NOT FROM alice', [2]),
+        ('SUBJECT meeting', [2, 3]),
+        ('TO "alice@example"', [2]),
+        ('BODY "brown fox"', [1]),
+        ('BODY "fox brown"', []),
+        ('TEXT caf\xc3\xa9', [3]),
+        ('HEADER Message-ID <first.message@example.org>', [1]),
+        ('SINCE 1-Mar-2016', [2, 3]),
+        ('BEFORE 1-Mar-2016', [1]),
+        ('ON 1-Apr-2016', [3]),
+        ('SENTBEFORE 2-Mar-2016 NOT DELETED', [1, 2]),
+        ('LARGER 200', [3]),
+        ('2:*', [2, 3]),
+        ('(1,3 SUBJECT meeting)', [3]),
+    ]
+
+    def testSearch(self):
+        """
+        Test the SEARCH and UID SEARCH commands.
+        """
+        acc = self.server.theAccount
+        self.results = []
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def add_messages():
+            d = acc.addMailbox('searchbox')
+            d.addCallback(lambda _: acc.getMailbox('searchbox'))
+            d.addCallback(add_to_mailbox)
+            return d
+
+        @defer.inlineCallbacks
+        def add_to_mailbox(mailbox):
+            # the first message is deleted, so that the uids and the
+            # sequence numbers differ.
+            yield mailbox.addMessage('Subject: deleted\r\n\r\n', ())
+            pairs = yield mailbox.collection.get_doc_ids_from_uids([1])
+            yield mailbox.collection.delete_msgs([pairs[0][1]])
+            for (msg, flags, date) in self.messages:
+                yield mailbox.addMessage(msg, flags, date)
+
+        def select():
+            return self.client.select('searchbox')
+
+        @defer.inlineCallbacks
+        def search():
+            for query, _ in self.queries:
+                result = yield self.client.search(query)
+                self.results.append(result)
+            result = yield self.client.search('UID 3:* UNSEEN', uid=True)
+            self.results.append(result)
+
+        d1 = self.connected.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(search), self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestSearch)
+
+    def _cbTestSearch(self, ignored):
+        expected = [result for _, result in self.queries] + [[3, 4]]
+        self.assertEqual(self.results, expected)
+
+    threads = [
+        ('Subject: Plans\r\nMessage-ID: <a@example.org>\r\n'
+         'Date: Mon, 01 Feb 2016 10:00:00 +0000\r\n\r\nfirst\r\n'),
+        ('Subject: Re: Plans\r\nMessage-ID: <b@example.org>\r\n'
+         'In-Reply-To: <a@example.org>\r\n'
+         'Date: Tue, 02 Feb 2016 10:00:00 +0000\r\n\r\nsecond\r\n'),
+        ('Subject: Other\r\nMessage-ID: <c@example.org>\r\n'
+         'Date: Wed, 03 Feb 2016 10:00:00 +0000\r\n\r\nthird\r\n'),
+        ('Subject: Re: Plans\r\nMessage-ID: <d@example.org>\r\n'
+         'References: <a@example.org> <b@example.org>\r\n'
+         'Date: Thu, 04 Feb 2016 10:00:00 +0000\r\n\r\nfourth\r\n'),
+        ('Subject: Re: Plans\r\nMessage-ID: <e@example.org>\r\n'
+         'References: <a@example.org>\r\n'
+         'Date: Fri, 05 Feb 2016 10:00:00 +0000\r\n\r\nfifth\r\n'),
+    ]
+
+    def _sendExtensionCommand(self, name, args, uid=False):
+        cmd = imap4.Command(
+            'UID ' + name if uid else name, args, wantResponse=(name,))
+        cmd._1_RESPONSES = cmd._1_RESPONSES + (name,)
+        d = self.client.sendCommand(cmd)
+        d.addCallback(lambda (lines, tagline): lines[0][1:])
+        return d
+
+    def testSort(self):
+        """
+        Test the SORT and UID SORT commands.
+        """
+        acc = self.server.theAccount
+        self.results = []
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        @defer.inlineCallbacks
+        def add_messages():
+            yield acc.addMailbox('sortbox')
+            mailbox = yield acc.getMailbox('sortbox')
+            # the first message is deleted, so that the uids and the
+            # sequence numbers differ.
+            yield mailbox.addMessage('Subject: deleted\r\n\r\n', ())
+            pairs = yield mailbox.collection.get_doc_ids_from_uids([1])
+            yield mailbox.collection.delete_msgs([pairs[0][1]])
+            for (msg, flags, date) in self.messages:
+                yield mailbox.addMessage(msg, flags, date)
+
+        def select():
+            return self.client.select('sortbox')
+
+        @defer.inlineCallbacks
+        def sort():
+            for args in ('(SUBJECT) UTF-8 ALL', '(REVERSE DATE) UTF-8 ALL',
+                         '(FROM SUBJECT) US-ASCII ALL', '(SIZE) UTF-8 2:3'):
+                result = yield self._sendExtensionCommand('SORT', args)
+                self.results.append(result)
+            result = yield self._sendExtensionCommand(
+                'SORT', '(REVERSE ARRIVAL) UTF-8 UNSEEN', uid=True)
+            self.results.append(result)
+            d = self._sendExtensionCommand('SORT', '(SUBJECT) KOI8-R ALL')
+            yield self.assertFailure(d, imap4.IMAP4Exception)
+
+        d1 = self.connected.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(sort), self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestSort)
+
+    def _cbTestSort(self, ignored):
+        self.assertEqual(self.results, [
+            ['1', '2', '3'], ['3', '2', '1'], ['1', '3', '2'], ['2', '3'],
+            ['4', '3']])
+
+    def testThread(self):
+        """
+        Test the THREAD command with both algorithms.
+        """
+        acc = self.server.theAccount
+        self.results = []
+
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        @defer.inlineCallbacks
+        def add_messages():
+            yield acc.addMailbox('threadbox')
+            mailbox = yield acc.getMailbox('threadbox')
+            for msg in self.threads:
+                yield mailbox.addMessage(msg, ())
+
+        def select():
+            return self.client.select('threadbox')
+
+        @defer.inlineCallbacks
+        def thread():
+            for args in ('REFERENCES UTF-8 ALL', 'ORDEREDSUBJECT UTF-8 ALL',
+                         'REFERENCES UTF-8 NOT 3'):
+                result = yield self._sendExtensionCommand('THREAD', args)
+                self.results.append(result)
+
+        d1 = self.connected.addCallback(strip(login))
+        d1.addCallbacks(strip(add_messages), self._ebGeneral)
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(thread), self._ebGeneral)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestThread)
+
+    def _cbTestThread(self, ignored):
+        self.assertEqual(self.results, [
+            [['1', ['2', '4'], ['5']], ['3']],
+            [['1', ['2'], ['4'], ['5']], ['3']],
+            [['1', ['2', '4'], ['5']]]])
+
+    def testSearchBadQuery(self):
+        """
+        Test that an invalid query gets a BAD response.
+        """
+        def login():
+            return self.client.login(TEST_USER, TEST_PASSWD)
+
+        def select():
+            return self.client.select('inbox')
+
+        def search():
+            return self.client.search('SINCE yesterday')
+
+        def failed(failure):
+            self.failure = failure
+
+        self.failure = None
+        d1 = self.connected.addCallback(strip(login))
+        d1.addCallbacks(strip(select), self._ebGeneral)
+        d1.addCallbacks(strip(search), self._ebGeneral)
+        d1.addErrback(failed)
+        d1.addCallbacks(self._cbStopClient, self._ebGeneral)
+        d2 = self.loopback()
+        d = defer.gatherResults([d1, d2])
+        return d.addCallback(self._cbTestSearchBadQuery)
+
+    def _cbTestSearchBadQuery(self, ignored):
+        self.assertIsNot(self.failure, None)
+        self.failure.trap(imap4.IMAP4Exception)
+        # the server logs the error of the search
+        self.flushLoggedErrors(imap4.IllegalQueryError)
@@ -25,9 +25,17 @@ from functools import partial
 from email.parser import Parser
 from email.Utils import formatdate
 
+from twisted.internet import defer
+from twisted.python.monkey import MonkeyPatcher
+
+from leap.bitmask.mail.adaptors.soledad import ContentDocWrapper
 from leap.bitmask.mail.adaptors.soledad import SoledadMailAdaptor
 from leap.bitmask.mail.mail import MessageCollection, Account, _unpack_headers
+from leap.bitmask.mail.mail import Flagsmode, MailboxCounters
 from leap.bitmask.mail.mailbox_indexer import MailboxIndexer
+from leap.bitmask.mail.plugins import soledad_sync_hooks
+from leap.bitmask.mail.search_indexer import SearchIndexer
+from leap.bitmask.mail.sync_hooks import MailProcessingPostSyncHook
 from leap.bitmask.mail.testing.common import SoledadTestMixin
 
 HERE = os.path.split(os.path.abspath(__file__))[0]
@@ -67,16 +75,18 @@ class CollectionMixin(object):
 
         if mbox_collection:
             mbox_indexer = MailboxIndexer(store)
+            search_indexer = SearchIndexer(store)
             mbox_name = mbox_name or "TestMbox"
             mbox_uuid = mbox_uuid or str(uuid.uuid4())
         else:
-            mbox_indexer = mbox_name = None
+            mbox_indexer = search_indexer = mbox_name = None
 
         def get_collection_from_mbox_wrapper(wrapper):
             wrapper.uuid = mbox_uuid
             return MessageCollection(
                 adaptor, store,
-                mbox_indexer=mbox_indexer, mbox_wrapper=wrapper)
+                mbox_indexer=mbox_indexer, mbox_wrapper=wrapper,
+                search_indexer=search_indexer)
 
         d = adaptor.initialize_store(store)
         if mbox_collection:
@@ -173,7 +183,7 @@ class MessageTestCase(SoledadTestMixin, CollectionMixin):
 
     def _test_get_size_cb(self, msg):
         self.assertTrue(msg is not None)
-        expected = len(_get_parsed_msg().as_string())
+        expected = len(_get_raw_msg())
         self.assertEqual(msg.get_size(), expected)
 
     def test_is_multipart_no(self):
@@ -268,12 +278,193 @@ class MessageCollectionTestCase(SoledadTestMixin, CollectionMixin):
     def _test_add_and_count_msg_cb(self, _):
         return partial(self.assert_collection_count, expected=1)
 
+    @defer.inlineCallbacks
+    def test_add_msgs(self):
+        collection = yield self.get_collection()
+        collection.counters = MailboxCounters()
+        notified = []
+        collection.notify_new_to_listeners = notified.append
+
+        msgs = yield collection.add_msgs(
+            [_get_raw_msg(), _get_raw_msg(multi=True)],
+            flags=('\\Recent',), date=_get_msg_time())
+        self.assertEqual([msg.get_uid() for msg in msgs], [1, 2])
+        # a single notification, with the uids of the new messages
+        self.assertEqual(notified, [[1, 2]])
+        counts = yield self._get_counts(collection)
+        self.assertEqual(counts, [2, 2, 2, 3])
+
+        msg = yield collection.get_message_by_uid(2)
+        self.assertTrue(msg.is_multipart())
+        self.assertEqual(list(msg.get_flags()), ['\\Recent'])
+
+    @defer.inlineCallbacks
+    def test_add_msgs_already_stored(self):
+        collection = yield self.get_collection()
+        collection.counters = MailboxCounters()
+        raw = _get_raw_msg()
+        yield collection.add_msg(raw, flags=('\\Recent',))
+
+        # the messages that are already there keep their uid, and they are
+        # not counted twice.
+        msgs = yield collection.add_msgs(
+            [raw, _get_raw_msg(multi=True), raw], flags=('\\Recent',))
+        self.assertEqual([msg.get_uid() for msg in msgs], [1, 2, 1])
+        counts = yield self._get_counts(collection)
+        self.assertEqual(counts, [2, 2, 2, 3])
+        collection.counters.invalidate(collection.mbox_uuid)
+        counts = yield self._get_counts(collection)
+        self.assertEqual(counts, [2, 2, 2, 3])
+
+    @defer.inlineCallbacks
+    def test_add_msg_indexing_error(self):
+        collection = yield self.get_collection()
+
+        def fail(*args):
+            return defer.fail(RuntimeError('indexing failed'))
+
+        self.patch(collection.mbox_indexer, 'insert_docs', fail)
+        yield self.assertFailure(
+            collection.add_msg(_get_raw_msg()), RuntimeError)
+        self.flushLoggedErrors(RuntimeError)
+
     def test_copy_msg(self):
         # TODO ---- update when implementing messagecopier
         # interface
         pass
     test_copy_msg.skip = "Not yet implemented"
 
+    @defer.inlineCallbacks
+    def test_copy_and_delete_msgs(self):
+        collection = yield self.get_collection()
+        target = yield self.get_collection(mbox_name="Archive")
+        yield collection.add_msg(_get_raw_msg(), flags=('\\Seen',))
+        yield collection.add_msg(_get_raw_msg(multi=True))
+        pairs = yield collection.get_doc_ids_from_uids([1, 2])
+        doc_ids = [doc_id for (_, doc_id) in pairs]
+
+        uids = yield target.copy_msgs(doc_ids, target.mbox_uuid)
+        self.assertEqual(uids, [1, 2])
+        msg = yield target.get_message_by_uid(1)
+        self.assertIn('\\Seen', msg.get_flags())
+
+        # a message that is copied again gets a new uid
+        uids = yield target.copy_msgs(doc_ids[1:], target.mbox_uuid)
+        self.assertEqual(uids, [3])
+        count = yield target.count()
+        self.assertEqual(count, 2)
+
+        uids = yield collection.delete_msgs(doc_ids)
+        self.assertEqual(uids, [1, 2])
+        count = yield collection.count()
+        self.assertEqual(count, 0)
+        count = yield target.count()
+        self.assertEqual(count, 2)
+
+    @defer.inlineCallbacks
+    def test_search_index(self):
+        collection = yield self.get_collection()
+        target = yield self.get_collection(mbox_name="Archive")
+        yield collection.add_msg(_get_raw_msg(), flags=('\\Seen',))
+        yield collection.add_msg(_get_raw_msg(multi=True))
+
+        found = yield collection.search(['SEEN'], [1, 2])
+        self.assertEqual(found, [1])
+        found = yield collection.search(['SUBJECT', 'pine'], [1, 2])
+        self.assertEqual(found, [2])
+        found = yield collection.search(['FROM', 'etrepum'], [1, 2])
+        self.assertEqual(found, [1])
+
+        msg = yield collection.get_message_by_uid(2)
+        yield collection.update_flags(msg, ('\\Seen',), Flagsmode.APPEND)
+        found = yield collection.search(['SEEN'], [1, 2])
+        self.assertEqual(found, [1, 2])
+
+        pairs = yield collection.get_doc_ids_from_uids([1, 2])
+        doc_ids = [doc_id for (_, doc_id) in pairs]
+        yield target.copy_msgs(doc_ids, target.mbox_uuid)
+        yield collection.delete_msgs(doc_ids)
+        found = yield collection.search(['ALL'], [])
+        self.assertEqual(found, [])
+        # the copies keep the flags and the text of the originals
+        found = yield target.search(['SEEN', 'TEXT', 'pine'], [1, 2])
+        self.assertEqual(found, [2])
+
+    @defer.inlineCallbacks
+    def test_sort_index(self):
+        collection = yield self.get_collection()
+        yield collection.add_msg(
+            'From: zoe@example.org\r\nSubject: Re: beta\r\n'
+            'Message-ID: <b@example.org>\r\nIn-Reply-To: <a@example.org>\r\n'
+            'Date: Tue, 01 Mar 2016 10:00:00 +0000\r\n\r\nbody')
+        yield collection.add_msg(
+            'From: adam@example.org\r\nSubject: beta\r\n'
+            'Message-ID: <a@example.org>\r\n'
+            'Date: Mon, 01 Feb 2016 10:00:00 +0000\r\n\r\nbody')
+        yield collection.add_msg(
+            'From: bea@example.org\r\nSubject: [list] alpha\r\n'
+            'Date: Wed, 01 Jun 2016 10:00:00 +0000\r\n\r\nbody')
+
+        found = yield collection.sort(['SUBJECT'], ['ALL'], [1, 2, 3])
+        self.assertEqual(found, [3, 1, 2])
+        found = yield collection.sort(['FROM'], ['ALL'], [1, 2, 3])
+        self.assertEqual(found, [2, 3, 1])
+        found = yield collection.sort(['REVERSE', 'DATE'], ['2:3'], [1, 2, 3])
+        self.assertEqual(found, [3, 2])
+        threads = yield collection.thread('REFERENCES', ['ALL'], [1, 2, 3])
+        self.assertEqual(threads, [(2, [(1, [])]), (3, [])])
+
+        # the messages indexed before there were sort keys get them.
+        yield collection.search_indexer._operation(
+            "DELETE FROM leapmail_search_sort")
+        found = yield collection.sort(['SUBJECT'], ['ALL'], [1, 2, 3])
+        self.assertEqual(found, [3, 1, 2])
+
+    @defer.inlineCallbacks
+    def test_search_unindexed_in_windows(self):
+        collection = yield self.get_collection()
+        collection.search_indexer.max_index_msgs = 2
+        for i in range(5):
+            yield collection.add_msg(
+                'Subject: window %d\r\n\r\nbody %d' % (i, i))
+        pairs = yield collection.get_doc_ids_from_uids(range(1, 6))
+        yield collection.search_indexer.delete_entries(
+            [doc_id for (_, doc_id) in pairs])
+
+        windows = []
+        get_messages = collection.get_messages_by_doc_ids
+
+        def get_messages_by_doc_ids(pairs, **kwargs):
+            windows.append(len(pairs))
+            return get_messages(pairs, **kwargs)
+
+        collection.get_messages_by_doc_ids = get_messages_by_doc_ids
+        found = yield collection.search(['SUBJECT', 'window'], range(1, 6))
+        self.assertEqual(found, [1, 2, 3, 4, 5])
+        self.assertEqual(windows, [2, 2, 1])
+
+    @defer.inlineCallbacks
+    def test_copy_search_entries_in_chunks(self):
+        collection = yield self.get_collection()
+        target = yield self.get_collection(mbox_name="Archive")
+        for i in range(5):
+            yield collection.add_msg(
+                'Subject: copy %d\r\n\r\nbody %d' % (i, i),
+                flags=('\\Seen',) if i % 2 else ())
+        pairs = yield collection.get_doc_ids_from_uids(range(1, 6))
+        doc_ids = [doc_id for (_, doc_id) in pairs]
+        target.search_indexer.max_insert_docs = 2
+        yield target.copy_msgs(doc_ids, target.mbox_uuid)
+
+        # the copies are indexed with the flags of the originals
+        unindexed = yield target.search_indexer.get_unindexed(
+            target.mbox_uuid)
+        self.assertEqual(unindexed, [])
+        found = yield target.search(['SEEN'], range(1, 6))
+        self.assertEqual(found, [2, 4])
+        found = yield target.search(['UNSEEN', 'SUBJECT', 'copy'], range(1, 6))
+        self.assertEqual(found, [1, 3, 5])
+
     def test_delete_msg(self):
         d = self.add_msg_to_collection()
 
@@ -296,6 +487,110 @@ class MessageCollectionTestCase(SoledadTestMixin, CollectionMixin):
     def _test_delete_msg_cb(self, _):
         return partial(self.assert_collection_count, expected=0)
 
+    def test_get_messages_by_doc_ids(self):
+        d = self.add_msg_to_collection()
+
+        def get_msgs(collection):
+            d = collection.get_doc_ids_from_uids([1])
+            d.addCallback(lambda pairs: pairs + [(2, None)])
+            d.addCallback(collection.get_messages_by_doc_ids, get_cdocs=True)
+            return d
+
+        d.addCallback(lambda _: self.get_collection(mbox_uuid=self._mbox_uuid))
+        d.addCallback(get_msgs)
+        d.addCallback(self._test_get_messages_by_doc_ids_cb)
+        return d
+
+    def _test_get_messages_by_doc_ids_cb(self, msgs):
+        self.assertEqual(len(msgs), 1)
+        uid, msg = msgs[0]
+        self.assertEqual(uid, 1)
+        self.assertEqual(msg.get_uid(), 1)
+        expected = [
+            (str(key.lower()), str(value))
+            for (key, value) in _get_parsed_msg().items()]
+        self.assertItemsEqual(_unpack_headers(msg.get_headers()), expected)
+        self.assertEqual(
+            msg.get_wrapper().cdocs[1].raw, _get_parsed_msg().get_payload())
+
+    @defer.inlineCallbacks
+    def test_get_flags_by_doc_ids_bulk(self):
+        collection = yield self.get_collection()
+        flags = [('\\Seen', '\\Flagged'), ('\\Seen',), (), ('\\Flagged',)]
+        for i, msg_flags in enumerate(flags):
+            yield collection.add_msg(
+                'Subject: flags %d\r\n\r\nbody %d' % (i, i),
+                flags=msg_flags)
+
+        calls = []
+
+        def record(name):
+            method = getattr(collection.adaptor, name)
+
+            def recorded(*args):
+                calls.append(name)
+                return method(*args)
+            return recorded
+
+        for name in ('get_all_flags_by_chash', 'get_flags_from_mdoc_id'):
+            setattr(collection.adaptor, name, record(name))
+
+        # half of the mailbox or less is retrieved one message at a time
+        pairs = yield collection.get_doc_ids_from_uids([1, 3])
+        result = yield collection.get_flags_by_doc_ids(pairs)
+        self.assertEqual(
+            result, [(1, ['\\Seen', '\\Flagged']), (3, [])])
+        self.assertEqual(calls, ['get_flags_from_mdoc_id'] * 2)
+
+        # and more than that, with a single query for the whole mailbox
+        del calls[:]
+        pairs = yield collection.get_doc_ids_from_uids([1, 2, 4])
+        result = yield collection.get_flags_by_doc_ids(pairs)
+        self.assertEqual(result, [
+            (1, ['\\Seen', '\\Flagged']), (2, ['\\Seen']),
+            (4, ['\\Flagged'])])
+        self.assertEqual(calls, ['get_all_flags_by_chash'])
+
+    @defer.inlineCallbacks
+    def test_counters(self):
+        collection = yield self.get_collection()
+        collection.counters = MailboxCounters()
+
+        yield collection.add_msg(_get_raw_msg(), flags=('\\Recent',))
+        yield collection.add_msg(_get_raw_msg(multi=True), flags=('\\Seen',))
+        counts = yield self._get_counts(collection)
+        self.assertEqual(counts, [2, 1, 1, 3])
+
+        # the cached counters are updated in place, without counting again
+        def fail(*args):
+            raise AssertionError('Counted in the store')
+
+        patcher = MonkeyPatcher(
+            (collection.mbox_indexer, 'count', fail),
+            (collection.mbox_indexer, 'get_next_uid', fail),
+            (collection.adaptor, 'get_count_unseen', fail),
+            (collection.adaptor, 'get_count_recent', fail))
+        patcher.patch()
+        msg = yield collection.get_message_by_uid(1)
+        yield collection.update_flags(msg, ('\\Seen',), Flagsmode.APPEND)
+        counts = yield self._get_counts(collection)
+        self.assertEqual(counts, [2, 0, 1, 3])
+
+        yield collection.delete_msg(msg)
+        counts = yield self._get_counts(collection)
+        self.assertEqual(counts, [1, 0, 0, 3])
+        patcher.restore()
+
+        # and counted again in the store after being invalidated
+        collection.counters.invalidate(collection.mbox_uuid)
+        counts = yield self._get_counts(collection)
+        self.assertEqual(counts, [1, 0, 0, 3])
+
+    def _get_counts(self, collection):
+        return defer.gatherResults([
+            collection.count(), collection.count_unseen(),
+            collection.count_recent(), collection.get_uid_next()])
+
     def test_update_flags(self):
         d = self.add_msg_to_collection()
         d.addCallback(self._test_update_flags_cb)
@@ -393,6 +688,203 @@ class AccountTestCase(SoledadTestMixin):
         d.addCallback(assert_uid_next_empty_collection)
         return d
 
+    @defer.inlineCallbacks
+    def test_mailbox_catalogue(self):
+        acc = self.get_account('some_user_id')
+        yield acc.callWhenReady(lambda _: None)
+        yield acc.add_mailbox("OneMailbox")
+        yield acc.list_all_mailbox_names()
+
+        # the catalogue is kept up to date without listing the store again
+        def fail(*args):
+            raise AssertionError('Listed the mailboxes in the store')
+
+        patcher = MonkeyPatcher((acc.adaptor, 'get_all_mboxes', fail))
+        patcher.patch()
+        yield acc.add_mailbox("TwoMailbox")
+        yield acc.rename_mailbox("OneMailbox", "RenamedMailbox")
+        yield acc.delete_mailbox("Sent")
+        mboxes = yield acc.list_all_mailbox_names()
+        self.assertItemsEqual(
+            mboxes, ["INBOX", "RenamedMailbox", "TwoMailbox"])
+
+        collection = yield acc.get_collection_by_mailbox("TwoMailbox")
+        yield collection.set_mbox_attr("subscribed", True)
+        mailboxes = yield acc.get_all_mailboxes()
+        self.assertEqual(
+            [m.mbox for m in mailboxes if m.subscribed], ["TwoMailbox"])
+        wrapper = acc.mbox_catalogue.get_by_uuid(collection.mbox_uuid)
+        self.assertEqual(wrapper.mbox, "TwoMailbox")
+        patcher.restore()
+
+        # and listed again in the store after being invalidated
+        acc.mbox_catalogue.invalidate()
+        mboxes = yield acc.list_all_mailbox_names()
+        self.assertItemsEqual(
+            mboxes, ["INBOX", "RenamedMailbox", "TwoMailbox"])
+
+    @defer.inlineCallbacks
+    def test_sync_hook_invalidates_catalogue(self):
+        acc = self.get_account('some_user_id')
+        yield acc.callWhenReady(lambda _: None)
+        yield acc.list_all_mailbox_names()
+        hook = MailProcessingPostSyncHook()
+        hook.set_account(acc)
+
+        # neither the documents of other kinds, nor the ones that soledad
+        # creates with a generic doc_id, are mailboxes.
+        other_doc = yield self._soledad.create_doc({'type': 'OpenPGPKey'})
+        acc.cdoc_cache.add('f' * 64, ContentDocWrapper(raw='synced'))
+        yield hook.process_received_docs(
+            [other_doc.doc_id, uuid.uuid4().hex, 'C-' + 'f' * 64])
+        self.assertTrue(acc.mbox_catalogue.loaded)
+        # the synced content documents leave the cache
+        self.assertIs(acc.cdoc_cache.get('f' * 64), None)
+
+        wrapper = acc.mbox_catalogue.get('INBOX')
+        yield hook.process_received_docs([wrapper.doc_id])
+        self.assertFalse(acc.mbox_catalogue.loaded)
+
+    @defer.inlineCallbacks
+    def test_sync_hook_notifies_listeners(self):
+        acc = self.get_account('notify_user_id')
+        yield acc.callWhenReady(lambda _: None)
+        hook = MailProcessingPostSyncHook()
+        hook.set_account(acc)
+        collection = yield acc.get_collection_by_mailbox('INBOX')
+        msg = yield collection.add_msg(_get_raw_msg(), flags=('\\Seen',))
+        wrapper = msg.get_wrapper()
+
+        notified = []
+
+        class Listener(object):
+
+            def notify_new(self):
+                notified.append(None)
+
+            def notify_added(self, uids):
+                notified.append(uids)
+
+            def notify_flags(self, flags):
+                notified.append(flags)
+
+        collection.addListener(Listener())
+        yield hook.process_received_docs(
+            [wrapper.mdoc.doc_id, wrapper.fdoc.doc_id])
+        self.assertIn([1], notified)
+        self.assertIn({1: ('\\Seen',)}, notified)
+
+    @defer.inlineCallbacks
+    def test_content_cache(self):
+        acc = self.get_account('cache_user_id')
+        yield acc.callWhenReady(lambda _: None)
+        cache = acc.cdoc_cache
+        cache.clear()
+        self.assertIs(cache, self.get_account('cache_user_id').cdoc_cache)
+        collection = yield acc.get_collection_by_mailbox('INBOX')
+        yield collection.add_msg(_get_raw_msg(multi=True))
+
+        got = []
+        get_doc = self._soledad.get_doc
+        get_docs = self._soledad.get_docs
+
+        def record_get_doc(doc_id, *args, **kwargs):
+            got.append(doc_id)
+            return get_doc(doc_id, *args, **kwargs)
+
+        def record_get_docs(doc_ids, *args, **kwargs):
+            got.extend(doc_ids)
+            return get_docs(doc_ids, *args, **kwargs)
+
+        self.patch(self._soledad, 'get_doc', record_get_doc)
+        self.patch(self._soledad, 'get_docs', record_get_docs)
+
+        def get_cdoc_ids():
+            cdoc_ids = [doc_id for doc_id in got if doc_id.startswith('C-')]
+            del got[:]
+            return cdoc_ids
+
+        msg = yield collection.get_message_by_uid(1)
+        body = yield msg.get_body_file(self._soledad)
+        self.assertEqual(len(get_cdoc_ids()), 1)
+        self.assertEqual(cache.hits, 0)
+
+        # the body is not retrieved again with the rest of the content
+        msg = yield collection.get_message_by_uid(1, get_cdocs=True)
+        self.assertEqual(len(get_cdoc_ids()), len(msg.get_wrapper().cdocs) - 1)
+        self.assertEqual(cache.hits, 1)
+
+        # and then nothing is retrieved again
+        msg = yield collection.get_message_by_uid(1, get_cdocs=True)
+        again = yield msg.get_body_file(self._soledad)
+        self.assertEqual(again.read(), body.read())
+        self.assertEqual(get_cdoc_ids(), [])
+        self.assertEqual(cache.hits, 1 + len(msg.get_wrapper().cdocs) + 1)
+
+        chash = msg.get_wrapper().mdoc.doc_id.split('-')[-1]
+        same = yield collection.get_message_by_content_hash(chash)
+        self.assertEqual(same.get_wrapper().mdoc.doc_id,
+                         msg.get_wrapper().mdoc.doc_id)
+
+        # and the content of the deleted messages is discarded
+        self.assertTrue(len(cache) > 0)
+        yield collection.delete_msg(msg)
+        self.assertEqual(len(cache), 0)
+
+    def test_acquire_shared(self):
+        acc = Account.acquire(self._soledad, 'shared_user_id')
+        same = Account.acquire(self._soledad, 'shared_user_id')
+        other = Account.acquire(self._soledad, 'other_user_id')
+        self.assertIs(acc, same)
+        self.assertIsNot(acc, other)
+
+        same.release()
+        self.assertFalse(acc.session_ended)
+        acc.release()
+        self.assertTrue(acc.session_ended)
+        other.release()
+
+        renewed = Account.acquire(self._soledad, 'shared_user_id')
+        self.assertIsNot(acc, renewed)
+        renewed.release()
+        return defer.gatherResults([
+            acc.deferred_initialization, other.deferred_initialization,
+            renewed.deferred_initialization])
+
+    def test_acquire_replaced(self):
+        hook = soledad_sync_hooks.post_sync_uid_reindexer
+        old = Account.acquire(self._soledad, 'replaced_user_id')
+        new = Account.acquire(object(), 'replaced_user_id')
+        self.assertIsNot(old, new)
+        self.assertIs(hook._account, new)
+
+        # releasing the replaced account leaves the new one alone
+        old.release()
+        self.assertTrue(old.session_ended)
+        self.assertIs(hook._account, new)
+        self.assertIs(Account.acquire(new.store, 'replaced_user_id'), new)
+        new.release()
+        new.release()
+        self.assertIs(hook._account, None)
+        new._init_d.addErrback(lambda _: None)
+        return old.deferred_initialization
+
+    @defer.inlineCallbacks
+    def test_call_when_ready(self):
+        acc = self.get_account('some_user_id')
+
+        def fail(_):
+            raise RuntimeError('first caller')
+
+        first = acc.callWhenReady(fail)
+        second = acc.callWhenReady(lambda result: result)
+        self.assertIsNot(first, second)
+        result = yield second
+        self.assertIs(result, None)
+        yield self.assertFailure(first, RuntimeError)
+        result = yield acc.callWhenReady(lambda _: 'done')
+        self.assertEqual(result, 'done')
+
     def test_get_collection_by_docs(self):
         pass
 
@@ -20,6 +20,9 @@ Tests for the mailbox_indexer module.
 import uuid
 from functools import partial
 
+from twisted.internet import defer
+from twisted.mail.imap4 import MessageSet
+
 from leap.bitmask.mail import mailbox_indexer as mi
 from leap.bitmask.mail.testing.common import SoledadTestMixin
 
@@ -126,6 +129,40 @@ class MailboxIndexerTestCase(SoledadTestMixin):
         d.addCallback(partial(assert_rowid, expected=3))
         return d
 
+    def test_insert_docs(self):
+        m_uid = self.get_mbox_uid()
+
+        h1 = fmt_hash(mbox_id, hash_test0)
+        h2 = fmt_hash(mbox_id, hash_test1)
+        h3 = fmt_hash(mbox_id, hash_test2)
+        h4 = fmt_hash(mbox_id, hash_test3)
+        h5 = fmt_hash(mbox_id, hash_test4)
+
+        def assert_uids(uids, expected=None):
+            self.assertEqual(uids, expected)
+
+        def assert_uid_rows(rows):
+            expected = [(1, h1), (2, h3), (3, h2), (4, h4), (5, h5)]
+            self.assertEquals(rows, expected)
+
+        m_uid.max_insert_docs = 2
+        d = m_uid.create_table(mbox_id)
+        d.addCallback(lambda _: m_uid.insert_doc(mbox_id, h1))
+        d.addCallback(lambda _: m_uid.insert_docs(mbox_id, [h3, h2, h1, h4]))
+        d.addCallback(partial(assert_uids, expected=[2, 3, 1, 4]))
+        d.addCallback(lambda _: m_uid.insert_docs(mbox_id, [h5]))
+        d.addCallback(partial(assert_uids, expected=[5]))
+        d.addCallback(lambda _: self.select_uid_rows(mbox_id))
+        d.addCallback(assert_uid_rows)
+        return d
+
+    def test_insert_docs_wrong_id(self):
+        m_uid = self.get_mbox_uid()
+        h1 = fmt_hash(mbox_id, hash_test0)
+        self.assertRaises(
+            mi.WrongMetaDocIDError, m_uid.insert_docs, mbox_id,
+            [h1, fmt_hash(str(uuid.uuid4()), hash_test1)])
+
     def test_delete_doc(self):
         m_uid = self.get_mbox_uid()
 
@@ -154,6 +191,32 @@ class MailboxIndexerTestCase(SoledadTestMixin):
         d.addCallback(assert_uid_rows)
         return d
 
+    def test_delete_docs_by_hash(self):
+        m_uid = self.get_mbox_uid()
+
+        h1 = fmt_hash(mbox_id, hash_test0)
+        h2 = fmt_hash(mbox_id, hash_test1)
+        h3 = fmt_hash(mbox_id, hash_test2)
+        h4 = fmt_hash(mbox_id, hash_test3)
+        h5 = fmt_hash(mbox_id, hash_test4)
+
+        def assert_uids(uids, expected=None):
+            self.assertEqual(uids, expected)
+
+        def assert_uid_rows(rows):
+            self.assertEquals(rows, [(2, h2), (4, h4)])
+
+        m_uid.max_insert_docs = 2
+        d = m_uid.create_table(mbox_id)
+        d.addCallback(lambda _: m_uid.insert_docs(
+            mbox_id, [h1, h2, h3, h4, h5]))
+        d.addCallback(lambda _: m_uid.delete_docs_by_hash(
+            mbox_id, [h5, h3, h1]))
+        d.addCallback(partial(assert_uids, expected=[1, 3, 5]))
+        d.addCallback(lambda _: self.select_uid_rows(mbox_id))
+        d.addCallback(assert_uid_rows)
+        return d
+
     def test_get_doc_id_from_uid(self):
         m_uid = self.get_mbox_uid()
 
@@ -248,3 +311,120 @@ class MailboxIndexerTestCase(SoledadTestMixin):
         d.addCallback(lambda _: m_uid.all_uid_iter(mbox_id))
         d.addCallback(partial(assert_all_uid))
         return d
+
+    def test_get_uid_from_msn(self):
+        m_uid = self.get_mbox_uid()
+
+        h1 = fmt_hash(mbox_id, hash_test0)
+        h2 = fmt_hash(mbox_id, hash_test1)
+        h3 = fmt_hash(mbox_id, hash_test2)
+
+        d = m_uid.create_table(mbox_id)
+        d.addCallback(lambda _: m_uid.insert_docs(mbox_id, [h1, h2, h3]))
+        d.addCallback(lambda _: m_uid.delete_doc_by_uid(mbox_id, 1))
+
+        def get_uids(_):
+            return defer.gatherResults([
+                m_uid.get_uid_from_msn(mbox_id, msn) for msn in range(4)])
+
+        d.addCallback(get_uids)
+        d.addCallback(self.assertEquals, [None, 2, 3, None])
+        return d
+
+    def test_get_doc_ids_from_uids(self):
+        m_uid = self.get_mbox_uid()
+
+        h1 = fmt_hash(mbox_id, hash_test0)
+        h2 = fmt_hash(mbox_id, hash_test1)
+        h3 = fmt_hash(mbox_id, hash_test2)
+        h4 = fmt_hash(mbox_id, hash_test3)
+        h5 = fmt_hash(mbox_id, hash_test4)
+
+        d = m_uid.create_table(mbox_id)
+        d.addCallback(lambda _: m_uid.insert_doc(mbox_id, h1))
+        d.addCallback(lambda _: m_uid.insert_doc(mbox_id, h2))
+        d.addCallback(lambda _: m_uid.insert_doc(mbox_id, h3))
+        d.addCallback(lambda _: m_uid.insert_doc(mbox_id, h4))
+        d.addCallback(lambda _: m_uid.insert_doc(mbox_id, h5))
+        d.addCallback(lambda _: m_uid.delete_doc_by_uid(mbox_id, 2))
+
+        def assert_pairs(result, expected=None):
+            self.assertEquals(result, expected)
+
+        d.addCallback(lambda _: m_uid.get_doc_ids_from_uids(
+            mbox_id, MessageSet(1, 3) + MessageSet(5)))
+        d.addCallback(partial(assert_pairs, expected=[(1, h1), (3, h3),
+                                                      (5, h5)]))
+        d.addCallback(lambda _: m_uid.get_doc_ids_from_uids(
+            mbox_id, MessageSet(4, None)))
+        d.addCallback(partial(assert_pairs, expected=[(4, h4), (5, h5)]))
+
+        # n:* with n beyond the last uid still returns the last message
+        d.addCallback(lambda _: m_uid.get_doc_ids_from_uids(
+            mbox_id, MessageSet(50, None)))
+        d.addCallback(partial(assert_pairs, expected=[(5, h5)]))
+        d.addCallback(lambda _: m_uid.get_doc_ids_from_uids(
+            mbox_id, [2, 3, 9]))
+        d.addCallback(partial(assert_pairs, expected=[(3, h3)]))
+        return d
+
+    def test_modseqs(self):
+        m_uid = self.get_mbox_uid()
+
+        h1 = fmt_hash(mbox_id, hash_test0)
+        h2 = fmt_hash(mbox_id, hash_test1)
+        h3 = fmt_hash(mbox_id, hash_test2)
+        h4 = fmt_hash(mbox_id, hash_test3)
+        h5 = fmt_hash(mbox_id, hash_test4)
+
+        def assert_result(result, expected=None):
+            self.assertEquals(result, expected)
+
+        d = m_uid.create_table(mbox_id)
+        d.addCallback(lambda _: m_uid.get_highest_modseq(mbox_id))
+        d.addCallback(partial(assert_result, expected=1))
+        d.addCallback(lambda _: m_uid.insert_doc(mbox_id, h1))
+        d.addCallback(lambda _: m_uid.insert_doc(mbox_id, h2))
+        d.addCallback(lambda _: m_uid.insert_docs(mbox_id, [h3, h4, h5]))
+        d.addCallback(lambda _: m_uid.get_highest_modseq(mbox_id))
+        d.addCallback(partial(assert_result, expected=4))
+
+        # a change and an expunge take the next modseqs of the mailbox
+        d.addCallback(lambda _: m_uid.bump_modseq(mbox_id, [h2]))
+        d.addCallback(lambda _: m_uid.delete_doc_by_uid(mbox_id, 4))
+        d.addCallback(lambda _: m_uid.get_highest_modseq(mbox_id))
+        d.addCallback(partial(assert_result, expected=6))
+
+        d.addCallback(lambda _: m_uid.get_modseqs(mbox_id))
+        d.addCallback(partial(assert_result, expected=[
+            (1, 2), (2, 5), (3, 4), (5, 4)]))
+        d.addCallback(lambda _: m_uid.get_modseqs(mbox_id, changedsince=4))
+        d.addCallback(partial(assert_result, expected=[(2, 5)]))
+        d.addCallback(lambda _: m_uid.get_modseqs(
+            mbox_id, MessageSet(3, None), changedsince=1))
+        d.addCallback(partial(assert_result, expected=[(3, 4), (5, 4)]))
+
+        d.addCallback(lambda _: m_uid.get_expunged(mbox_id, 4))
+        d.addCallback(partial(assert_result, expected=[4]))
+        d.addCallback(lambda _: m_uid.get_expunged(mbox_id, 6))
+        d.addCallback(partial(assert_result, expected=[]))
+        return d
+
+    def test_get_uids_from_doc_ids(self):
+        m_uid = self.get_mbox_uid()
+
+        h1 = fmt_hash(mbox_id, hash_test0)
+        h2 = fmt_hash(mbox_id, hash_test1)
+        h3 = fmt_hash(mbox_id, hash_test2)
+        h4 = fmt_hash(mbox_id, hash_test3)
+
+        def assert_pairs(result, expected=None):
+            self.assertEquals(result, expected)
+
+        m_uid.max_insert_docs = 2
+        d = m_uid.create_table(mbox_id)
+        d.addCallback(lambda _: m_uid.insert_docs(mbox_id, [h1, h2, h3]))
+        d.addCallback(lambda _: m_uid.get_uids_from_doc_ids(
+            mbox_id, [h3, h4, h1]))
+        d.addCallback(partial(assert_pairs, expected=[(1, h1), (3, h3)]))
+        return d
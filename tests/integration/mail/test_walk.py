@@ -5,6 +5,7 @@ import os.path
 from email.parser import Parser
 
 from leap.bitmask.mail import walk
+from leap.bitmask.mail.utils import first
 
 CORPUS = {
     'simple': 'rfc822.message',
@@ -67,6 +68,29 @@ def test_bounce_mime():
         'message/rfc822']
 
 
+def test_walk_msg():
+    msg = _parse('multisigned')
+    tree, raw_docs, body_phash = walk.walk_msg(msg)
+    assert tree == walk.get_tree(msg)
+
+    leaves = []
+
+    def get_leaves(part):
+        if part['multi']:
+            for index in sorted(part['part_map']):
+                get_leaves(part['part_map'][index])
+        else:
+            leaves.append(part)
+
+    get_leaves(tree)
+    assert [doc['phash'] for doc in raw_docs] == [
+        leaf['phash'] for leaf in leaves]
+    assert [doc['content-type'] for doc in raw_docs] == [
+        leaf['ctype'] for leaf in leaves]
+    assert body_phash == first(
+        [leaf['phash'] for leaf in leaves if leaf['ctype'] == 'text/plain'])
+
+
 # utils
 
 def _parse(name):
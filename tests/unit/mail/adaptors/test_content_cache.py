@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# test_content_cache.py
+# Copyright (C) 2016 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from leap.bitmask.mail.adaptors.soledad import ContentDocCache
+from leap.bitmask.mail.adaptors.soledad import ContentDocWrapper
+
+
+def _wrapper(raw):
+    return ContentDocWrapper(raw=raw)
+
+
+class TestContentDocCache(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        cache = ContentDocCache(max_size=100)
+        wrapper = _wrapper('x' * 10)
+        assert cache.get('a') is None
+        cache.add('a', wrapper)
+        assert cache.get('a') is wrapper
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert cache.size == 10
+
+    def test_evicts_least_recently_used(self):
+        cache = ContentDocCache(max_size=30)
+        cache.add('a', _wrapper('a' * 10))
+        cache.add('b', _wrapper('b' * 10))
+        cache.add('c', _wrapper('c' * 10))
+        cache.get('a')
+        cache.add('d', _wrapper('d' * 15))
+        assert cache.get('b') is None
+        assert cache.get('c') is None
+        assert cache.get('a') is not None
+        assert cache.get('d') is not None
+        assert cache.size == 25
+
+    def test_too_big(self):
+        cache = ContentDocCache(max_size=10)
+        cache.add('a', _wrapper('a' * 5))
+        cache.add('b', _wrapper('b' * 11))
+        assert cache.get('b') is None
+        assert len(cache) == 1
+        assert cache.size == 5
+
+    def test_discard(self):
+        cache = ContentDocCache(max_size=100)
+        cache.add('a', _wrapper('a' * 10))
+        cache.add('a', _wrapper('a' * 10))
+        assert cache.size == 10
+        cache.discard('a')
+        cache.discard('b')
+        assert len(cache) == 0
+        assert cache.size == 0
+
+    def test_default_max_size(self):
+        old = ContentDocCache.max_size
+        try:
+            ContentDocCache.set_max_size(20)
+            assert ContentDocCache().max_size == 20
+            assert ContentDocCache(max_size=5).max_size == 5
+        finally:
+            ContentDocCache.set_max_size(old)
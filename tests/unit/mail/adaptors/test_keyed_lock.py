@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# test_keyed_lock.py
+# Copyright (C) 2016 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from twisted.internet import defer
+
+from leap.bitmask.mail.adaptors.soledad import KeyedDeferredLock
+from leap.bitmask.mail.adaptors.soledad import SoledadDocumentWrapper
+from leap.bitmask.mail.adaptors.soledad import SoledadMailAdaptor
+
+
+class TestKeyedDeferredLock(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = KeyedDeferredLock()
+        self.calls = []
+        self.pending = []
+
+    def _blocking_call(self, name):
+        self.calls.append(name)
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def test_same_key(self):
+        self.lock.run('a', self._blocking_call, 1)
+        self.lock.run('a', self._blocking_call, 2)
+        assert self.calls == [1]
+
+        self.pending[0].callback(None)
+        assert self.calls == [1, 2]
+
+    def test_other_key(self):
+        self.lock.run('a', self._blocking_call, 1)
+        self.lock.run('b', self._blocking_call, 2)
+        assert self.calls == [1, 2]
+
+    def test_discard(self):
+        results = []
+        d = self.lock.run('a', self._blocking_call, 1)
+        d.addCallback(results.append)
+        assert 'a' in self.lock._locks
+
+        self.pending[0].callback('done')
+        assert results == ['done']
+        assert self.lock._locks == {}
+
+
+class TestMailboxLocks(unittest.TestCase):
+
+    def setUp(self):
+        self._old_locks = SoledadMailAdaptor._mbox_locks
+        SoledadMailAdaptor._mbox_locks = KeyedDeferredLock()
+        self.adaptor = SoledadMailAdaptor()
+        self.store = object()
+
+    def tearDown(self):
+        SoledadMailAdaptor._mbox_locks = self._old_locks
+
+    def test_mailboxes(self):
+        pending = []
+        calls = []
+
+        def call(name):
+            calls.append(name)
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        run = self.adaptor.run_with_mbox_lock
+        run(self.store, ('INBOX',), call, 'inbox')
+        run(self.store, ('Sent',), call, 'sent')
+        run(object(), ('INBOX',), call, 'other store')
+        run(self.store, ('Sent', 'inbox'), call, 'rename')
+        assert calls == ['inbox', 'sent', 'other store']
+
+        pending[0].callback(None)
+        assert calls == ['inbox', 'sent', 'other store']
+        pending[1].callback(None)
+        assert calls == ['inbox', 'sent', 'other store', 'rename']
+
+
+class _BlockingWrapper(SoledadDocumentWrapper):
+
+    calls = []
+    pending = []
+
+    @classmethod
+    def _block(cls, name):
+        cls.calls.append(name)
+        d = defer.Deferred()
+        cls.pending.append(d)
+        return d
+
+    @classmethod
+    def _get_or_create(cls, store, index, value):
+        return cls._block(value)
+
+    @classmethod
+    def _get_all(cls, store):
+        return cls._block('all')
+
+
+class TestWrapperLocks(unittest.TestCase):
+
+    def setUp(self):
+        self._old_locks = SoledadDocumentWrapper._k_locks
+        SoledadDocumentWrapper._k_locks = KeyedDeferredLock()
+        _BlockingWrapper.calls = []
+        _BlockingWrapper.pending = []
+        self.store = object()
+
+    def tearDown(self):
+        SoledadDocumentWrapper._k_locks = self._old_locks
+
+    def test_get_or_create_and_get_all(self):
+        calls = _BlockingWrapper.calls
+        pending = _BlockingWrapper.pending
+        _BlockingWrapper.get_or_create(self.store, 'by-name', 'INBOX')
+        _BlockingWrapper.get_or_create(self.store, 'by-name', 'INBOX')
+        _BlockingWrapper.get_all(self.store)
+        _BlockingWrapper.get_all(self.store)
+        _BlockingWrapper.get_or_create(self.store, 'by-name', 'Sent')
+
+        # the same document is only looked up (and created) once at a time,
+        # and the listings are serialized among them, but neither waits for
+        # the other.
+        assert calls == ['INBOX', 'all', 'Sent']
+
+        pending[1].callback([])
+        assert calls == ['INBOX', 'all', 'Sent', 'all']
+        pending[0].callback(None)
+        assert calls == ['INBOX', 'all', 'Sent', 'all', 'INBOX']
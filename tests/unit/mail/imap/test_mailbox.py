@@ -15,35 +15,130 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+
 import unittest
 
-from leap.bitmask.mail.imap.mailbox import make_collection_listener
+from twisted.internet import defer, task
+from twisted.mail.imap4 import MessageSet
+
+from leap.bitmask.mail.imap.mailbox import IMAPMailbox, MailboxEvents
+from leap.bitmask.mail.imap.mailbox import MessageSequence
+
+
+class _collection(object):
+
+    def __init__(self, uids):
+        self.uids = uids
+        self.listeners = set()
+
+    def addListener(self, listener):
+        self.listeners.add(listener)
+
+    def all_uid_iter(self):
+        return defer.succeed(list(self.uids))
+
+    def count_recent(self):
+        return defer.succeed(2)
+
+    def get_modseqs(self, uids):
+        return defer.succeed([(uid, 10 + uid) for uid in uids])
+
 
+class _listener(object):
 
-class _mbox(object):
-    pass
+    pending = 0
 
+    def updatesPending(self):
+        self.pending += 1
 
-class TestListener(unittest.TestCase):
+
+class TestMailboxEvents(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.collection = _collection([1, 2, 3, 5])
+        self.mbox = IMAPMailbox(self.collection)
+        self.listener = _listener()
+        self.mbox.load_uids()
+        self.mbox.addListener(self.listener)
+        self.events = MailboxEvents.for_collection(self.collection)
+        self.clock = task.Clock()
+        self.events.clock = self.clock
+
+    def test_one_source(self):
+        assert self.collection.listeners == set([self.events])
+        other = IMAPMailbox(self.collection)
+        other.addListener(_listener())
+        assert MailboxEvents.for_collection(self.collection) is self.events
+        assert self.collection.listeners == set([self.events])
+
+    def test_coalesce(self):
+        for uid in range(6, 56):
+            self.events.notify_added([uid])
+        self.events.notify_flags({2: ('\\Seen',)})
+        assert self.listener.pending == 0
+        self.clock.advance(MailboxEvents.delay)
+        assert self.listener.pending == 1
+
+        updates = self.mbox.get_updates()
+        assert updates.exists == 54
+        assert updates.recent == 2
+        assert updates.flags == [(2, 2, ('\\Seen',), 12)]
+        assert self.mbox.get_updates() is None
+
+    def test_expunge(self):
+        self.events.notify_added([6])
+        self.events.notify_expunged([2, 5, 6])
+        self.events.notify_flags({3: ('\\Flagged',)})
+        self.events.flush()
 
-    def test_mailbox_listener(self):
-        mbox1 = _mbox()
-        mbox1.mbox_name = 'inbox'
+        updates = self.mbox.get_updates()
+        # each msn is valid once the higher ones are expunged
+        assert updates.expunged == [4, 2]
+        assert updates.vanished == [2, 5]
+        assert updates.exists is None
+        assert updates.flags == [(2, 3, ('\\Flagged',), 13)]
+
+    def test_no_listeners(self):
+        self.mbox.removeListener(self.listener)
+        self.events.notify_added([6])
+        assert not self.clock.getDelayedCalls()
+        assert self.mbox.get_updates() is None
+
+
+class TestMessageSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.sequence = MessageSequence([5, 2, 3, 9])
 
-        mbox2 = _mbox()
-        mbox2.mbox_name = 'inbox'
+    def test_lookup(self):
+        assert list(self.sequence) == [2, 3, 5, 9]
+        assert self.sequence.get_uid(3) == 5
+        assert self.sequence.get_uid(5) is None
+        assert self.sequence.get_msn(9) == 4
+        assert self.sequence.get_msn(4) is None
+        assert 3 in self.sequence
 
-        mbox3 = _mbox()
-        mbox3.mbox_name = 'trash'
+    def test_changes(self):
+        assert self.sequence.add(12)
+        assert not self.sequence.add(3)
+        assert self.sequence.add(4)
+        assert list(self.sequence) == [2, 3, 4, 5, 9, 12]
+        assert self.sequence.remove(5) == 4
+        assert self.sequence.remove(5) is None
+        assert self.sequence.get_msn(9) == 4
 
-        _set1 = set([mbox1] + [make_collection_listener(mbox2)] +
-                    [make_collection_listener(mbox3)])
-        assert len(_set1) == 3
+    def test_msn_ranges(self):
+        get_ranges = self.sequence.get_ranges
+        assert get_ranges(MessageSet(2, None), False) == [(2, 4)]
+        assert get_ranges(MessageSet(7, None), False) == [(4, 4)]
+        assert get_ranges(MessageSet(5, 8), False) == []
+        assert get_ranges([1, 3, 4], False) == [(1, 1), (3, 4)]
 
-        _set2 = set([make_collection_listener(mbox1)] +
-                    [make_collection_listener(mbox2)] +
-                    [make_collection_listener(mbox3)])
-        assert len(_set2) == 2
+    def test_uid_ranges(self):
+        get_ranges = self.sequence.get_ranges
+        assert get_ranges(MessageSet(3, 8), True) == [(2, 3)]
+        # n:* has the last message even if n is higher than its uid
+        assert get_ranges(MessageSet(20, None), True) == [(4, 4)]
+        assert get_ranges(MessageSet(6, 8), True) == []
+        uids = self.sequence.get_uid_set(get_ranges(MessageSet(3, 8), True))
+        assert uids.ranges == [(3, 5)]
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# test_server.py
+# Copyright (C) 2016 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import StringIO
+import unittest
+import zlib
+
+from twisted.internet import interfaces, task
+from twisted.mail import imap4
+from twisted.test.proto_helpers import StringTransport
+
+from leap.bitmask.mail.imap.server import _get_fetch_plan, _FetchThrottle
+from leap.bitmask.mail.imap.server import _DeflateTransport
+from leap.bitmask.mail.imap.server import _FileWindow, _formatBodyItem
+from leap.bitmask.mail.imap.server import _formatThread
+from leap.bitmask.mail.imap.server import _formatSequenceSet, _splitFetchAtts
+
+
+def _parse(query):
+    parser = imap4._FetchParser()
+    parser.parseString(query)
+    return parser.result
+
+
+class TestFetchPlan(unittest.TestCase):
+
+    def test_flags_only(self):
+        plan = _get_fetch_plan(_parse('(UID FLAGS RFC822.SIZE)'))
+        assert plan == (False, False)
+
+    def test_mua_sync(self):
+        plan = _get_fetch_plan(_parse('(UID FLAGS RFC822.SIZE ENVELOPE)'))
+        assert plan == (True, False)
+
+    def test_header_fields(self):
+        plan = _get_fetch_plan(_parse(
+            '(UID BODY.PEEK[HEADER.FIELDS (Subject From)] INTERNALDATE)'))
+        assert plan == (True, False)
+
+    def test_bodystructure(self):
+        plan = _get_fetch_plan(_parse('(UID ENVELOPE BODYSTRUCTURE)'))
+        assert plan == (True, False)
+
+    def test_body(self):
+        assert _get_fetch_plan(_parse('(UID BODY[])')) == (True, True)
+        assert _get_fetch_plan(_parse('(BODY[TEXT])')) == (True, True)
+        assert _get_fetch_plan(_parse('RFC822')) == (True, True)
+
+
+class TestFetchThrottle(unittest.TestCase):
+
+    def test_wait(self):
+        throttle = _FetchThrottle()
+        fired = []
+        throttle.wait().addCallback(fired.append)
+        assert fired == [None]
+
+        throttle.pauseProducing()
+        throttle.wait().addCallback(fired.append)
+        assert fired == [None]
+
+        throttle.resumeProducing()
+        assert fired == [None, None]
+
+    def test_stop(self):
+        throttle = _FetchThrottle()
+        fired = []
+        throttle.pauseProducing()
+        throttle.wait().addCallback(fired.append)
+        throttle.stopProducing()
+        assert fired == [None]
+        assert throttle.stopped
+
+
+class TestDeflateTransport(unittest.TestCase):
+
+    def _transport(self):
+        raw = StringTransport()
+        transport = _DeflateTransport(raw)
+        transport.clock = task.Clock()
+        return raw, transport
+
+    def _inflate(self, data):
+        return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+
+    def test_flush_once(self):
+        raw, transport = self._transport()
+        transport.write('* 1 EXISTS\r\n')
+        transport.writeSequence(['* 0 RECENT', '\r\n'])
+        assert transport.clock.getDelayedCalls()[0].active()
+        written = raw.value()
+
+        transport.clock.advance(0)
+        assert raw.value() != written
+        assert self._inflate(raw.value()) == '* 1 EXISTS\r\n* 0 RECENT\r\n'
+        assert not transport.clock.getDelayedCalls()
+
+    def test_lose_connection(self):
+        raw, transport = self._transport()
+        transport.write('* BYE\r\n')
+        transport.loseConnection()
+        assert self._inflate(raw.value()) == '* BYE\r\n'
+        assert raw.disconnecting
+        assert not transport.clock.getDelayedCalls()
+
+    def test_wrapped(self):
+        raw, transport = self._transport()
+        assert interfaces.ITransport.providedBy(transport)
+        assert transport.getPeer() == raw.getPeer()
+
+
+class TestFileWindow(unittest.TestCase):
+
+    def test_read(self):
+        window = _FileWindow(StringIO.StringIO('0123456789'), 2, 5)
+        assert window.read(3) == '234'
+        assert window.read() == '56'
+        assert window.read() == ''
+
+    def test_size(self):
+        window = _FileWindow(StringIO.StringIO('0123456789'), 8, 5)
+        window.seek(0, 2)
+        assert window.tell() == 2
+        window.seek(0)
+        assert window.read() == '89'
+
+    def test_out_of_range(self):
+        window = _FileWindow(StringIO.StringIO('0123456789'), 20, 5)
+        assert window.read() == ''
+
+
+class TestFormatBodyItem(unittest.TestCase):
+
+    def test_partial(self):
+        item = _parse('BODY[]<1024.512>')[0]
+        assert _formatBodyItem(item) == 'BODY[]<1024>'
+        item = _parse('BODY[1.TEXT]<0.10>')[0]
+        assert _formatBodyItem(item) == 'BODY[1.TEXT]<0>'
+
+    def test_not_partial(self):
+        item = _parse('BODY[2]')[0]
+        assert _formatBodyItem(item) == 'BODY[2]'
+
+
+class TestSplitFetchAtts(unittest.TestCase):
+
+    def test_modseq(self):
+        assert _splitFetchAtts('(FLAGS MODSEQ) (CHANGEDSINCE 5)') == (
+            '(FLAGS)', True, '(CHANGEDSINCE 5)')
+        assert _splitFetchAtts('MODSEQ') == ('', True, '')
+
+    def test_no_modseq(self):
+        assert _splitFetchAtts('(UID BODY[HEADER.FIELDS (From)])') == (
+            '(UID BODY[HEADER.FIELDS (From)])', False, '')
+        assert _splitFetchAtts('FAST') == ('FAST', False, '')
+
+
+class TestFormatSequenceSet(unittest.TestCase):
+
+    def test_ranges(self):
+        assert _formatSequenceSet([7, 1, 2, 3]) == '1:3,7'
+        assert _formatSequenceSet([4]) == '4'
+
+
+class TestFormatThread(unittest.TestCase):
+
+    def test_chain(self):
+        assert _formatThread((1, [(2, [(3, [])])])) == '1 2 3'
+
+    def test_siblings(self):
+        thread = (1, [(2, [(4, [])]), (5, [])])
+        assert _formatThread(thread) == '1 (2 4)(5)'
+
+    def test_dummy(self):
+        assert _formatThread((None, [(3, []), (5, [])])) == '(3)(5)'
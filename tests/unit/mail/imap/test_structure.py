@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# test_structure.py
+# Copyright (C) 2016 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import subprocess
+import sys
+import unittest
+
+from email.parser import Parser
+
+from leap.bitmask.mail.imap.structure import get_body_structure
+from leap.bitmask.mail.imap.structure import get_envelope
+
+
+MULTIPART = '''\
+From: alice@example.org
+To: bob@example.org
+Subject: structure
+Content-Type: multipart/mixed; boundary="AbCdEf"
+
+--AbCdEf
+Content-Type: text/plain
+
+hello
+--AbCdEf--
+'''
+
+
+class TestStructure(unittest.TestCase):
+
+    def test_boundary_case_is_kept(self):
+        msg = Parser().parsestr(MULTIPART)
+        structure = get_body_structure(msg)
+        assert structure[1] == 'mixed'
+        assert structure[2] == ['boundary', 'AbCdEf']
+
+    def test_envelope(self):
+        msg = Parser().parsestr(MULTIPART)
+        envelope = get_envelope(msg)
+        assert envelope[1] == 'structure'
+
+    def test_no_server_import(self):
+        # the structure is computed by the storage adaptor, which must not
+        # pull in the IMAP server.
+        code = (
+            "import sys\n"
+            "import leap.bitmask.mail.adaptors.soledad\n"
+            "assert 'leap.bitmask.mail.imap.server' not in sys.modules\n")
+        assert subprocess.call([sys.executable, '-c', code]) == 0
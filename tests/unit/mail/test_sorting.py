@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# test_sorting.py
+# Copyright (C) 2016 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from leap.bitmask.mail.sorting import ThreadMessage, get_base_subject
+from leap.bitmask.mail.sorting import parse_message_ids
+from leap.bitmask.mail.sorting import thread_ordered_subject
+from leap.bitmask.mail.sorting import thread_references
+
+
+def _msg(uid, date, subject, message_id=None, references=()):
+    subject, reply = get_base_subject(subject)
+    return ThreadMessage(
+        uid, date, subject, reply, message_id, list(references))
+
+
+class TestBaseSubject(unittest.TestCase):
+
+    def test_plain(self):
+        assert get_base_subject(u'Hello  \t world') == (u'Hello world', False)
+        assert get_base_subject(u'') == (u'', False)
+
+    def test_reply(self):
+        assert get_base_subject(u'Re: Hello') == (u'Hello', True)
+        assert get_base_subject(u'RE: Fwd: re [2]: Hello') == (u'Hello', True)
+        assert get_base_subject(u'Hello (fwd)') == (u'Hello', True)
+        assert get_base_subject(u'[Fwd: Re: Hello]') == (u'Hello', True)
+
+    def test_blobs(self):
+        assert get_base_subject(u'[list] Re: Hello') == (u'Hello', True)
+        assert get_base_subject(u'[list] Hello') == (u'Hello', False)
+        # a blob that is the whole subject is kept
+        assert get_base_subject(u'[list]') == (u'[list]', False)
+
+
+class TestMessageIds(unittest.TestCase):
+
+    def test_parse(self):
+        assert parse_message_ids('<a@x> <b@x>\r\n <c@x>') == [
+            '<a@x>', '<b@x>', '<c@x>']
+        assert parse_message_ids('garbage') == []
+        assert parse_message_ids(None) == []
+
+
+class TestOrderedSubject(unittest.TestCase):
+
+    def test_threads(self):
+        threads = thread_ordered_subject([
+            _msg(1, 30, u'Plans'),
+            _msg(2, 10, u'Other'),
+            _msg(3, 20, u'Re: Plans'),
+            _msg(4, 40, u'Re: Plans'),
+            _msg(5, 50, u'Re: Other')])
+        assert threads == [
+            (2, [(5, [])]),
+            (3, [(1, []), (4, [])])]
+
+
+class TestReferences(unittest.TestCase):
+
+    def test_links(self):
+        threads = thread_references([
+            _msg(1, 10, u'Plans', '<a@x>'),
+            _msg(2, 20, u'Re: Plans', '<b@x>', ['<a@x>']),
+            _msg(3, 30, u'Other', '<c@x>'),
+            _msg(4, 40, u'Re: Plans', '<d@x>', ['<a@x>', '<b@x>']),
+            _msg(5, 50, u'Re: Plans', '<e@x>', ['<a@x>'])])
+        assert threads == [
+            (1, [(2, [(4, [])]), (5, [])]),
+            (3, [])]
+
+    def test_missing_parent(self):
+        # the replies to a message that is not in the mailbox are siblings
+        # under a dummy.
+        threads = thread_references([
+            _msg(1, 10, u'Re: Lost', '<b@x>', ['<a@x>']),
+            _msg(2, 20, u'Something else', '<c@x>', ['<a@x>'])])
+        assert threads == [(None, [(1, []), (2, [])])]
+
+        # but not a single one.
+        threads = thread_references([
+            _msg(1, 10, u'Re: Lost', '<b@x>', ['<a@x>'])])
+        assert threads == [(1, [])]
+
+    def test_subject(self):
+        # the replies without references join the thread of their subject,
+        # and two originals with the same subject go under a dummy.
+        threads = thread_references([
+            _msg(1, 10, u'Plans', '<a@x>'),
+            _msg(2, 20, u'Re: Plans', '<b@x>'),
+            _msg(3, 30, u'Plans', '<c@x>')])
+        assert threads == [(None, [(1, [(2, [])]), (3, [])])]
+
+    def test_duplicates_and_loops(self):
+        # the second message cannot be the child of the first one, that is
+        # its child already, and the third one has a duplicated id.
+        threads = thread_references([
+            _msg(1, 10, u'One', '<a@x>', ['<b@x>']),
+            _msg(2, 20, u'Two', '<b@x>', ['<a@x>']),
+            _msg(3, 30, u'Three', '<a@x>')])
+        assert threads == [(2, [(1, [])]), (3, [])]